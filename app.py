@@ -1,7 +1,13 @@
 import os
 import sys
+import hmac
+import json
+import time
+import hashlib
+import threading
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, session, redirect, url_for, jsonify
+from flask import Flask, Response, abort, g, render_template, request, session, redirect, url_for, jsonify, stream_with_context
+from markupsafe import escape
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from pathlib import Path
@@ -13,15 +19,23 @@ if root_dir not in sys.path:
     sys.path.insert(0, root_dir)
 
 from src.gemini_rag_model import RAGChatbot
-from src.utils import convert_markdown_to_html
+from src.utils import MarkdownRenderer, convert_markdown_to_html
 from src.config import Config
+from src.conversation_store import create_conversation_store
+from src.single_flight import create_single_flight, normalize_query
+from src.batch_answering import BatchAnswerer, read_completed_ids, read_items
+from src.indexing import get_index_state, start_background_indexing
+from src.tenants import TenantRegistry
+from src.storage_profiles import FULL_VECTOR, get_vector_sizes
+from src.metrics import clear_trace, current_trace, finish_trace, observe_stage, record_error, render_metrics, start_trace, timed_stage
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SESSION_SECRET_KEY")
 
-@app.template_filter('markdown_to_html')
-def markdown_to_html_filter(text):
-    return convert_markdown_to_html(text)
+def render_markdown(text):
+    """Convert markdown to HTML, timed as a pipeline stage"""
+    with timed_stage("markdown"):
+        return convert_markdown_to_html(text)
 
 limiter = Limiter(
     get_remote_address,
@@ -30,16 +44,155 @@ limiter = Limiter(
     storage_uri=os.getenv("REDIS_URL", "memory://")
 )
 
-# Initialize RAGChatbot
-chatbot = RAGChatbot(config=Config)
+# Chatbot of each tenant, created on its first request, corpus is indexed in background so workers serve requests immediately
+tenants = TenantRegistry(Config, RAGChatbot, on_load=start_background_indexing if Config.INDEX_ON_STARTUP else None)
+
+@app.url_value_preprocessor
+def select_tenant(endpoint, values):
+    """Select tenant of the request by its /t/<tenant> path prefix, otherwise by its host"""
+    g.path_tenant = values.pop("tenant", None) if values else None
+    g.tenant = tenants.resolve(request.host, g.path_tenant)
+    if g.tenant is None:
+        abort(404)
+
+@app.url_defaults
+def add_tenant(endpoint, values):
+    # Links of pages served under /t/<tenant> stay under it
+    if g.get("path_tenant") and "tenant" not in values and app.url_map.is_endpoint_expecting(endpoint, "tenant"):
+        values["tenant"] = g.path_tenant
+
+def get_chatbot():
+    """Chatbot of the tenant of the request"""
+    return tenants.get(g.get("tenant") or Config.DEFAULT_TENANT)
+
+# Chat history is stored server side, the session cookie only holds the conversation id
+conversation_store = create_conversation_store(Config)
+
+def conversation_key():
+    """Session key of the conversation id, a session has one conversation per tenant"""
+    tenant = g.get("tenant") or Config.DEFAULT_TENANT
+    return "conversation_id" if tenant == Config.DEFAULT_TENANT else f"conversation_id:{tenant}"
+
+def get_conversation_id(create=False):
+    """Get conversation id of the session, a new one is created when asked"""
+    # Sessions from before the conversation store kept their history in the cookie
+    session.pop("chat_history", None)
+    key = conversation_key()
+    if key not in session and create:
+        session[key] = conversation_store.new_id()
+    return session.get(key)
 
 @app.route("/", methods=["GET"])
+@app.route("/t/<tenant>/", methods=["GET"])
 def home():
-    if "chat_history" not in session:
-        session["chat_history"] = []
-    return render_template("index.html", chat_history=session["chat_history"])
+    conversation_id = get_conversation_id()
+    chat_history = conversation_store.get_messages(conversation_id) if conversation_id else []
+    return render_template("index.html", chat_history=chat_history, brand_name=get_chatbot().config.BRAND_NAME)
+
+ERROR_MESSAGE = """
+    **Demo Limit Reached**
+    
+    This is a portfolio demo with limited API quota. The chatbot is temporarily unavailable.
+    
+    For questions about this project or to discuss production implementation, please contact me at lngquoctrung.work@gmail.com
+"""
+
+# Probes and metrics scrapes are not traced
+UNTRACED_ENDPOINTS = {"static", "health", "metrics"}
+
+@app.before_request
+def start_request_trace():
+    if request.endpoint in UNTRACED_ENDPOINTS:
+        clear_trace()
+    else:
+        start_trace()
+
+@app.after_request
+def finish_request_trace(response):
+    trace = current_trace()
+    if trace is not None:
+        endpoint = request.endpoint or "not_found"
+        method = request.method
+        # Streamed responses are still generating here, the trace ends when the stream is closed
+        response.call_on_close(lambda: finish_trace(trace, endpoint, method, response.status_code))
+    return response
+
+def build_prompt(chatbot, conversation_id, user_message):
+    """Store user message in chat history, create prompt with recent conversation and its summary
+
+    Returns the prompt and the recent messages, which are used to rewrite follow-up questions.
+    """
+    recent_messages = conversation_store.get_messages(conversation_id, last=chatbot.config.CONVERSATION_PROMPT_MESSAGES)
+    summary = conversation_store.get_summary(conversation_id)["text"] if recent_messages else ""
+
+    # Store user's chat history, user messages are shown as plain text
+    conversation_store.append(conversation_id, "user", user_message, str(escape(user_message)))
+    return chatbot.build_conversation_prompt(user_message, recent_messages, summary), recent_messages
+
+# Conversations whose summary is being updated by this process
+summarizing = set()
+summarizing_lock = threading.Lock()
+
+def update_summary(chatbot, conversation_id):
+    """Fold messages which left the prompt window into the rolling summary of the conversation"""
+    try:
+        summary = conversation_store.get_summary(conversation_id)
+        messages = conversation_store.get_messages(conversation_id)
+        if not messages:
+            return
+        window_start = messages[-1]["seq"] + 1 - chatbot.config.CONVERSATION_PROMPT_MESSAGES
+        pending = [message for message in messages if summary["summarized"] <= message["seq"] < window_start]
+        if pending:
+            text = chatbot.summarize_conversation(summary["text"], pending)
+            conversation_store.set_summary(conversation_id, text, window_start)
+    except Exception as e:
+        print(f"Error summarizing conversation: {str(e)}")
+    finally:
+        with summarizing_lock:
+            summarizing.discard(conversation_id)
+
+def store_answer(chatbot, conversation_id, bot_response, bot_response_html):
+    """Store assistant answer in chat history, summarize older messages in background when enough are waiting"""
+    total = conversation_store.append(conversation_id, "assistant", bot_response, bot_response_html)
+    summarized = conversation_store.get_summary(conversation_id)["summarized"]
+    if total - chatbot.config.CONVERSATION_PROMPT_MESSAGES - summarized < chatbot.config.CONVERSATION_SUMMARY_BATCH:
+        return
+    with summarizing_lock:
+        if conversation_id in summarizing:
+            return
+        summarizing.add(conversation_id)
+    threading.Thread(target=update_summary, args=(chatbot, conversation_id), daemon=True).start()
+
+# Identical prompts in flight at the same time share one generation, across workers with Redis
+generation_flight = create_single_flight("generation", Config)
+
+def generation_key(chatbot, prompt):
+    """Key of a generation, the prompt holds the question and the conversation it depends on
+
+    Tenants answer the same prompt from their own documents, so the key holds the collection.
+    """
+    return hashlib.sha256(f"{chatbot.collection_name}:{normalize_query(prompt)}".encode("utf-8")).hexdigest()
+
+def generate_answer(chatbot, prompt, question, history):
+    """Generate answer, or wait for the answer of the same prompt in progress"""
+    if generation_flight is None:
+        return chatbot.generate_response(prompt, question=question, history=history)
+    return generation_flight.do(generation_key(chatbot, prompt), lambda: chatbot.generate_response(prompt, question=question, history=history))
+
+def generate_answer_stream(chatbot, prompt, question, history):
+    """Stream answer, or the answer of the same prompt in progress from its start"""
+    if generation_flight is None:
+        return chatbot.generate_response_stream(prompt, question=question, history=history)
+    return generation_flight.stream(
+        "stream:" + generation_key(chatbot, prompt), lambda: chatbot.generate_response_stream(prompt, question=question, history=history)
+    )
+
+def format_sse(event, data):
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.route("/chat", methods=["POST"])
+@app.route("/t/<tenant>/chat", methods=["POST"])
 @limiter.limit("50 per hour")
 def chat():
     try:
@@ -48,39 +201,16 @@ def chat():
         if not user_message:
             return jsonify({"error": "Empty message"}), 400
 
-        # Store user's chat history
-        if "chat_history" not in session:
-            session["chat_history"] = []
-        session["chat_history"].append(("user", user_message))
-        session.modified = True
-
-        # Create context from chat history
-        context = ""
-        if len(session["chat_history"]) > 1:
-            recent_messages = session["chat_history"][-5:]
-            context_parts = []
-            for role, msg in recent_messages[:-1]:
-                role_name = "Khách hàng" if role == "user" else "Trợ lý"
-                context_parts.append(f"{role_name}: {msg}")
-            context = "\n".join(context_parts)
-
-        # Create prompt with context
-        if context:
-            prompt = f"""
-                Lịch sử hội thoại gần đây:
-                {context}
-                Câu hỏi mới nhất: {user_message}
-            """
-        else:
-            prompt = user_message
+        chatbot = get_chatbot()
+        conversation_id = get_conversation_id(create=True)
+        prompt, history = build_prompt(chatbot, conversation_id, user_message)
         
         # Generate response
-        bot_response = chatbot.generate_response(prompt)
-        bot_response_html = convert_markdown_to_html(bot_response)
+        bot_response = generate_answer(chatbot, prompt, user_message, history)
+        bot_response_html = render_markdown(bot_response)
 
         # Store assistant's chat history
-        session["chat_history"].append(("assistant", bot_response))
-        session.modified = True
+        store_answer(chatbot, conversation_id, bot_response, bot_response_html)
 
         return jsonify({
             "response": bot_response_html,
@@ -90,38 +220,141 @@ def chat():
     except Exception as e:
         # Log error
         print(f"Error in chat endpoint: {str(e)}")
-        
-        error_message = """
-            **Demo Limit Reached**
-            
-            This is a portfolio demo with limited API quota. The chatbot is temporarily unavailable.
-            
-            For questions about this project or to discuss production implementation, please contact me at lngquoctrung.work@gmail.com
-        """
+        record_error(str(e))
         
         return jsonify({
-            "response": convert_markdown_to_html(error_message),
+            "response": convert_markdown_to_html(ERROR_MESSAGE),
             "status": "error"
         }), 200
 
+@app.route("/chat/stream", methods=["POST"])
+@app.route("/t/<tenant>/chat/stream", methods=["POST"])
+@limiter.limit("50 per hour")
+def chat_stream():
+    """Stream response tokens as server-sent events"""
+    # Get user message
+    user_message = request.json.get("message", "").strip()
+    if not user_message:
+        return jsonify({"error": "Empty message"}), 400
+
+    # User message is stored before streaming starts
+    chatbot = get_chatbot()
+    conversation_id = get_conversation_id(create=True)
+    prompt, history = build_prompt(chatbot, conversation_id, user_message)
+
+    def generate():
+        answer_parts = []
+        # Markdown is rendered as lines complete, tokens carry the HTML of the lines they complete
+        renderer = MarkdownRenderer()
+        html_parts = []
+        markdown_seconds = 0.0
+        try:
+            for text in generate_answer_stream(chatbot, prompt, user_message, history):
+                answer_parts.append(text)
+                start = time.perf_counter()
+                html = renderer.feed(text)
+                markdown_seconds += time.perf_counter() - start
+                html_parts.append(html)
+                yield format_sse("token", {"text": text, "html": html, "pending": renderer.pending()})
+
+            # Chat history is stored server side, so the answer is stored when the stream completes
+            bot_response = "".join(answer_parts)
+            start = time.perf_counter()
+            html_parts.append(renderer.close())
+            observe_stage("markdown", markdown_seconds + time.perf_counter() - start)
+            bot_response_html = "".join(html_parts)
+            store_answer(chatbot, conversation_id, bot_response, bot_response_html)
+            yield format_sse("done", {
+                "response": bot_response_html,
+                "status": "success"
+            })
+        except Exception as e:
+            # Log error
+            print(f"Error in chat stream endpoint: {str(e)}")
+            record_error(str(e))
+            yield format_sse("error", {
+                "response": convert_markdown_to_html(ERROR_MESSAGE),
+                "status": "error"
+            })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/batch", methods=["POST"])
+@app.route("/t/<tenant>/batch", methods=["POST"])
+@limiter.limit("10 per hour")
+def batch():
+    """Answer a JSONL file of questions, results are streamed as JSONL in completion order
+
+    The questions are the request body or its "questions" file. Results of a previous
+    run can be sent as "completed" file, questions it answered are skipped. Requires
+    the BATCH_API_TOKEN bearer token.
+    """
+    token = os.getenv("BATCH_API_TOKEN")
+    if not token:
+        return jsonify({"error": "Batch API is disabled"}), 403
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    chatbot = get_chatbot()
+    questions = request.files.get("questions")
+    lines = (questions.read() if questions else request.get_data()).decode("utf-8").splitlines()
+    items = list(read_items(lines))
+    if not items:
+        return jsonify({"error": "No questions"}), 400
+    if len(items) > chatbot.config.BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {chatbot.config.BATCH_MAX_ITEMS} questions per request"}), 413
+
+    completed = request.files.get("completed")
+    skip_ids = read_completed_ids(completed.read().decode("utf-8").splitlines()) if completed else set()
+    answerer = BatchAnswerer(chatbot, batch_size=chatbot.config.BATCH_SIZE, max_concurrency=chatbot.config.BATCH_MAX_CONCURRENCY)
+
+    def generate():
+        for result in answerer.answer(items, skip_ids):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route("/reset", methods=["POST"])
+@app.route("/t/<tenant>/reset", methods=["POST"])
 def reset():
-    session["chat_history"] = []
-    session.modified = True
+    conversation_id = get_conversation_id()
+    if conversation_id:
+        conversation_store.clear(conversation_id)
+        session.pop(conversation_key())
     return redirect(url_for("home"))
 
 @app.route("/health", methods=["GET"])
+@app.route("/t/<tenant>/health", methods=["GET"])
 @limiter.exempt
 def health():
-    """Health check endpoint"""
+    """Health check endpoint of the tenant, the default tenant is loaded at startup"""
     try:
+        chatbot = get_chatbot()
+        # Queries are served while indexing or stale, as long as a collection exists
+        index_state = get_index_state(chatbot)
+        if index_state["state"] == "missing":
+            return jsonify({
+                "status": "starting",
+                "vector_db": "connected",
+                "index": index_state
+            }), 503
+
         # Check Qdrant connection
         count = chatbot.qdrant_client.count(chatbot.collection_name).count
         
         return jsonify({
             "status": "healthy",
             "vector_db": "connected",
-            "indexed_chunks": count
+            "indexed_chunks": count,
+            "index": index_state
         }), 200
     except Exception as e:
         return jsonify({
@@ -129,18 +362,40 @@ def health():
             "error": str(e)
         }), 500
 
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def metrics():
+    """Prometheus metrics of all workers: stage and request latencies, Gemini tokens, cache lookups"""
+    data, content_type = render_metrics()
+    return Response(data, headers={"Content-Type": content_type})
+
 @app.route("/stats", methods=["GET"])
+@app.route("/t/<tenant>/stats", methods=["GET"])
 @limiter.exempt
 def stats():
     """Debug endpoint để xem stats của vector database"""
     try:
+        chatbot = get_chatbot()
+        index_state = get_index_state(chatbot)
+        if index_state["state"] == "missing":
+            return jsonify({"collection_name": chatbot.collection_name, "index": index_state, "status": "missing"}), 503
+
         collection_info = chatbot.qdrant_client.get_collection(chatbot.collection_name)
+        # Tiered collections have a full and a coarse vector
+        vector_sizes = get_vector_sizes(collection_info)
         
         return jsonify({
             "collection_name": chatbot.collection_name,
             "total_chunks": collection_info.points_count,
-            "vector_size": collection_info.config.params.vectors.size,
-            "status": "ready"
+            "vector_size": vector_sizes[FULL_VECTOR],
+            "vectors": vector_sizes,
+            "embedding_cache": chatbot.embedding_cache.stats() if chatbot.embedding_cache else None,
+            "response_cache": chatbot.response_cache.stats() if chatbot.response_cache else None,
+            "faq_index": chatbot.faq_index.stats(index_state.get("collection")) if chatbot.faq_index else None,
+            "index": index_state,
+            "tenant": g.tenant,
+            "tenants": tenants.stats(),
+            "status": index_state["state"]
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
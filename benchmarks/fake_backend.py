@@ -0,0 +1,127 @@
+import re
+import time
+import hashlib
+import numpy as np
+
+from typing import List, Iterator
+from google.genai import types
+from src.lexical_index import tokenize
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Deterministic embedding of a text, hashed bag of terms and character trigrams
+
+    Texts sharing words get close vectors, so retrieval quality measured with it follows
+    chunking and ranking changes, although it does not understand meaning like Gemini.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    terms = tokenize(text)
+    term_set = set(terms)
+    features = terms + [term[i:i + 3] for term in terms if len(term) > 3 for i in range(len(term) - 2)]
+    for feature in features:
+        digest = hashlib.md5(feature.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        # Whole terms weigh more than their trigrams
+        vector[index] += sign * (2.0 if feature in term_set else 0.5)
+
+    norm = float(np.linalg.norm(vector))
+    if norm > 0:
+        vector /= norm
+    return vector.tolist()
+
+def _content_text(contents) -> str:
+    """Get text of generate_content contents"""
+    if isinstance(contents, str):
+        return contents
+    texts = []
+    for content in contents:
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, dict):
+            texts.extend(part.get("text", "") for part in content.get("parts", []))
+        else:
+            texts.extend(part.text or "" for part in content.parts)
+    return "\n".join(texts)
+
+def _count_tokens(text: str) -> int:
+    """Approximate Gemini token count, about 4 characters per token"""
+    return max(1, len(text) // 4)
+
+class FakeModels:
+    """Stand-in of genai.Client().models with deterministic answers and fixed latencies"""
+    def __init__(self, embed_latency: float = 0.0, generate_latency: float = 0.0, stream_chunk_size: int = 5):
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.stream_chunk_size = stream_chunk_size
+
+    def _embed(self, contents, config=None) -> types.EmbedContentResponse:
+        if isinstance(contents, str):
+            contents = [contents]
+        dim = config.output_dimensionality if config is not None and config.output_dimensionality else 768
+        return types.EmbedContentResponse(
+            embeddings=[types.ContentEmbedding(values=fake_embedding(text, dim)) for text in contents]
+        )
+
+    def embed_content(self, model, contents, config=None) -> types.EmbedContentResponse:
+        time.sleep(self.embed_latency)
+        return self._embed(contents, config)
+
+    def _answer(self, prompt: str) -> str:
+        """Build answer from the first document of the context, formatted like Gemini answers"""
+        # Query rewrite prompts are answered with the previous user message and the question
+        rewrite = re.search(r"Khách hàng: (?P<previous>[^\n]*)\n(?:.*\n)*?\s*Câu hỏi mới nhất: (?P<question>[^\n]*)\n\s*Viết lại", prompt)
+        if rewrite:
+            return f"{rewrite.group('previous')} {rewrite.group('question')}"
+
+        match = re.search(r"\[Document 1 - (?P<filename>[^\]]+)\]\n(?P<text>.*?)(?:\n\n---|\Z)", prompt, re.S)
+        if not match:
+            return "Xin lỗi, tôi không tìm thấy thông tin này. Vui lòng liên hệ support@techshop.com"
+
+        sentences = [line.strip() for line in match.group("text").split("\n") if line.strip()]
+        bullets = "\n".join(f"- {sentence}" for sentence in sentences[1:4])
+        return (
+            f"**Theo {match.group('filename')}**: {sentences[0] if sentences else ''}\n\n"
+            f"{bullets}\n\n"
+            "Bạn còn thắc mắc gì khác không?"
+        )
+
+    def _response(self, text: str, prompt: str) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=_count_tokens(prompt),
+                candidates_token_count=_count_tokens(text),
+            ),
+        )
+
+    def generate_content(self, model, contents, config=None) -> types.GenerateContentResponse:
+        time.sleep(self.generate_latency)
+        prompt = _content_text(contents)
+        return self._response(self._answer(prompt), prompt)
+
+    def _stream_parts(self, prompt: str) -> List[str]:
+        words = self._answer(prompt).split(" ")
+        size = self.stream_chunk_size
+        return [" ".join(words[i:i + size]) + (" " if i + size < len(words) else "") for i in range(0, len(words), size)]
+
+    def _stream_response(self, parts: List[str], idx: int, prompt: str) -> types.GenerateContentResponse:
+        """Response of a stream chunk, usage metadata counts the answer streamed so far like Gemini"""
+        response = self._response("".join(parts[:idx + 1]), prompt)
+        response.candidates[0].content.parts[0].text = parts[idx]
+        return response
+
+    def generate_content_stream(self, model, contents, config=None) -> Iterator[types.GenerateContentResponse]:
+        prompt = _content_text(contents)
+        parts = self._stream_parts(prompt)
+        for idx, part in enumerate(parts):
+            # Latency of the whole answer is spread over its chunks
+            time.sleep(self.generate_latency / len(parts))
+            yield self._stream_response(parts, idx, prompt)
+
+    def count_tokens(self, model, contents, config=None) -> types.CountTokensResponse:
+        return types.CountTokensResponse(total_tokens=_count_tokens(_content_text(contents)))
+
+class FakeGenaiClient:
+    """Offline stand-in of genai.Client, embeddings and answers are deterministic"""
+    def __init__(self, embed_latency: float = 0.0, generate_latency: float = 0.0):
+        self.models = FakeModels(embed_latency=embed_latency, generate_latency=generate_latency)
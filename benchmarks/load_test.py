@@ -0,0 +1,359 @@
+"""Load test the Flask endpoints of one container, against a mock Gemini server and a local Qdrant
+
+Starts the mock Gemini server, then for each gunicorn worker and thread configuration
+starts the app with gunicorn.conf.py, waits until the corpus is indexed and drives it
+with virtual users at each concurrency level. A virtual user keeps its session cookie
+for a conversation of a few questions, then starts a new one like a new visitor:
+
+    docker run -d -p 6333:6333 qdrant/qdrant:v1.15
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --workers 1 2 4 --threads 16 64 --concurrency 8 32 128 --duration 30
+    python benchmarks/load_test.py --generate-latency-ms 2000 --error-rate 0.05 --mix chat=6,chat_stream=2,health=1,stats=1
+    python benchmarks/load_test.py --rate-limits --redis-url redis://localhost:6379 --output load.json
+
+Questions are read from a JSONL file like the batch input ({"id", "question"} or
+{"request_id", "title", "body"}). Chunks are indexed into the loadtest_docs collection,
+so the collections of the app are not touched. The report gives throughput, latency
+percentiles, error and rate limited shares of each configuration and level.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+
+# Add root directory to sys.path, like app.py
+root_dir = str(Path(__file__).parent.parent.absolute())
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+import httpx
+
+from mock_gemini_server import MockGeminiServer
+from run_benchmark import parse_override
+from src.config import Config
+from src.batch_answering import read_items
+
+# Method and path of the endpoints virtual users call
+ENDPOINTS = {
+    "chat": ("POST", "/chat"),
+    "chat_stream": ("POST", "/chat/stream"),
+    "health": ("GET", "/health"),
+    "stats": ("GET", "/stats"),
+}
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """Parse "chat=8,health=1" into endpoints and weights"""
+    weights = []
+    for part in mix.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint.strip() not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {endpoint!r}, use {', '.join(ENDPOINTS)}")
+        weights.append((endpoint.strip(), float(weight or 1)))
+    return weights
+
+def load_questions(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [item["question"] for item in read_items(f) if "error" not in item]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class AppServer:
+    """Gunicorn serving the app with one worker and thread configuration"""
+    def __init__(self, workers: int, threads: int, env: Dict[str, str], log_path: str):
+        self.workers = workers
+        self.threads = threads
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = log_path
+        self.env = dict(
+            env,
+            GUNICORN_BIND=f"127.0.0.1:{self.port}",
+            GUNICORN_WORKERS=str(workers),
+            GUNICORN_THREADS=str(threads),
+        )
+        self.process = None
+
+    def start(self):
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--pythonpath", "benchmarks", "load_test_app:app"],
+            cwd=root_dir, env=self.env, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout: float):
+        """Wait until the corpus is indexed, the first start indexes it through the mock server"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Gunicorn exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                response = httpx.get(f"{self.url}/health", timeout=5)
+                if response.status_code == 200 and response.json().get("index", {}).get("state") == "ready":
+                    return
+            except (httpx.HTTPError, ValueError):
+                pass
+            time.sleep(1)
+        raise TimeoutError(f"App not ready after {timeout}s, see {self.log_path}")
+
+    def rss_mb(self) -> Optional[float]:
+        """Resident memory of gunicorn and its workers, from /proc"""
+        pids = [self.process.pid]
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as f:
+                pids += [int(pid) for pid in f.read().split()]
+            rss_kb = 0
+            for pid in pids:
+                with open(f"/proc/{pid}/status") as f:
+                    rss_kb += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+            return round(rss_kb / 1024, 1)
+        except (OSError, StopIteration, ValueError):
+            return None
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log.close()
+
+def _send(client: httpx.Client, endpoint: str, question: str) -> Tuple[int, bool]:
+    """Send a request, returns its status and whether it succeeded"""
+    method, path = ENDPOINTS[endpoint]
+    if endpoint == "chat":
+        response = client.post(path, json={"message": question})
+        # Failed generations are answered with the error message and status 200
+        return response.status_code, response.status_code == 200 and response.json().get("status") == "success"
+    if endpoint == "chat_stream":
+        with client.stream(method, path, json={"message": question}) as response:
+            body = response.read().decode("utf-8")
+        return response.status_code, response.status_code == 200 and "event: done" in body
+    response = client.request(method, path)
+    return response.status_code, response.status_code == 200
+
+def run_user(
+    base_url: str, questions: List[str], mix: List[Tuple[str, float]], turns: int,
+    timeout: float, deadline: float, seed: int, results: List[Tuple],
+):
+    """Virtual user sending requests until the deadline, results are (start, endpoint, status, ok, seconds)"""
+    rng = random.Random(seed)
+    endpoints = [endpoint for endpoint, _ in mix]
+    weights = [weight for _, weight in mix]
+    chat_turns = 0
+    with httpx.Client(base_url=base_url, timeout=timeout) as client:
+        while time.time() < deadline:
+            endpoint = rng.choices(endpoints, weights)[0]
+            if endpoint in ("chat", "chat_stream"):
+                # A new session cookie after each conversation, like a new visitor
+                if chat_turns == turns:
+                    client.cookies.clear()
+                    chat_turns = 0
+                chat_turns += 1
+            started_at = time.time()
+            start = time.perf_counter()
+            try:
+                status, ok = _send(client, endpoint, rng.choice(questions))
+            except (httpx.HTTPError, ValueError):
+                status, ok = 0, False
+            results.append((started_at, endpoint, status, ok, time.perf_counter() - start))
+
+def _latency_stats(seconds: List[float]) -> Dict:
+    if not seconds:
+        return {"p50_ms": None, "p90_ms": None, "p99_ms": None}
+    return {
+        f"p{p}_ms": round(float(np.percentile(seconds, p)) * 1000, 1) for p in (50, 90, 99)
+    }
+
+def summarize(results: List[Tuple], window: float) -> Dict:
+    """Throughput, latency percentiles and error shares of requests started in the measured window"""
+    summary = {"requests": len(results), "throughput_rps": round(len(results) / window, 2)}
+    summary.update(_latency_stats([result[4] for result in results if result[3]]))
+    summary["error_rate"] = round(sum(1 for result in results if not result[3] and result[2] != 429) / max(len(results), 1), 4)
+    summary["rate_limited_rate"] = round(sum(1 for result in results if result[2] == 429) / max(len(results), 1), 4)
+
+    summary["endpoints"] = {}
+    for endpoint in sorted({result[1] for result in results}):
+        endpoint_results = [result for result in results if result[1] == endpoint]
+        summary["endpoints"][endpoint] = dict(
+            requests=len(endpoint_results),
+            throughput_rps=round(len(endpoint_results) / window, 2),
+            errors=sum(1 for result in endpoint_results if not result[3] and result[2] != 429),
+            rate_limited=sum(1 for result in endpoint_results if result[2] == 429),
+            **_latency_stats([result[4] for result in endpoint_results if result[3]]),
+        )
+    return summary
+
+def run_level(
+    server: AppServer, mock: MockGeminiServer, questions: List[str], mix: List[Tuple[str, float]],
+    concurrency: int, duration: float, warmup: float, turns: int, timeout: float,
+) -> Dict:
+    """Drive the app with concurrent virtual users, requests of the warmup are not measured"""
+    results = []
+    started_at = time.time()
+    measure_from = started_at + warmup
+    deadline = measure_from + duration
+    users = [
+        threading.Thread(
+            target=run_user,
+            args=(server.url, questions, mix, turns, timeout, deadline, seed, results),
+            daemon=True,
+        )
+        for seed in range(concurrency)
+    ]
+    for user in users:
+        user.start()
+    time.sleep(max(measure_from - time.time(), 0))
+    mock.reset_stats()
+    for user in users:
+        user.join()
+
+    measured = [result for result in results if result[0] >= measure_from]
+    summary = summarize(measured, duration)
+    summary.update(concurrency=concurrency, rss_mb=server.rss_mb(), gemini=mock.stats())
+    return summary
+
+def print_report(report: Dict):
+    print(f"\nMock Gemini: embed {report['mock']['embed_latency_ms']} ms, generate {report['mock']['generate_latency_ms']} ms, error rate {report['mock']['error_rate']}")
+    print(f"Mix: {report['mix']}, rate limits {'on' if report['rate_limits'] else 'off'}, limiter storage {report['limiter_storage']}")
+    print(f"\n{'workers':>8}{'threads':>9}{'users':>7}{'req/s':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>9}{'429':>8}{'RSS MB':>9}{'Gemini':>8}{'failed':>8}")
+    for run in report["runs"]:
+        for level in run["levels"]:
+            latencies = "".join("-".rjust(10) if level[key] is None else f"{level[key]:>10.1f}" for key in ("p50_ms", "p90_ms", "p99_ms"))
+            rss = "-" if level["rss_mb"] is None else f"{level['rss_mb']:.1f}"
+            # Calls and injected errors of the mock server, retries of the app included
+            upstream = sum(level["gemini"]["requests"].values())
+            failed = sum(level["gemini"]["errors"].values())
+            print(
+                f"{run['workers']:>8}{run['threads']:>9}{level['concurrency']:>7}{level['throughput_rps']:>9.2f}{latencies}"
+                f"{level['error_rate']:>9.2%}{level['rate_limited_rate']:>8.1%}{rss:>9}{upstream:>8}{failed:>8}"
+            )
+    print("\nLatency percentiles are of successful requests, errors exclude rate limited (429) requests")
+    print("Gemini calls and failed calls are counted by the mock server while measuring")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Flask endpoints with a mock Gemini server")
+    parser.add_argument("--questions", default=str(Path(__file__).parent / "queries.jsonl"), help="JSONL file of questions")
+    parser.add_argument("--qdrant-url", default=os.getenv("LOAD_TEST_QDRANT_URL", "http://localhost:6333"), help="Local Qdrant server")
+    parser.add_argument("--redis-url", default=None, help="Redis of limiter, caches and locks, in-memory and SQLite when not set")
+    parser.add_argument("--workers", type=int, nargs="*", default=[2], help="Gunicorn worker counts, the Dockerfile runs 2")
+    parser.add_argument("--threads", type=int, nargs="*", default=[64], help="Threads per worker, the Dockerfile runs 64")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 32, 64], help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds of each level")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds of each level before measuring")
+    parser.add_argument("--turns", type=int, default=3, help="Questions of a conversation, before a new session")
+    parser.add_argument("--mix", default="chat=8,health=1,stats=1", help="Weights of endpoints: chat, chat_stream, health, stats")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Client timeout of a request")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the per-address rate limits of the app")
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0, help="Latency of mock embedding calls")
+    parser.add_argument("--generate-latency-ms", type=float, default=800.0, help="Latency of mock generation calls")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Mock latencies vary uniformly by this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock model calls failing")
+    parser.add_argument("--error-status", type=int, default=503, help="Status of failing mock calls: 429, 500 or 503")
+    parser.add_argument("--ready-timeout", type=float, default=300.0, help="Seconds to wait for the app to index the corpus")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a Config value of the app")
+    parser.add_argument("--output", help="Write report as JSON to this file")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    mix = parse_mix(args.mix)
+    mock = MockGeminiServer(
+        embed_latency=args.embed_latency_ms / 1000, generate_latency=args.generate_latency_ms / 1000,
+        jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status,
+    ).start()
+    print(f"Mock Gemini server on {mock.url}")
+
+    with tempfile.TemporaryDirectory(prefix="techshop-load-test-") as work_dir:
+        overrides = {
+            # Collections of the load test, apart from the collections of the app
+            "QDRANT_COLLECTION_NAME": "loadtest_docs",
+            "RESPONSE_CACHE_COLLECTION_NAME": "loadtest_response_cache",
+            # Questions of the file repeat, answers would come from the response cache
+            "RESPONSE_CACHE_ENABLED": False,
+            # The mock server has no quota
+            "GEMINI_RATE_LIMITS": {},
+            "INDEX_ON_STARTUP": True,
+            "EMBEDDING_CACHE_PATH": os.path.join(work_dir, "embeddings.sqlite3"),
+            "CONVERSATION_STORE_PATH": os.path.join(work_dir, "conversations.sqlite3"),
+            "INDEX_STATE_DIR": os.path.join(work_dir, "index"),
+            "LEXICAL_INDEX_DIR": os.path.join(work_dir, "lexical"),
+            "EXTRACTION_CACHE_DIR": os.path.join(work_dir, "extraction"),
+            "TENANTS_FILE": "",
+        }
+        overrides.update(parse_override(assignment) for assignment in args.set)
+        for key in overrides:
+            if not hasattr(Config, key):
+                raise ValueError(f"Unknown config key: {key}")
+
+        env = dict(
+            os.environ,
+            GEMINI_BASE_URL=mock.url,
+            GOOGLE_API_KEY="mock",
+            QDRANT_URL=args.qdrant_url,
+            SESSION_SECRET_KEY="load-test",
+            PROMETHEUS_MULTIPROC_DIR=os.path.join(work_dir, "prometheus"),
+            LOAD_TEST_CONFIG=json.dumps(overrides),
+            LOAD_TEST_RATE_LIMITS="1" if args.rate_limits else "0",
+        )
+        env.pop("REDIS_URL", None)
+        if args.redis_url:
+            env["REDIS_URL"] = args.redis_url
+
+        report = {
+            "mock": {
+                "embed_latency_ms": args.embed_latency_ms,
+                "generate_latency_ms": args.generate_latency_ms,
+                "error_rate": args.error_rate,
+            },
+            "mix": args.mix,
+            "rate_limits": args.rate_limits,
+            "limiter_storage": "redis" if args.redis_url else "memory",
+            "overrides": {key: value for key, value in overrides.items() if key not in ("EMBEDDING_CACHE_PATH", "CONVERSATION_STORE_PATH", "INDEX_STATE_DIR", "LEXICAL_INDEX_DIR", "EXTRACTION_CACHE_DIR")},
+            "runs": [],
+        }
+        try:
+            for workers in args.workers:
+                for threads in args.threads:
+                    server = AppServer(workers, threads, env, os.path.join(work_dir, f"gunicorn-{workers}x{threads}.log"))
+                    print(f"Starting {workers} workers x {threads} threads...")
+                    server.start()
+                    try:
+                        server.wait_ready(args.ready_timeout)
+                        run = {"workers": workers, "threads": threads, "levels": []}
+                        for concurrency in args.concurrency:
+                            print(f"  {concurrency} users for {args.duration:.0f}s...")
+                            run["levels"].append(run_level(
+                                server, mock, questions, mix, concurrency, args.duration, args.warmup, args.turns, args.timeout
+                            ))
+                        report["runs"].append(run)
+                    except Exception:
+                        with open(server.log_path) as f:
+                            print(f.read()[-3000:])
+                        raise
+                    finally:
+                        server.stop()
+        finally:
+            mock.stop()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""App served by load tests, with the Config overrides of the LOAD_TEST_CONFIG environment variable
+
+    LOAD_TEST_CONFIG='{"GEMINI_RATE_LIMITS": {}}' gunicorn --config gunicorn.conf.py --pythonpath benchmarks load_test_app:app
+
+Overrides are applied before the app is imported, so its chatbots are created with
+them. LOAD_TEST_RATE_LIMITS=0 disables the rate limits of the app, all virtual users
+of a load test come from one address.
+"""
+import os
+import sys
+import json
+
+from pathlib import Path
+
+# Add root directory to sys.path, like app.py
+root_dir = str(Path(__file__).parent.parent.absolute())
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from src.config import Config
+
+for key, value in json.loads(os.getenv("LOAD_TEST_CONFIG", "{}")).items():
+    if not hasattr(Config, key):
+        raise ValueError(f"Unknown config key: {key}")
+    setattr(Config, key, value)
+
+import app as flask_app
+
+flask_app.limiter.enabled = os.getenv("LOAD_TEST_RATE_LIMITS", "1") != "0"
+app = flask_app.app
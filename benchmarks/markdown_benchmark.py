@@ -0,0 +1,253 @@
+"""Golden checks and micro-benchmark of the markdown renderer of src/utils.py
+
+Checks the renderer against expected HTML of typical answers, against the previous
+renderer (kept below) where that one was correct, and that feeding text in streamed
+chunks gives the same HTML as rendering it at once. Then times both renderers:
+
+    python benchmarks/markdown_benchmark.py
+    python benchmarks/markdown_benchmark.py --repeat 2000
+
+Exits with status 1 when a check fails. The previous renderer needs bleach, which the
+app no longer depends on: without it, only the current renderer is checked and timed.
+"""
+import re
+import sys
+import time
+import argparse
+
+try:
+    import bleach
+except ImportError:
+    bleach = None
+
+from typing import Callable, List, Dict
+from pathlib import Path
+
+# Add root directory to sys.path, like app.py
+root_dir = str(Path(__file__).parent.parent.absolute())
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from src.utils import MarkdownRenderer, convert_markdown_to_html
+
+def legacy_convert_markdown_to_html(markdown):
+    """Renderer of src/utils.py before the single-pass renderer, kept as reference"""
+    allowed_tags = ['b', 'strong', 'i', 'em', 'u', 'p', 'br', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'code', 'pre', 'span', 'div']
+    allowed_attrs = {'*': ['class']}
+
+    html = bleach.clean(markdown, tags=[], strip=True)
+
+    def replace_code_block(match):
+        code_content = match.group(1).strip()
+        return f'<pre><code>{code_content}</code></pre>'
+
+    html = re.sub(r'``````', replace_code_block, html)
+    html = re.sub(r'`([^`]+)`', r'<code>\1</code>', html)
+    html = re.sub(r'^#### (.*?)$', r'<h4>\1</h4>', html, flags=re.MULTILINE)
+    html = re.sub(r'^### (.*?)$', r'<h3>\1</h3>', html, flags=re.MULTILINE)
+    html = re.sub(r'^## (.*?)$', r'<h2>\1</h2>', html, flags=re.MULTILINE)
+    html = re.sub(r'^# (.*?)$', r'<h1>\1</h1>', html, flags=re.MULTILINE)
+    html = re.sub(r'\*\*\*(.*?)\*\*\*', r'<b><i>\1</i></b>', html)
+    html = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', html)
+    html = re.sub(r'\*(.*?)\*', r'<i>\1</i>', html)
+
+    processed_lines = []
+    in_ordered_list = False
+    in_unordered_list = False
+    prev_was_list_item = False
+
+    for line in html.split('\n'):
+        stripped = line.strip()
+
+        if not stripped or stripped.startswith('<h') or stripped.startswith('<pre>') or stripped.startswith('</pre>') or stripped.startswith('<code>'):
+            if in_unordered_list and not prev_was_list_item:
+                processed_lines.append('</ul>')
+                in_unordered_list = False
+            if in_ordered_list and not prev_was_list_item:
+                processed_lines.append('</ol>')
+                in_ordered_list = False
+            processed_lines.append(line)
+            prev_was_list_item = False
+            continue
+
+        ordered_match = re.match(r'^\d+[.)\s]\s*(.+)$', stripped)
+        unordered_match = re.match(r'^[*\-]\s+(.+)$', stripped)
+
+        if ordered_match:
+            if not in_ordered_list:
+                if in_unordered_list:
+                    processed_lines.append('</ul>')
+                    in_unordered_list = False
+                processed_lines.append('<ol>')
+                in_ordered_list = True
+            processed_lines.append(f'<li>{ordered_match.group(1)}</li>')
+            prev_was_list_item = True
+        elif unordered_match:
+            if not in_unordered_list:
+                if in_ordered_list and not prev_was_list_item:
+                    processed_lines.append('</ol>')
+                    in_ordered_list = False
+                processed_lines.append('<ul>')
+                in_unordered_list = True
+            processed_lines.append(f'<li>{unordered_match.group(1)}</li>')
+            prev_was_list_item = True
+        else:
+            if in_unordered_list:
+                processed_lines.append('</ul>')
+                in_unordered_list = False
+            if in_ordered_list:
+                processed_lines.append('</ol>')
+                in_ordered_list = False
+            processed_lines.append(line)
+            prev_was_list_item = False
+
+    if in_unordered_list:
+        processed_lines.append('</ul>')
+    if in_ordered_list:
+        processed_lines.append('</ol>')
+
+    html = '\n'.join(processed_lines)
+
+    blocks = []
+    current_block = []
+
+    for line in html.split('\n'):
+        stripped = line.strip()
+        if re.match(r'^</?(?:ol|ul|h[1-4]|pre)', stripped):
+            if current_block:
+                block_text = ' '.join(current_block)
+                if block_text and not re.match(r'^<[^>]+>$', block_text):
+                    blocks.append(f'<p>{block_text}</p>')
+                current_block = []
+            blocks.append(line)
+        elif stripped:
+            current_block.append(stripped)
+
+    if current_block:
+        block_text = ' '.join(current_block)
+        if block_text and not re.match(r'^<[^>]+>$', block_text):
+            blocks.append(f'<p>{block_text}</p>')
+
+    html = ''.join(blocks)
+    html = bleach.clean(html, tags=allowed_tags, attributes=allowed_attrs, strip=False)
+
+    return html
+
+# (name, markdown, expected HTML, whether the previous renderer gave the same HTML)
+# The previous renderer differs where it was wrong: blank lines did not end paragraphs,
+# fenced code never matched, nested lists were broken, "2 items" started an ordered
+# list, single stars matched across spaces and inside code spans.
+GOLDEN_CASES = [
+    ('paragraph', 'Xin chào! Tôi có thể giúp gì cho bạn?', '<p>Xin chào! Tôi có thể giúp gì cho bạn?</p>', True),
+    ('joined_lines', 'TechShop offers a 30-day return policy\nfor unused products.', '<p>TechShop offers a 30-day return policy for unused products.</p>', True),
+    ('bold_italic', '**Warranty** covers *defects*, ***not*** accidental damage.', '<p><b>Warranty</b> covers <i>defects</i>, <b><i>not</i></b> accidental damage.</p>', True),
+    ('inline_code', 'Use promo code `SAVE10` at checkout.', '<p>Use promo code <code>SAVE10</code> at checkout.</p>', True),
+    ('headings', '# Returns\n## Policy\n### Steps\n#### Notes', '<h1>Returns</h1><h2>Policy</h2><h3>Steps</h3><h4>Notes</h4>', True),
+    ('unordered_list', 'Shipping options:\n- Standard: 3-5 days\n- Express: 1-2 days', '<p>Shipping options:</p><ul><li>Standard: 3-5 days</li><li>Express: 1-2 days</li></ul>', True),
+    ('ordered_list', '1. Add to cart\n2. Checkout\n3. Pay', '<ol><li>Add to cart</li><li>Checkout</li><li>Pay</li></ol>', True),
+    ('star_list', '* one\n* two', '<ul><li>one</li><li>two</li></ul>', True),
+    ('loose_list', '- a\n\n- b', '<ul><li>a</li><li>b</li></ul>', True),
+    ('heading_list', '## Steps\n1. Open app\n2. Login', '<h2>Steps</h2><ol><li>Open app</li><li>Login</li></ol>', True),
+    ('strip_tags', '<script>alert(1)</script>Hi <b>there</b>', '<p>alert(1)Hi there</p>', True),
+    ('escape', 'Price < $50 & free shipping', '<p>Price &lt; $50 &amp; free shipping</p>', True),
+    ('entity', 'Tom &amp; Jerry', '<p>Tom &amp; Jerry</p>', True),
+    ('answer', '**Theo techshop-faq.pdf**: Chính sách đổi trả\n\n* Sản phẩm chưa sử dụng\n* Còn nguyên hộp\n\nBạn còn thắc mắc gì khác không?', '<p><b>Theo techshop-faq.pdf</b>: Chính sách đổi trả</p><ul><li>Sản phẩm chưa sử dụng</li><li>Còn nguyên hộp</li></ul><p>Bạn còn thắc mắc gì khác không?</p>', True),
+    ('paragraph_break', 'First paragraph.\n\nSecond paragraph.', '<p>First paragraph.</p><p>Second paragraph.</p>', False),
+    ('fenced_code', "```python\nprint('<b>')\n```", '<pre><code class="language-python">print(\'&lt;b&gt;\')</code></pre>', False),
+    ('nested_list', '1. Step one\n   - detail\n2. Step two', '<ol><li>Step one<ul><li>detail</li></ul></li><li>Step two</li></ol>', False),
+    ('list_kind_change', '1. one\n- two', '<ol><li>one</li></ol><ul><li>two</li></ul>', False),
+    ('number_at_line_start', '2 items left in stock', '<p>2 items left in stock</p>', False),
+    ('spaced_stars', '2 * 3 * 4 = 24', '<p>2 * 3 * 4 = 24</p>', False),
+    ('stars_in_code', 'Run `a*b*c` now', '<p>Run <code>a*b*c</code> now</p>', False),
+    ('unclosed_fence', '```\nstill streaming', '<pre><code>still streaming</code></pre>', False),
+]
+
+# Typical streamed answer, rendered by the micro-benchmark
+SAMPLE_ANSWER = """## Chính sách đổi trả
+
+**Theo techshop-user-guide.pdf**, TechShop offers a 30-day return policy for defective or
+unsatisfactory products. Refunds are processed within *7-10 business days*.
+
+1. Ensure the product is unused and in its original packaging.
+2. Visit the **Returns** page and fill out the return request form:
+   - Order number, e.g. `TS-2025-0042`
+   - Reason of the return
+3. Ship the product back using the provided return label.
+
+```
+Return address: TechShop Returns, 123 Main St
+```
+
+Bạn còn thắc mắc gì khác không?"""
+
+def normalize(html: str) -> str:
+    """Drop what the previous renderer added without meaning: empty paragraphs, spaces between tags"""
+    return re.sub(r">\s+<", "><", html.replace("<p></p>", ""))
+
+def render_streamed(markdown: str, chunk_size: int) -> str:
+    renderer = MarkdownRenderer()
+    parts = [renderer.feed(markdown[start:start + chunk_size]) for start in range(0, len(markdown), chunk_size)]
+    return "".join(parts) + renderer.close()
+
+def check_golden() -> List[str]:
+    """Check every golden case, returns failures"""
+    failures = []
+    for name, markdown, expected, same_as_legacy in GOLDEN_CASES:
+        html = convert_markdown_to_html(markdown)
+        if html != expected:
+            failures.append(f"{name}: expected {expected!r}, got {html!r}")
+        if same_as_legacy and bleach is not None:
+            legacy = normalize(legacy_convert_markdown_to_html(markdown))
+            if legacy != normalize(html):
+                failures.append(f"{name}: previous renderer gave {legacy!r}, got {html!r}")
+        for chunk_size in (1, 3, 7):
+            streamed = render_streamed(markdown, chunk_size)
+            if streamed != html:
+                failures.append(f"{name}: streamed in chunks of {chunk_size} gave {streamed!r}, got {html!r}")
+    return failures
+
+def time_calls(fn: Callable[[], object], repeat: int) -> float:
+    """Mean microseconds of a call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def benchmark(repeat: int) -> Dict[str, float]:
+    texts = [markdown for _, markdown, _, _ in GOLDEN_CASES]
+    timings = {
+        "answer_us": time_calls(lambda: convert_markdown_to_html(SAMPLE_ANSWER), repeat),
+        "golden_us": time_calls(lambda: [convert_markdown_to_html(text) for text in texts], repeat // 10 or 1),
+        # Streamed 5 characters at a time, like tokens of generate_content_stream
+        "streamed_answer_us": time_calls(lambda: render_streamed(SAMPLE_ANSWER, 5), repeat),
+    }
+    if bleach is not None:
+        timings["legacy_answer_us"] = time_calls(lambda: legacy_convert_markdown_to_html(SAMPLE_ANSWER), repeat)
+        timings["legacy_golden_us"] = time_calls(lambda: [legacy_convert_markdown_to_html(text) for text in texts], repeat // 10 or 1)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the markdown renderer")
+    parser.add_argument("--repeat", type=int, default=500, help="Number of timed renders")
+    args = parser.parse_args()
+
+    failures = check_golden()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"{len(GOLDEN_CASES) - len({failure.split(':')[0] for failure in failures})}/{len(GOLDEN_CASES)} golden cases pass")
+    if bleach is None:
+        print("bleach is not installed, skipped the previous renderer")
+
+    timings = benchmark(args.repeat)
+    print(f"\n{'render':<28}{'previous us':>14}{'single-pass us':>16}{'speedup':>9}")
+    for label, legacy_key, key in (("sample answer", "legacy_answer_us", "answer_us"), ("golden cases", "legacy_golden_us", "golden_us")):
+        if legacy_key in timings:
+            print(f"{label:<28}{timings[legacy_key]:>14.1f}{timings[key]:>16.1f}{timings[legacy_key] / timings[key]:>8.1f}x")
+        else:
+            print(f"{label:<28}{'-':>14}{timings[key]:>16.1f}")
+    print(f"{'sample answer, streamed':<28}{'-':>14}{timings['streamed_answer_us']:>16.1f}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Mock of the Gemini REST API for load tests, with configurable latency and error rate
+
+Serves the calls the app makes through google-genai: generateContent,
+streamGenerateContent, batchEmbedContents and countTokens. Embeddings and answers
+come from the offline fake backend, so retrieval still works. Point the app at it
+with GEMINI_BASE_URL:
+
+    python benchmarks/mock_gemini_server.py --port 8081 --generate-latency-ms 800 --error-rate 0.02
+    GEMINI_BASE_URL=http://localhost:8081 GOOGLE_API_KEY=mock gunicorn --config gunicorn.conf.py app:app
+
+benchmarks/load_test.py starts it by itself.
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+from typing import Dict, List, Optional
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add root directory to sys.path, like app.py
+root_dir = str(Path(__file__).parent.parent.absolute())
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from fake_backend import FakeModels, _count_tokens, fake_embedding
+
+PATH_PATTERN = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):(?P<method>\w+)")
+ERRORS = {
+    429: ("RESOURCE_EXHAUSTED", "Resource has been exhausted (mock)"),
+    500: ("INTERNAL", "An internal error has occurred (mock)"),
+    503: ("UNAVAILABLE", "The model is overloaded (mock)"),
+}
+
+def _contents_text(contents: List[Dict]) -> str:
+    return "\n".join(part.get("text", "") for content in contents for part in content.get("parts", []))
+
+class MockGeminiServer:
+    """Threaded HTTP server answering like Gemini, run in a background thread"""
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        embed_latency: float = 0.0,
+        generate_latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+    ):
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.models = FakeModels()
+
+        # Requests and injected errors of each method
+        self.requests = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockGeminiServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = {}
+            self.errors = {}
+
+    def _latency(self, latency: float) -> float:
+        return max(latency * (1 + random.uniform(-self.jitter, self.jitter)), 0.0)
+
+    def _count(self, method: str, error: bool):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            if error:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                # One line per request would flood the load test output
+                pass
+
+            def _send_json(self, status: int, data: Dict):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                match = PATH_PATTERN.match(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if match is None:
+                    self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {self.path}", "status": "NOT_FOUND"}})
+                    return
+                model, method = match.group("model"), match.group("method")
+
+                # countTokens is not a model call, it is never failed
+                error = method != "countTokens" and random.random() < server.error_rate
+                server._count(method, error)
+                if error:
+                    time.sleep(server._latency(server.embed_latency))
+                    status, message = ERRORS.get(server.error_status, ERRORS[503])
+                    self._send_json(server.error_status, {"error": {"code": server.error_status, "message": message, "status": status}})
+                    return
+
+                if method == "batchEmbedContents":
+                    time.sleep(server._latency(server.embed_latency))
+                    self._send_json(200, {"embeddings": [
+                        {"values": fake_embedding(_contents_text([request["content"]]), request.get("outputDimensionality") or 768)}
+                        for request in body.get("requests", [])
+                    ]})
+                elif method == "countTokens":
+                    self._send_json(200, {"totalTokens": _count_tokens(_contents_text(body.get("contents", [])))})
+                elif method == "generateContent":
+                    time.sleep(server._latency(server.generate_latency))
+                    prompt = _contents_text(body.get("contents", []))
+                    self._send_json(200, self._response(model, server.models._answer(prompt), prompt))
+                elif method == "streamGenerateContent":
+                    self._stream(model, _contents_text(body.get("contents", [])))
+                else:
+                    self._send_json(404, {"error": {"code": 404, "message": f"Unknown method {method}", "status": "NOT_FOUND"}})
+
+            def _response(self, model: str, text: str, prompt: str, answer: Optional[str] = None) -> Dict:
+                answer = text if answer is None else answer
+                return {
+                    "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}],
+                    "usageMetadata": {
+                        "promptTokenCount": _count_tokens(prompt),
+                        "candidatesTokenCount": _count_tokens(answer),
+                        "totalTokenCount": _count_tokens(prompt) + _count_tokens(answer),
+                    },
+                    "modelVersion": model,
+                }
+
+            def _stream(self, model: str, prompt: str):
+                # Server-sent events, the connection is closed at the end of the stream
+                parts = server.models._stream_parts(prompt)
+                latency = server._latency(server.generate_latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for idx, part in enumerate(parts):
+                    # Latency of the whole answer is spread over its chunks
+                    time.sleep(latency / len(parts))
+                    data = self._response(model, part, prompt, "".join(parts[:idx + 1]))
+                    self.wfile.write(f"data: {json.dumps(data)}\r\n\r\n".encode("utf-8"))
+                    self.wfile.flush()
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock of the Gemini REST API for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0, help="Latency of embedding calls")
+    parser.add_argument("--generate-latency-ms", type=float, default=800.0, help="Latency of generation calls, spread over the chunks of streams")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latencies vary uniformly by this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of model calls failed with --error-status")
+    parser.add_argument("--error-status", type=int, choices=sorted(ERRORS), default=503)
+    args = parser.parse_args()
+
+    server = MockGeminiServer(
+        args.host, args.port, args.embed_latency_ms / 1000, args.generate_latency_ms / 1000,
+        args.jitter, args.error_rate, args.error_status,
+    )
+    print(f"Mock Gemini server on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
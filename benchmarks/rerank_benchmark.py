@@ -0,0 +1,111 @@
+"""Compare retrieval with and without reranking: answer quality versus prompt size versus latency
+
+Indexes the corpus once and searches the labelled queries with the first stage ranking
+alone, then with the candidate pool reranked by MMRReranker, for each prompt size and
+MMR trade-off:
+
+    python benchmarks/rerank_benchmark.py
+    python benchmarks/rerank_benchmark.py --top-k 2 3 5 --lambdas 1.0 0.7 0.5 --candidates 30
+
+Answer quality is measured on what reaches the prompt: recall and MRR of labelled chunks
+in the top-k, and recall of labelled text in the context built from them.
+"""
+import json
+import argparse
+import tempfile
+import numpy as np
+
+from typing import List, Dict, Optional
+from pathlib import Path
+
+from dotenv import load_dotenv
+from run_benchmark import StageTimer, create_chatbot, create_config, is_relevant, load_queries, parse_override, retrieval_query
+
+from src.metrics import start_trace
+from src.reranker import MMRReranker
+
+def benchmark_variant(chatbot, queries: List[Dict], top_k: int, reranker: Optional[MMRReranker]) -> Dict:
+    """Measure recall, MRR and context size of one way of ranking"""
+    chatbot.reranker = reranker
+    reciprocal_ranks = []
+    context_hits = []
+    context_tokens = []
+    rerank_ms = []
+    for query in queries:
+        trace = start_trace()
+        chunks = chatbot.search_relevant_chunks(retrieval_query(chatbot, query), top_k=top_k)
+        if "rerank" in trace.stages:
+            rerank_ms.append(trace.stages["rerank"] * 1000)
+
+        context = chatbot.context_builder.build(chunks)
+        context_tokens.append(context["tokens"])
+        rank = next((idx for idx, chunk in enumerate(chunks, 1) if is_relevant(chunk, query["relevant"])), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        context_hits.append(any(is_relevant(passage, query["relevant"]) for passage in context["passages"]))
+
+    return {
+        "top_k": top_k,
+        "recall": round(float(np.mean([rank > 0 for rank in reciprocal_ranks])), 4),
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "context_recall": round(float(np.mean(context_hits)), 4),
+        "mean_context_tokens": round(float(np.mean(context_tokens)), 1),
+        "rerank_p50_ms": round(float(np.percentile(rerank_ms, 50)), 3) if rerank_ms else None,
+        "rerank_p99_ms": round(float(np.percentile(rerank_ms, 99)), 3) if rerank_ms else None,
+    }
+
+def print_report(report: Dict):
+    print(f"\n{report['queries']} labelled queries, pool of {report['candidates']} candidates, budget {report['budget_ms']} ms")
+    print(f"\n{'ranking':<18}{'top k':>7}{'recall':>9}{'MRR':>9}{'ctx recall':>12}{'ctx tokens':>12}{'p50 ms':>9}{'p99 ms':>9}")
+    for variant in report["variants"]:
+        p50 = "-" if variant["rerank_p50_ms"] is None else f"{variant['rerank_p50_ms']:.3f}"
+        p99 = "-" if variant["rerank_p99_ms"] is None else f"{variant['rerank_p99_ms']:.3f}"
+        print(
+            f"{variant['ranking']:<18}{variant['top_k']:>7}{variant['recall']:>9.4f}{variant['mrr']:>9.4f}"
+            f"{variant['context_recall']:>12.4f}{variant['mean_context_tokens']:>12.1f}{p50:>9}{p99:>9}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare retrieval with and without reranking")
+    parser.add_argument("--queries", default=str(Path(__file__).parent / "queries.jsonl"), help="JSONL query file")
+    parser.add_argument("--backend", choices=["fake", "gemini"], default="fake", help="Backend embedding the corpus and queries")
+    parser.add_argument("--top-k", type=int, nargs="*", default=[3, 5], help="Numbers of chunks going to the prompt")
+    parser.add_argument("--lambdas", type=float, nargs="*", default=[1.0, 0.7], help="MMR trade-offs to compare")
+    parser.add_argument("--candidates", type=int, default=None, help="Candidate pool, defaults to RERANK_CANDIDATES")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a Config value")
+    parser.add_argument("--output", help="Write report as JSON to this file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    overrides = dict(parse_override(assignment) for assignment in args.set)
+    if args.candidates:
+        overrides["RERANK_CANDIDATES"] = args.candidates
+    queries = [query for query in load_queries(args.queries) if query["relevant"]]
+
+    with tempfile.TemporaryDirectory(prefix="techshop-benchmark-") as work_dir:
+        config = create_config(overrides, work_dir)
+        chatbot = create_chatbot(config, args.backend, StageTimer(), 0.0, 0.0)
+        chatbot.index_corpus()
+
+        report = {
+            "queries": len(queries),
+            "candidates": config.RERANK_CANDIDATES,
+            "budget_ms": config.RERANK_BUDGET_MS,
+            "variants": [],
+        }
+        for top_k in args.top_k:
+            print(f"Benchmarking top {top_k}...")
+            variant = benchmark_variant(chatbot, queries, top_k, None)
+            report["variants"].append(dict(variant, ranking="first stage"))
+            for mmr_lambda in args.lambdas:
+                reranker = MMRReranker(config.RERANK_WEIGHTS, mmr_lambda, config.RERANK_BUDGET_MS)
+                variant = benchmark_variant(chatbot, queries, top_k, reranker)
+                report["variants"].append(dict(variant, ranking=f"rerank λ={mmr_lambda}"))
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""Replay a query file against RAGChatbot and report latency, indexing throughput and retrieval quality
+
+Runs offline by default, with a deterministic fake Gemini backend and Qdrant in-process
+memory mode:
+
+    python benchmarks/run_benchmark.py
+    python benchmarks/run_benchmark.py --set TEXT_SPLITTER_CHUNK_SIZE=500 --set RETRIEVAL_MODE='"dense"'
+    python benchmarks/run_benchmark.py --set QUERY_REWRITE_MODE='"prompt"'
+    python benchmarks/run_benchmark.py --backend gemini --output report.json
+"""
+import os
+import re
+import sys
+import ast
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from typing import List, Dict, Optional
+from pathlib import Path
+
+# Add root directory to sys.path, like app.py
+root_dir = str(Path(__file__).parent.parent.absolute())
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from src.config import Config
+from src.metrics import start_trace
+from src.gemini_rag_model import RAGChatbot
+from src.utils import convert_markdown_to_html
+
+STAGES = ["query_rewrite", "embed", "search", "rerank", "prompt_build", "generate", "markdown", "total"]
+
+class StageTimer:
+    """Collect durations of pipeline stages, in milliseconds"""
+    def __init__(self):
+        self.durations = {}
+        self.current = {}
+
+    def add(self, stage: str, seconds: float):
+        self.current[stage] = self.current.get(stage, 0.0) + seconds * 1000
+
+    def start_query(self):
+        self.current = {}
+
+    def end_query(self) -> Dict[str, float]:
+        for stage, duration in self.current.items():
+            self.durations.setdefault(stage, []).append(duration)
+        return self.current
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for stage in STAGES:
+            durations = self.durations.get(stage)
+            if durations:
+                report[stage] = {
+                    "count": len(durations),
+                    "mean_ms": round(float(np.mean(durations)), 3),
+                    "p50_ms": round(float(np.percentile(durations, 50)), 3),
+                    "p90_ms": round(float(np.percentile(durations, 90)), 3),
+                    "p99_ms": round(float(np.percentile(durations, 99)), 3),
+                }
+        return report
+
+class TimedProxy:
+    """Proxy of a client which times calls of some methods as pipeline stages"""
+    def __init__(self, target, stages: Dict[str, str], timer: StageTimer):
+        self._target = target
+        self._stages = stages
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        stage = self._stages.get(name)
+        if stage is None or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._timer.add(stage, time.perf_counter() - start)
+        return timed
+
+class TimedGenaiClient:
+    """Gemini client whose embedding and generation calls are timed"""
+    def __init__(self, client, timer: StageTimer):
+        self.models = TimedProxy(client.models, {"embed_content": "embed", "generate_content": "generate"}, timer)
+
+def parse_override(assignment: str):
+    """Parse KEY=VALUE config override, value is a Python literal or a plain string"""
+    key, _, value = assignment.partition("=")
+    try:
+        return key.strip(), ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return key.strip(), value
+
+def create_config(overrides: Dict, work_dir: str):
+    """Create benchmark config, caches and local state are kept out of the way of the app"""
+    settings = {
+        "INDEX_ON_STARTUP": False,
+        "RESPONSE_CACHE_ENABLED": False,
+        "EMBEDDING_CACHE_BACKEND": "none",
+        "EMBEDDING_CACHE_PATH": os.path.join(work_dir, "embeddings.sqlite3"),
+        "INDEX_STATE_DIR": os.path.join(work_dir, "index"),
+        "LEXICAL_INDEX_DIR": os.path.join(work_dir, "lexical"),
+        "EXTRACTION_CACHE_DIR": os.path.join(work_dir, "extraction"),
+        # The benchmark measures the pipeline, not the quota of the API key
+        "GEMINI_RATE_LIMITS": {},
+    }
+    settings.update(overrides)
+    for key in settings:
+        if not hasattr(Config, key):
+            raise ValueError(f"Unknown config key: {key}")
+    return type("BenchmarkConfig", (Config,), settings)
+
+def load_queries(path: str) -> List[Dict]:
+    """Load query file, one JSON object per line
+
+    The question is read from "question", or "message" / "body" so request logs can be
+    replayed as they are. "relevant" lists {"filename", "text"} labels of chunks which
+    answer the question, queries without labels only count for latency. "history" lists
+    earlier {"role", "text"} messages of follow-up questions.
+    """
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            question = item.get("question") or item.get("message") or item.get("body")
+            if question:
+                queries.append({
+                    "question": question,
+                    "history": item.get("history", []),
+                    "relevant": item.get("relevant", []),
+                })
+    return queries
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def is_relevant(chunk: Dict, labels: List[Dict]) -> bool:
+    """Check if a retrieved chunk matches one of the labels"""
+    text = _normalize(chunk["text"])
+    return any(chunk["filename"] == label["filename"] and _normalize(label["text"]) in text for label in labels)
+
+def create_chatbot(config, backend: str, timer: StageTimer, embed_latency: float, generate_latency: float) -> RAGChatbot:
+    """Create chatbot with timed clients of the chosen backend"""
+    if backend == "fake":
+        from fake_backend import FakeGenaiClient
+        genai_client = FakeGenaiClient(embed_latency=embed_latency, generate_latency=generate_latency)
+        qdrant_client = QdrantClient(":memory:")
+    else:
+        from google import genai
+        genai_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+        qdrant_client = QdrantClient(url=os.getenv("QDRANT_URL"))
+
+    return RAGChatbot(
+        config=config,
+        genai_client=TimedGenaiClient(genai_client, timer),
+        qdrant_client=TimedProxy(qdrant_client, {"query_points": "search", "retrieve": "search"}, timer),
+    )
+
+def benchmark_indexing(chatbot: RAGChatbot, timer: StageTimer) -> Dict:
+    """Index the corpus and measure throughput"""
+    timer.start_query()
+    start = time.perf_counter()
+    chatbot.index_corpus()
+    seconds = time.perf_counter() - start
+    stages = timer.current
+    timer.current = {}
+
+    chunks = chatbot.qdrant_client.count(collection_name=chatbot.collection_name).count
+    return {
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(chunks / seconds, 2) if seconds > 0 else None,
+        "embed_ms": round(stages.get("embed", 0.0), 3),
+    }
+
+def retrieval_query(chatbot: RAGChatbot, query: Dict) -> str:
+    """Search query of a benchmark query, follow-up questions are rewritten like in the app"""
+    prompt = chatbot.build_conversation_prompt(query["question"], query["history"])
+    return chatbot.query_rewriter.rewrite(prompt, query["question"], query["history"])
+
+def benchmark_retrieval(chatbot: RAGChatbot, queries: List[Dict], top_k: int) -> Optional[Dict]:
+    """Measure recall@k and MRR of labelled queries, and separately of follow-up questions"""
+    labelled = [query for query in queries if query["relevant"]]
+    if not labelled:
+        return None
+
+    hits = 0
+    reciprocal_ranks = []
+    follow_up_ranks = []
+    misses = []
+    for query in labelled:
+        chunks = chatbot.search_relevant_chunks(retrieval_query(chatbot, query), top_k=top_k)
+        rank = next((idx for idx, chunk in enumerate(chunks, 1) if is_relevant(chunk, query["relevant"])), None)
+        if rank is None:
+            reciprocal_ranks.append(0.0)
+            misses.append(query["question"])
+        else:
+            hits += 1
+            reciprocal_ranks.append(1.0 / rank)
+        if query["history"]:
+            follow_up_ranks.append(reciprocal_ranks[-1])
+
+    return {
+        "queries": len(labelled),
+        "top_k": top_k,
+        f"recall@{top_k}": round(hits / len(labelled), 4),
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "follow_up_queries": len(follow_up_ranks),
+        f"follow_up_recall@{top_k}": round(float(np.mean([rank > 0 for rank in follow_up_ranks])), 4) if follow_up_ranks else None,
+        "follow_up_mrr": round(float(np.mean(follow_up_ranks)), 4) if follow_up_ranks else None,
+        "misses": misses,
+    }
+
+def benchmark_context(chatbot: RAGChatbot, queries: List[Dict], top_k: int) -> Dict:
+    """Measure tokens of generation contexts and tokens left out by the context builder, by cause"""
+    used = []
+    saved = []
+    dropped_chunks = []
+    dropped = []
+    passages = []
+    for query in queries:
+        chunks = chatbot.search_relevant_chunks(retrieval_query(chatbot, query), top_k=top_k)
+        context = chatbot.context_builder.build(chunks)
+        used.append(context["tokens"])
+        saved.append(context["saved_tokens"])
+        dropped_chunks.append(context["dropped_chunks"])
+        dropped.append(context["dropped_tokens"])
+        passages.append(len(context["passages"]))
+    return {
+        "mean_tokens": round(float(np.mean(used)), 1),
+        "mean_saved_tokens": round(float(np.mean(saved)), 1),
+        "mean_dropped_chunks": round(float(np.mean(dropped_chunks)), 2),
+        "mean_dropped_tokens": round(float(np.mean(dropped)), 1),
+        "mean_passages": round(float(np.mean(passages)), 2),
+    }
+
+def benchmark_latency(chatbot: RAGChatbot, queries: List[Dict], timer: StageTimer, repeat: int) -> Dict:
+    """Answer every query and measure latency of each stage"""
+    # Queries rewritten while measuring retrieval would be cache hits
+    chatbot.query_rewriter.clear_cache()
+    for _ in range(repeat):
+        for query in queries:
+            timer.start_query()
+            trace = start_trace()
+            prompt = chatbot.build_conversation_prompt(query["question"], query["history"])
+            start = time.perf_counter()
+            answer = chatbot.generate_response(prompt, question=query["question"], history=query["history"])
+            total = time.perf_counter() - start
+
+            # Rewrite calls go through generate_content, they are moved out of the generate stage
+            rewrite = trace.stages.get("query_rewrite", 0.0)
+            if rewrite:
+                timer.add("query_rewrite", rewrite)
+                timer.add("generate", -rewrite)
+            if "rerank" in trace.stages:
+                timer.add("rerank", trace.stages["rerank"])
+
+            start = time.perf_counter()
+            convert_markdown_to_html(answer)
+            timer.add("markdown", time.perf_counter() - start)
+
+            # Everything which is not a backend call: chunk formatting, fusion, prompt assembly
+            other = total * 1000 - sum(timer.current.get(stage, 0.0) for stage in ("query_rewrite", "embed", "search", "rerank", "generate"))
+            timer.add("prompt_build", max(other, 0.0) / 1000)
+            timer.add("total", total)
+            timer.end_query()
+    return timer.percentiles()
+
+def print_report(report: Dict):
+    """Print benchmark report as tables"""
+    indexing = report["indexing"]
+    print(f"\nIndexing: {indexing['chunks']} chunks in {indexing['seconds']}s ({indexing['chunks_per_second']} chunks/s)")
+
+    print(f"\n{'stage':<14}{'count':>7}{'mean ms':>11}{'p50 ms':>11}{'p90 ms':>11}{'p99 ms':>11}")
+    for stage, stats in report["latency"].items():
+        print(f"{stage:<14}{stats['count']:>7}{stats['mean_ms']:>11.3f}{stats['p50_ms']:>11.3f}{stats['p90_ms']:>11.3f}{stats['p99_ms']:>11.3f}")
+
+    retrieval = report["retrieval"]
+    if retrieval:
+        top_k = retrieval["top_k"]
+        print(f"\nRetrieval: recall@{top_k} {retrieval[f'recall@{top_k}']}, MRR {retrieval['mrr']} over {retrieval['queries']} labelled queries")
+        if retrieval["follow_up_queries"]:
+            print(f"Follow-ups: recall@{top_k} {retrieval[f'follow_up_recall@{top_k}']}, MRR {retrieval['follow_up_mrr']} over {retrieval['follow_up_queries']} queries")
+        for question in retrieval["misses"]:
+            print(f"  miss: {question}")
+
+    context = report["context"]
+    print(f"\nContext: {context['mean_tokens']} tokens in {context['mean_passages']} passages per query")
+    print(f"  {context['mean_saved_tokens']} tokens saved by deduplicating and merging chunks")
+    print(f"  {context['mean_dropped_chunks']} chunks ({context['mean_dropped_tokens']} tokens) dropped under CONTEXT_MIN_SCORE")
+
+    faq = report.get("faq")
+    if faq and faq["hits"]:
+        print(
+            f"FAQ answers: {faq['hits']} of {faq['hits'] + faq['misses']} questions (hit rate {faq['hit_rate']}), "
+            f"{faq['mean_faq_answer_ms']} ms instead of {faq['mean_generated_answer_ms']} ms"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TechShop RAG pipeline")
+    parser.add_argument("--queries", default=str(Path(__file__).parent / "queries.jsonl"), help="JSONL query file")
+    parser.add_argument("--backend", choices=["fake", "gemini"], default="fake", help="fake runs offline, gemini uses GOOGLE_API_KEY and QDRANT_URL")
+    parser.add_argument("--top-k", type=int, default=None, help="k of recall@k, defaults to TOP_K_SEARCH_RELEVANT_CHUNKS")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times the query file is replayed")
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="Latency of fake embedding calls")
+    parser.add_argument("--generate-latency-ms", type=float, default=0.0, help="Latency of fake generation calls")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a Config value")
+    parser.add_argument("--output", help="Write report as JSON to this file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    overrides = dict(parse_override(assignment) for assignment in args.set)
+    queries = load_queries(args.queries)
+
+    with tempfile.TemporaryDirectory(prefix="techshop-benchmark-") as work_dir:
+        config = create_config(overrides, work_dir)
+        timer = StageTimer()
+        chatbot = create_chatbot(config, args.backend, timer, args.embed_latency_ms / 1000, args.generate_latency_ms / 1000)
+
+        report = {
+            "backend": args.backend,
+            "overrides": overrides,
+            "indexing": benchmark_indexing(chatbot, timer),
+            "retrieval": benchmark_retrieval(chatbot, queries, args.top_k or config.TOP_K_SEARCH_RELEVANT_CHUNKS),
+            "context": benchmark_context(chatbot, queries, config.TOP_K_SEARCH_RELEVANT_CHUNKS),
+            "latency": benchmark_latency(chatbot, queries, timer, args.repeat),
+        }
+        # Questions answered from the FAQ index skip retrieval and generation
+        report["faq"] = chatbot.faq_index.stats() if chatbot.faq_index is not None else None
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
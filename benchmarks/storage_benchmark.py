@@ -0,0 +1,263 @@
+"""Compare storage profiles of the chunk collection: recall versus memory versus latency
+
+Indexes the corpus, optionally grows it with synthetic vectors to a target size, and
+searches the labelled queries with every profile of Config.STORAGE_PROFILES:
+
+    python benchmarks/storage_benchmark.py --scale 50000
+    python benchmarks/storage_benchmark.py --qdrant-url http://localhost:6333 --scale 50000
+
+Without --qdrant-url, quantization and rescoring are simulated with NumPy, because the
+in-process Qdrant mode ignores quantization. With --qdrant-url every profile is created
+on the server and searched for real. Memory is estimated from the profile. Recall of
+the tiered profile, which searches a prefix of the embeddings, depends on embeddings
+trained for it like gemini-embedding-001, run it with --backend gemini to measure it.
+"""
+import json
+import math
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from typing import List, Dict, Tuple
+from pathlib import Path
+
+from dotenv import load_dotenv
+from run_benchmark import StageTimer, create_chatbot, create_config, is_relevant, load_queries, parse_override
+
+from qdrant_client import QdrantClient, models
+from src.storage_profiles import (
+    create_collection, create_point_vector, create_query, create_search_params, estimate_memory, full_vector,
+)
+
+def load_corpus_vectors(chatbot) -> Tuple[np.ndarray, List[Dict]]:
+    """Get vectors and payloads of the indexed chunks"""
+    vectors = []
+    payloads = []
+    offset = None
+    while True:
+        records, offset = chatbot.qdrant_client.scroll(
+            collection_name=chatbot.collection_name,
+            limit=256,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        for record in records:
+            vectors.append(full_vector(record.vector))
+            payloads.append(record.payload)
+        if offset is None:
+            break
+    return np.array(vectors, dtype=np.float32), payloads
+
+def grow_vectors(vectors: np.ndarray, size: int, noise: float, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Add noisy copies of corpus vectors until there are size vectors, they stand for a bigger corpus
+
+    Returns the vectors and the index of the corpus vector each one was copied from.
+    """
+    sources = np.arange(len(vectors))
+    if size <= len(vectors):
+        return vectors, sources
+    rng = np.random.default_rng(seed)
+    copied = rng.integers(0, len(vectors), size - len(vectors))
+    synthetic = vectors[copied] + rng.normal(0.0, noise / np.sqrt(vectors.shape[1]), (len(copied), vectors.shape[1])).astype(np.float32)
+    return np.vstack([vectors, synthetic]), np.concatenate([sources, copied])
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the k highest scores, best first"""
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+class SimulatedSearch:
+    """Search normalized vectors like Qdrant with the quantization of a profile
+
+    Scalar quantization maps values clipped to the quantile range to 256 levels, binary
+    quantization keeps the sign of each dimension and scores by matching bits. Candidates
+    are oversampled and rescored with the original vectors when the profile rescores.
+    Tiered profiles search the normalized prefix of the vectors this way, then rescore
+    the prefetched candidates with the full vectors.
+    """
+    def __init__(self, vectors: np.ndarray, profile: Dict):
+        self.vectors = vectors
+        self.profile = profile
+        self.coarse_dim = profile.get("coarse_dim")
+        self.searched = normalize(vectors[:, :self.coarse_dim]) if self.coarse_dim else vectors
+        self.quantization = profile.get("quantization")
+        if self.quantization == "scalar":
+            quantile = profile.get("quantile", 0.99)
+            low, high = np.quantile(self.searched, [1 - quantile, quantile])
+            levels = np.round((np.clip(self.searched, low, high) - low) / (high - low) * 255)
+            self.approximate = (levels / 255 * (high - low) + low).astype(np.float32)
+        elif self.quantization == "binary":
+            self.approximate = np.where(self.searched > 0, 1.0, -1.0).astype(np.float32)
+
+    def _search_index(self, query: np.ndarray, k: int) -> np.ndarray:
+        """Search the indexed vectors, the prefixes of a tiered profile"""
+        if self.quantization is None:
+            return top_k(self.searched @ query, k)
+
+        approximate_query = np.where(query > 0, 1.0, -1.0).astype(np.float32) if self.quantization == "binary" else query
+        oversampling = self.profile.get("oversampling") or 1.0
+        candidates = top_k(self.approximate @ approximate_query, int(k * oversampling))
+        if self.profile.get("rescore", True):
+            candidates = candidates[np.argsort(-(self.searched[candidates] @ query))]
+        return candidates[:k]
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        if not self.coarse_dim:
+            return self._search_index(query, k)
+        limit = math.ceil(k * self.profile.get("prefetch_oversampling", 4.0))
+        candidates = self._search_index(normalize(query[:self.coarse_dim]), limit)
+        return candidates[np.argsort(-(self.vectors[candidates] @ query))][:k]
+
+class QdrantSearch:
+    """Search a collection created with a profile on a Qdrant server"""
+    def __init__(self, qdrant_client: QdrantClient, name: str, vectors: np.ndarray, payloads: List[Dict], profile: Dict):
+        self.qdrant_client = qdrant_client
+        self.collection_name = f"techshop_storage_benchmark_{name}"
+        self.profile = profile
+        self.search_params = create_search_params(profile)
+
+        if self.qdrant_client.collection_exists(self.collection_name):
+            self.qdrant_client.delete_collection(self.collection_name)
+        create_collection(self.qdrant_client, self.collection_name, vectors.shape[1], profile)
+        for start in range(0, len(vectors), 256):
+            self.qdrant_client.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    models.PointStruct(
+                        id=idx,
+                        vector=create_point_vector(vectors[idx].tolist(), profile.get("coarse_dim")),
+                        # Synthetic points get a payload of the size of a real chunk
+                        payload=payloads[idx] if idx < len(payloads) else {"text": "x" * 800, "filename": "synthetic"},
+                    )
+                    for idx in range(start, min(start + 256, len(vectors)))
+                ],
+                wait=True,
+            )
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        results = self.qdrant_client.query_points(
+            collection_name=self.collection_name,
+            **create_query(
+                query.tolist(),
+                k,
+                search_params=self.search_params,
+                coarse_dim=self.profile.get("coarse_dim"),
+                prefetch_oversampling=self.profile.get("prefetch_oversampling", 4.0),
+            ),
+        )
+        return np.array([point.id for point in results.points], dtype=np.int64)
+
+    def close(self):
+        self.qdrant_client.delete_collection(self.collection_name)
+
+def benchmark_profile(search, vectors: np.ndarray, sources: np.ndarray, payloads: List[Dict], queries: List[Dict], query_vectors: np.ndarray, k: int) -> Dict:
+    """Measure recall against exact search, recall of labelled chunks and search latency
+
+    A synthetic copy of a labelled chunk counts as that chunk.
+    """
+    overlaps = []
+    label_hits = []
+    latencies = []
+    for query, query_vector in zip(queries, query_vectors):
+        exact = set(top_k(vectors @ query_vector, k).tolist())
+
+        start = time.perf_counter()
+        found = search.search(query_vector, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        overlaps.append(len(exact & set(found.tolist())) / len(exact))
+        if query["relevant"]:
+            chunks = [
+                {"filename": payloads[sources[idx]]["filename"], "text": payloads[sources[idx]]["text"]}
+                for idx in found.tolist()
+            ]
+            label_hits.append(any(is_relevant(chunk, query["relevant"]) for chunk in chunks))
+
+    return {
+        f"recall@{k}_vs_exact": round(float(np.mean(overlaps)), 4),
+        f"label_recall@{k}": round(float(np.mean(label_hits)), 4) if label_hits else None,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+def print_report(report: Dict):
+    k = report["top_k"]
+    print(f"\n{report['points']} points of {report['dim']} dimensions, {report['queries']} queries, search: {report['search']}")
+    print(f"\n{'profile':<12}{'RAM MB':>10}{'disk MB':>10}{'recall vs exact':>17}{'label recall':>14}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in report["profiles"].items():
+        label_recall = stats[f"label_recall@{k}"]
+        print(
+            f"{name:<12}{stats['ram_bytes'] / 2**20:>10.1f}{stats['disk_bytes'] / 2**20:>10.1f}"
+            f"{stats[f'recall@{k}_vs_exact']:>17.4f}{'-' if label_recall is None else f'{label_recall:.4f}':>14}"
+            f"{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare storage profiles of the chunk collection")
+    parser.add_argument("--queries", default=str(Path(__file__).parent / "queries.jsonl"), help="JSONL query file")
+    parser.add_argument("--backend", choices=["fake", "gemini"], default="fake", help="Backend embedding the corpus and queries")
+    parser.add_argument("--qdrant-url", help="Search profiles on this Qdrant server instead of simulating them")
+    parser.add_argument("--profiles", nargs="*", help="Profiles to compare, defaults to all")
+    parser.add_argument("--scale", type=int, default=0, help="Grow the corpus to this many points with synthetic vectors")
+    parser.add_argument("--noise", type=float, default=1.0, help="Noise of synthetic vectors around corpus vectors")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top-k", type=int, default=None, help="k of recall@k, defaults to TOP_K_SEARCH_RELEVANT_CHUNKS")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a Config value")
+    parser.add_argument("--output", help="Write report as JSON to this file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    overrides = dict(parse_override(assignment) for assignment in args.set)
+    queries = load_queries(args.queries)
+
+    with tempfile.TemporaryDirectory(prefix="techshop-benchmark-") as work_dir:
+        config = create_config(overrides, work_dir)
+        chatbot = create_chatbot(config, args.backend, StageTimer(), 0.0, 0.0)
+        chatbot.index_corpus()
+        corpus_vectors, payloads = load_corpus_vectors(chatbot)
+        query_vectors = normalize(np.array([chatbot._get_embedding(query["question"]) for query in queries], dtype=np.float32))
+
+    vectors, sources = grow_vectors(corpus_vectors, args.scale, args.noise, args.seed)
+    vectors = normalize(vectors)
+    k = args.top_k or config.TOP_K_SEARCH_RELEVANT_CHUNKS
+    payload_bytes = int(np.mean([len(json.dumps(payload, ensure_ascii=False).encode("utf-8")) for payload in payloads]) * len(vectors))
+
+    report = {
+        "points": len(vectors),
+        "dim": vectors.shape[1],
+        "queries": len(queries),
+        "top_k": k,
+        "search": "qdrant" if args.qdrant_url else "simulated",
+        "profiles": {},
+    }
+    qdrant_client = QdrantClient(url=args.qdrant_url) if args.qdrant_url else None
+    for name in args.profiles or list(config.STORAGE_PROFILES):
+        profile = config.STORAGE_PROFILES[name]
+        print(f"Benchmarking storage profile {name}...")
+        if qdrant_client is not None:
+            search = QdrantSearch(qdrant_client, name, vectors, payloads, profile)
+        else:
+            search = SimulatedSearch(vectors, profile)
+        try:
+            stats = benchmark_profile(search, vectors, sources, payloads, queries, query_vectors, k)
+        finally:
+            if qdrant_client is not None:
+                search.close()
+        stats.update(estimate_memory(profile, len(vectors), vectors.shape[1], payload_bytes))
+        report["profiles"][name] = stats
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
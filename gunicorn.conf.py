@@ -0,0 +1,28 @@
+import os
+import shutil
+
+# Bind address
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Threaded workers, Gemini and Qdrant calls release the GIL while they wait on the
+# network, so each worker serves as many chats at once as it has threads
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+
+# Streamed responses keep the connection open during the whole generation
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+keepalive = 5
+
+# Prometheus metrics of all workers are aggregated through files in this folder,
+# it is set before workers import the app so prometheus_client starts in multiprocess mode
+prometheus_multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/techshop-prometheus")
+
+def on_starting(server):
+    # Files of a previous run would be counted again
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
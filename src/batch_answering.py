@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .search_filters import validate_filters
+
+# Fields holding the question of an item, items with a title and a body (like requests.jsonl) join both
+QUESTION_FIELDS = ["question", "message"]
+ID_FIELDS = ["id", "request_id"]
+
+def parse_item(line: str, line_number: int) -> Optional[Dict]:
+    """Parse a JSONL line into {"id", "question", "filters"}, None for blank lines
+
+    Items without id are numbered by their line, so a file can be resumed as long as
+    its lines do not move. Filters scope the search of the item, like
+    RAGChatbot.search_relevant_chunks.
+    """
+    if not line.strip():
+        return None
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        return {"id": f"line-{line_number}", "question": "", "error": f"Invalid JSON: {e}"}
+    if not isinstance(data, dict):
+        return {"id": f"line-{line_number}", "question": "", "error": "Item is not a JSON object"}
+
+    item_id = next((str(data[field]) for field in ID_FIELDS if data.get(field) is not None), f"line-{line_number}")
+    question = next((data[field] for field in QUESTION_FIELDS if data.get(field)), None)
+    if question is None:
+        question = "\n\n".join(str(data[field]) for field in ["title", "body"] if data.get(field))
+    question = str(question).strip()
+    if not question:
+        return {"id": item_id, "question": "", "error": "Item has no question"}
+    try:
+        filters = validate_filters(data.get("filters"))
+    except (ValueError, TypeError, AttributeError) as e:
+        return {"id": item_id, "question": question, "error": f"Invalid filters: {e}"}
+    return {"id": item_id, "question": question, "filters": filters}
+
+def read_items(lines: Iterable[str]) -> Iterator[Dict]:
+    """Parse items of a JSONL file of questions"""
+    for line_number, line in enumerate(lines, 1):
+        item = parse_item(line, line_number)
+        if item is not None:
+            yield item
+
+def read_completed_ids(lines: Iterable[str]) -> Set[str]:
+    """Ids of the items answered in a previous results file, failed items are answered again"""
+    completed = set()
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            # Last line of an interrupted run may be cut
+            continue
+        if isinstance(result, dict) and result.get("status") == "success":
+            completed.add(str(result.get("id")))
+    return completed
+
+class BatchAnswerer:
+    """Answer many standalone questions, e.g. nightly jobs over support tickets
+
+    Questions are embedded together and searched in one Qdrant request per batch, then
+    answered by a bounded number of concurrent generations. Retrieval of the next batch
+    overlaps with generations of the previous ones. Results are yielded as soon as they
+    are generated, so their order is not the order of the questions.
+    """
+    def __init__(self, chatbot, batch_size: int, max_concurrency: int):
+        self.chatbot = chatbot
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+
+    def _answer_item(self, item: Dict, embedding: Optional[List[float]], chunks: List[Dict], retrieve_ms: float, started_at: float) -> Dict:
+        start = time.perf_counter()
+        try:
+            if embedding is None:
+                raise Exception("Question could not be embedded")
+            # Items failing because Gemini is unavailable are answered again on resume, not with excerpts
+            answer = self.chatbot.answer_with_chunks(item["question"], chunks, embedding, retrieval_only=False)
+            status, error = "success", None
+        except Exception as e:
+            answer, status, error = None, "error", str(e)
+        end = time.perf_counter()
+        return {
+            "id": item["id"],
+            "question": item["question"],
+            "status": status,
+            "answer": answer,
+            "error": error,
+            "sources": [{"filename": chunk["filename"], "page": chunk.get("page")} for chunk in chunks],
+            "timings_ms": {
+                # Retrieval of the whole batch, embedding and search are shared by its questions
+                "retrieve": round(retrieve_ms, 3),
+                "generate": round((end - start) * 1000, 3),
+                "total": round((end - started_at) * 1000, 3),
+            },
+        }
+
+    def _failed_item(self, item: Dict, error: str) -> Dict:
+        return {
+            "id": item["id"],
+            "question": item["question"],
+            "status": "error",
+            "answer": None,
+            "error": error,
+            "sources": [],
+            "timings_ms": {"retrieve": 0.0, "generate": 0.0, "total": 0.0},
+        }
+
+    def _batches(self, items: Iterable[Dict], skip_ids: Set[str]) -> Iterator[List[Dict]]:
+        batch = []
+        for item in items:
+            if item["id"] in skip_ids:
+                continue
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def answer(self, items: Iterable[Dict], skip_ids: Optional[Set[str]] = None) -> Iterator[Dict]:
+        """Yield a result of each item whose id is not skipped, in completion order"""
+        skip_ids = skip_ids or set()
+        top_k = self.chatbot.config.TOP_K_SEARCH_RELEVANT_CHUNKS
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="batch-answer")
+        pending = set()
+        try:
+            for batch in self._batches(items, skip_ids):
+                invalid = [item for item in batch if "error" in item]
+                for item in invalid:
+                    yield self._failed_item(item, item["error"])
+                batch = [item for item in batch if "error" not in item]
+                if not batch:
+                    continue
+
+                started_at = time.perf_counter()
+                try:
+                    embeddings, chunks = self.chatbot.search_relevant_chunks_batch(
+                        [item["question"] for item in batch], top_k, [item["filters"] for item in batch]
+                    )
+                except Exception as e:
+                    print(f"Error searching batch of {len(batch)} questions: {e}")
+                    for item in batch:
+                        yield self._failed_item(item, f"Search failed: {e}")
+                    continue
+                retrieve_ms = (time.perf_counter() - started_at) * 1000
+
+                for item, embedding, item_chunks in zip(batch, embeddings, chunks):
+                    pending.add(executor.submit(self._answer_item, item, embedding, item_chunks, retrieve_ms, started_at))
+
+                # Search the next batch while this one is generated, unless too many generations are waiting
+                while len(pending) > self.max_concurrency + self.batch_size:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                done = {future for future in pending if future.done()}
+                pending -= done
+                for future in done:
+                    yield future.result()
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # Generations not started yet are dropped when the caller stops reading, e.g. a client disconnecting
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions, results are written as JSONL")
+    parser.add_argument("questions", help="JSONL file, one {\"id\", \"question\"} or {\"request_id\", \"title\", \"body\"} per line")
+    parser.add_argument("--output", required=True, help="JSONL file of results")
+    parser.add_argument("--resume", action="store_true", help="Skip questions answered in the output file, append to it")
+    parser.add_argument("--batch-size", type=int, default=None, help="Questions searched together, defaults to BATCH_SIZE")
+    parser.add_argument("--concurrency", type=int, default=None, help="Concurrent generations, defaults to BATCH_MAX_CONCURRENCY")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from .config import Config
+    from .gemini_rag_model import RAGChatbot
+
+    skip_ids = set()
+    if args.resume and os.path.exists(args.output):
+        with open(args.output, "r", encoding="utf-8") as f:
+            skip_ids = read_completed_ids(f)
+        print(f"Resuming, {len(skip_ids)} questions already answered")
+
+    answerer = BatchAnswerer(
+        RAGChatbot(config=Config),
+        batch_size=args.batch_size or Config.BATCH_SIZE,
+        max_concurrency=args.concurrency or Config.BATCH_MAX_CONCURRENCY,
+    )
+    counts = {"success": 0, "error": 0}
+    start = time.perf_counter()
+    with open(args.questions, "r", encoding="utf-8") as questions, \
+            open(args.output, "a" if args.resume else "w", encoding="utf-8") as output:
+        for result in answerer.answer(read_items(questions), skip_ids):
+            # One line per result, flushed so an interrupted run can be resumed
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            counts[result["status"]] += 1
+            answered = counts["success"] + counts["error"]
+            if answered % 50 == 0:
+                print(f"Answered {answered} questions ({answered / (time.perf_counter() - start):.1f} questions/s)")
+
+    print(f"Answered {counts['success']} questions, {counts['error']} failed, in {time.perf_counter() - start:.1f}s")
+    return counts["error"] == 0
+
+if __name__ == "__main__":
+    # Answer questions from command line: python -m src.batch_answering questions.jsonl --output results.jsonl
+    sys.exit(0 if main() else 1)
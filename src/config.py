@@ -13,17 +13,312 @@ class Config:
     EMBEDDING_MODEL_NAME = "gemini-embedding-001"
     QDRANT_COLLECTION_NAME = "techshop_docs"
 
+    # Assistant of the brand, each tenant sets its own
+    BRAND_NAME = "TechShop"
+    # System instruction of generation
+    SYSTEM_PROMPT = """
+            Bạn là trợ lý ảo của TechShop, một nền tảng thương mại điện tử.
+
+            NHIỆM VỤ CHÍNH:
+            - Trả lời câu hỏi của khách hàng DỰA TRÊN các tài liệu hướng dẫn, FAQ và troubleshooting được cung cấp trong Context
+            - Ưu tiên thông tin từ Context, KHÔNG sử dụng kiến thức chung
+            - Nếu Context không có thông tin liên quan, hãy trả lời: "Xin lỗi, tôi không tìm thấy thông tin này. Vui lòng liên hệ support@techshop.com"
+
+            PHONG CÁCH:
+            - Thân thiện, chuyên nghiệp
+            - Câu trả lời ngắn gọn, rõ ràng (2-3 đoạn văn)
+            - Sử dụng bullet points khi liệt kê nhiều mục
+            - Luôn kết thúc với câu hỏi "Bạn còn thắc mắc gì khác không?"
+
+            QUY TẮC QUAN TRỌNG:
+            - CHỈ trả lời dựa trên thông tin trong Context
+            - KHÔNG bịa đặt hoặc suy đoán thông tin
+            - Nếu không chắc chắn, hãy thừa nhận và đề nghị liên hệ support
+        """
+    # Answer when no relevant chunk is found
+    NO_RELEVANT_CHUNKS_ANSWER = "Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau hoặc liên hệ support@techshop.com"
+
     # Text splitter configuration
     TEXT_SPLITTER_CHUNK_SIZE = 800
     TEXT_SPLITTER_CHUNK_OVERLAP = 200
 
+    # PDF extraction configuration
+    # Number of processes extracting pages of PDF files, 1 extracts in the indexing process
+    PDF_EXTRACTION_WORKERS = 4
+    # Number of pages extracted by one task of the process pool
+    PDF_EXTRACTION_PAGES_PER_TASK = 8
+    # Starting worker processes takes seconds, smaller corpora are extracted in the indexing process
+    PDF_EXTRACTION_MIN_PARALLEL_PAGES = 64
+    # A text block is a heading when its font is this much larger than the body font of its page
+    PDF_HEADING_SIZE_RATIO = 1.15
+    # Folder of extracted pages, keyed by file hash so unchanged PDFs are never parsed again
+    EXTRACTION_CACHE_DIR = str(root_path / ".cache" / "extraction")
+
     # Embedding model configuration
     # Gemini text-embedding-004 uses 769 dimension embedding
     EMBEDDING_DIM = 768
 
+    # Embedding pipeline configuration
+    # Number of chunks sent in one embed_content request
+    EMBEDDING_BATCH_SIZE = 100
+    # Number of embed_content requests in flight at the same time
+    EMBEDDING_MAX_WORKERS = 4
+
+    # Gemini quota configuration
+    # Requests and tokens per minute of each model, shared by all workers through Redis when REDIS_URL is set
+    # Defaults are the free tier limits, models which are not listed are not throttled
+    GEMINI_RATE_LIMITS = {
+        "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000},
+        "gemini-2.0-flash-lite": {"rpm": 30, "tpm": 1000000},
+        "gemini-embedding-001": {"rpm": 100, "tpm": 30000},
+        # Token counting has its own quota, whatever the model counted for
+        "count_tokens": {"rpm": 3000},
+    }
+    # Seconds a call may wait for quota of its model before it falls back
+    GEMINI_QUOTA_MAX_WAIT = 5.0
+    # Retries of transient errors (429, 5xx, timeouts) with jittered exponential backoff
+    GEMINI_MAX_RETRIES = 3
+    GEMINI_RETRY_BASE_DELAY = 0.5
+    GEMINI_RETRY_MAX_DELAY = 8.0
+    # Seconds a call may take with its quota waits, retries and fallback model
+    GEMINI_REQUEST_DEADLINE = 30.0
+    # Seconds a background call (embeddings of indexing) may take, it waits for quota without GEMINI_QUOTA_MAX_WAIT
+    GEMINI_BACKGROUND_DEADLINE = 900.0
+    # Cheaper model answering when a model is out of quota or failing
+    GEMINI_FALLBACK_MODELS = {"gemini-2.5-flash-lite": "gemini-2.0-flash-lite"}
+    # Answer with excerpts of the best passages when no model can answer
+    GEMINI_RETRIEVAL_ONLY_FALLBACK = True
+    GEMINI_RETRIEVAL_ONLY_PASSAGES = 2
+    GEMINI_RETRIEVAL_ONLY_EXCERPT_CHARS = 400
+
+    # Embedding cache configuration
+    # Backend of the cache: "sqlite", "redis" (shared through REDIS_URL) or "none"
+    EMBEDDING_CACHE_BACKEND = "sqlite"
+    EMBEDDING_CACHE_PATH = str(root_path / ".cache" / "embeddings.sqlite3")
+    # Maximum number of embeddings in SQLite cache, least recently used ones are evicted
+    EMBEDDING_CACHE_MAX_ENTRIES = 100000
+    # Expiration of embeddings in Redis cache (seconds)
+    EMBEDDING_CACHE_TTL = 30 * 24 * 3600
+
+    # Number of points uploaded to Qdrant in one upsert
+    QDRANT_UPSERT_BATCH_SIZE = 100
+
+    # Payload indexes of the chunk collection, they serve filtered searches: {field: schema type}
+    PAYLOAD_INDEXES = {
+        "filename": "keyword",
+        "doc_type": "keyword",
+        "language": "keyword",
+        "page": "integer",
+        "page_end": "integer",
+    }
+
+    # Storage profile of the chunk collection, changing it rebuilds the collection without re-embedding
+    # Compare recall, memory and latency of the profiles with benchmarks/storage_benchmark.py
+    STORAGE_PROFILE = "memory"
+    STORAGE_PROFILES = {
+        # Float32 vectors, HNSW graph and payloads in RAM, best latency and recall
+        "memory": {
+            "quantization": None,
+            "vectors_on_disk": False,
+            "payload_on_disk": False,
+            "hnsw_m": 16,
+            "hnsw_ef_construct": 100,
+            "hnsw_ef": None,
+            "payload_indexes": PAYLOAD_INDEXES,
+        },
+        # int8 scalar quantized vectors in RAM (4x smaller), original vectors and payloads on disk,
+        # candidates are oversampled and rescored with original vectors
+        "balanced": {
+            "quantization": "scalar",
+            "quantile": 0.99,
+            "oversampling": 2.0,
+            "rescore": True,
+            "vectors_on_disk": True,
+            "payload_on_disk": True,
+            "hnsw_m": 16,
+            "hnsw_ef_construct": 100,
+            "hnsw_ef": None,
+            "payload_indexes": PAYLOAD_INDEXES,
+        },
+        # 1-bit binary quantized vectors in RAM (32x smaller), everything else on disk,
+        # binary quantization loses more recall on 768 dimensions, so it oversamples more
+        "compact": {
+            "quantization": "binary",
+            "oversampling": 4.0,
+            "rescore": True,
+            "vectors_on_disk": True,
+            "payload_on_disk": True,
+            "hnsw_on_disk": True,
+            "hnsw_m": 12,
+            "hnsw_ef_construct": 100,
+            "hnsw_ef": 128,
+            "payload_indexes": PAYLOAD_INDEXES,
+        },
+        # Matryoshka tiers: the first 128 dimensions of each embedding, int8 quantized in RAM,
+        # select candidates, which are rescored with the full vectors read from disk.
+        # Both come from one embedding, switching to it copies the collection without re-embedding
+        "tiered": {
+            "coarse_dim": 128,
+            "prefetch_oversampling": 8.0,
+            "quantization": "scalar",
+            "quantile": 0.99,
+            "rescore": False,
+            "vectors_on_disk": True,
+            "payload_on_disk": True,
+            "hnsw_m": 16,
+            "hnsw_ef_construct": 100,
+            "hnsw_ef": None,
+            "payload_indexes": PAYLOAD_INDEXES,
+        },
+    }
+
+    # Semantic response cache configuration
+    # Reuse the answer of a cached question when cosine similarity is above threshold
+    # and the same chunks are retrieved, entries expire after TTL (seconds)
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_COLLECTION_NAME = "techshop_response_cache"
+    RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.95
+    RESPONSE_CACHE_TTL = 24 * 3600
+
+    # FAQ answer index
+    # Question and answer pairs of FAQ documents are indexed by question, a question whose cosine
+    # similarity to one of them is above threshold gets its answer without retrieval and generation
+    FAQ_INDEX_ENABLED = True
+    # Document types (see DOCUMENT_TYPES) holding question and answer pairs
+    FAQ_DOCUMENT_TYPES = ["faq"]
+    FAQ_SIMILARITY_THRESHOLD = 0.92
+    # Answer of a matching entry, from its "answer", "question", "filename" and "page"
+    FAQ_ANSWER_TEMPLATE = "{answer}\n\n*Nguồn: {filename}, trang {page}*\n\nBạn còn thắc mắc gì khác không?"
+
+    # Conversation store configuration
+    # Chat history is kept in Redis when REDIS_URL is set, otherwise in SQLite, the session cookie only holds its id
+    CONVERSATION_STORE_PATH = str(root_path / ".cache" / "conversations.sqlite3")
+    # Number of messages kept per conversation and shown on the chat page
+    CONVERSATION_MAX_MESSAGES = 50
+    # Expiration of conversations without activity (seconds)
+    CONVERSATION_TTL = 7 * 24 * 3600
+    # Number of previous messages sent in the prompt, older ones are covered by the rolling summary
+    CONVERSATION_PROMPT_MESSAGES = 4
+    # Older messages are folded into the summary once this many are waiting, in a background thread
+    CONVERSATION_SUMMARY_BATCH = 6
+    CONVERSATION_SUMMARY_MAX_TOKENS = 256
+
+    # Request coalescing configuration
+    # Concurrent identical questions and embeddings share one upstream call, across workers when REDIS_URL is set
+    SINGLE_FLIGHT_ENABLED = True
+    # Expiration of the lock of a call (seconds), longer calls may be made again by another worker
+    SINGLE_FLIGHT_LOCK_TTL = 60
+    # Seconds a request waits for events of the call it shares
+    SINGLE_FLIGHT_WAIT_TIMEOUT = 60
+    # Seconds events of a finished call stay readable by workers still reading them
+    SINGLE_FLIGHT_RESULT_TTL = 30
+
+    # Indexing configuration
+    # Index corpus in a background thread when the app starts, only one process indexes at a time
+    INDEX_ON_STARTUP = True
+    # Expiration of the indexing lock (seconds), refreshed every third of it while indexing runs
+    INDEX_LOCK_TTL = 300
+    # Folder of indexing lock and status files, used when REDIS_URL is not set
+    INDEX_STATE_DIR = str(root_path / ".cache" / "index")
+    # Seconds between checks of the corpus version served by the collection alias
+    INDEX_STATE_REFRESH_INTERVAL = 30
+
     # Corpus path
     CORPUS_PATH = str(root_path / "corpus")
 
     # Top K search relevant chunks
     TOP_K_SEARCH_RELEVANT_CHUNKS = 5
-    
\ No newline at end of file
+
+    # Retrieval configuration
+    # "dense" only searches vectors, "hybrid" fuses vector and BM25 results with reciprocal rank fusion
+    RETRIEVAL_MODE = "hybrid"
+    # Number of candidates taken from each retriever before fusion
+    HYBRID_CANDIDATES = 20
+    RRF_K = 60
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    # Folder of BM25 indexes, one per collection version, loaded memory-mapped by every worker
+    LEXICAL_INDEX_DIR = str(root_path / ".cache" / "lexical")
+
+    # Document types stored with chunks for filtered searches, the first pattern found in a file name gives its type
+    DOCUMENT_TYPES = {"faq": "faq", "troubleshooting": "troubleshooting", "user-guide": "user_guide"}
+    DEFAULT_DOCUMENT_TYPE = "other"
+
+    # Query routing configuration
+    # Questions containing a phrase of a route search documents of its types first, the first matching route wins,
+    # other questions search every document. Phrases are matched as whole words without case and diacritics.
+    # A routed search whose best cosine score is under QUERY_ROUTER_MIN_SCORE is run again in every document.
+    # Disabled until routes are evaluated on the golden set
+    QUERY_ROUTER_ENABLED = False
+    QUERY_ROUTER_MIN_SCORE = 0.6
+    QUERY_ROUTES = [
+        # Documents named in the question
+        {"doc_types": ["faq"], "phrases": ["faq", "frequently asked"]},
+        {"doc_types": ["user_guide"], "phrases": ["user guide", "huong dan su dung"]},
+        {"doc_types": ["troubleshooting"], "phrases": ["troubleshooting", "troubleshoot"]},
+        # Problem reports are answered by the troubleshooting guide, only wording of errors, since
+        # plain negations ("is not", "cannot") are just as common in how-to questions
+        {"doc_types": ["troubleshooting"], "phrases": [
+            "error", "failed", "fails", "declined", "not working", "not found", "not recognized", "not updating",
+            "not loading", "forgot password", "bao loi", "bi loi", "gap loi", "ma loi", "bi tu choi",
+            "khong hoat dong", "quen mat khau",
+        ]},
+    ]
+
+    # Reranking configuration
+    # Rerank a larger pool of retrieved chunks on CPU before the best TOP_K_SEARCH_RELEVANT_CHUNKS go to the prompt
+    RERANK_ENABLED = False
+    RERANK_CANDIDATES = 30
+    # Weights of the relevance features: cosine similarity, share of query terms in the chunk,
+    # first stage (fused) score, closeness to relevant chunks of the same file
+    RERANK_WEIGHTS = {"dense": 0.5, "lexical": 0.3, "first_stage": 0.2, "proximity": 0.1}
+    # Maximal marginal relevance trade-off, 1.0 ranks by relevance only, lower values favour diverse chunks
+    RERANK_MMR_LAMBDA = 0.7
+    # Latency budget of reranking (milliseconds), remaining chunks are ranked by relevance when it is used up
+    RERANK_BUDGET_MS = 10.0
+
+    # Query rewriting configuration
+    # "heuristic" prefixes follow-up questions with previous user messages, "llm" rewrites them with
+    # QUERY_REWRITE_MODEL, "prompt" searches with the whole prompt including chat history
+    QUERY_REWRITE_MODE = "heuristic"
+    QUERY_REWRITE_MODEL = "gemini-2.5-flash-lite"
+    QUERY_REWRITE_MAX_TOKENS = 64
+    # Number of previous user messages added to follow-up questions by the heuristic
+    QUERY_REWRITE_HISTORY_TURNS = 1
+    # Questions of at most this many words asked after other messages are treated as follow-ups
+    QUERY_REWRITE_SHORT_QUERY_TERMS = 4
+    # Number of rewritten queries cached in each process
+    QUERY_REWRITE_CACHE_SIZE = 1024
+
+    # Context builder configuration
+    # Token budget of the retrieved passages in the generation prompt
+    CONTEXT_MAX_TOKENS = 1500
+    # Chunks with a vector (cosine) score under this floor are left out, the best chunk is always kept.
+    # 0.0 only drops chunks pointing away from the query. Raise it only after calibrating it on scores
+    # of real Gemini embeddings, the offline fake embeddings score far lower
+    CONTEXT_MIN_SCORE = 0.0
+    # "estimate" uses characters per token, "gemini" counts tokens of new chunks with the Gemini
+    # token counter at indexing, one count_tokens request per chunk
+    CONTEXT_TOKEN_COUNTER = "estimate"
+    CONTEXT_CHARS_PER_TOKEN = 4.0
+    
+    # Batch answering configuration (/batch endpoint and python -m src.batch_answering)
+    # Questions embedded together and searched in one Qdrant request
+    BATCH_SIZE = 32
+    # Generations in flight at the same time, Gemini calls are still throttled by GEMINI_RATE_LIMITS
+    BATCH_MAX_CONCURRENCY = 4
+    # Questions accepted by one /batch request
+    BATCH_MAX_ITEMS = 5000
+
+    # Multi-tenant configuration
+    # Tenant served when a request names no other tenant, it uses this Config as it is
+    DEFAULT_TENANT = "techshop"
+    # Other brands served by the same app: {tenant id: {"hosts": [host names], "config": {Config key: value}}}, e.g.
+    # {"gadgetco": {"hosts": ["help.gadgetco.com"], "config": {"BRAND_NAME": "GadgetCo", "CORPUS_PATH": "/data/gadgetco",
+    #   "SYSTEM_PROMPT": "...", "NO_RELEVANT_CHUNKS_ANSWER": "...", "MODEL_NAME": "gemini-2.5-flash"}}}
+    # Tenants are selected by the Host header, or by the /t/<tenant id>/ path prefix
+    TENANTS = {}
+    # JSON file of more tenants in the same format, read at startup when it exists
+    TENANTS_FILE = str(root_path / "tenants.json")
+    # Tenants whose chatbot stays in memory, the least recently used one is unloaded beyond it
+    TENANT_MAX_LOADED = 8
@@ -0,0 +1,142 @@
+import re
+
+from typing import List, Dict
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def merge_overlapping(first: str, second: str, max_overlap: int) -> str:
+    """Join two consecutive chunks, the end of first repeated at the start of second is kept once"""
+    for size in range(min(len(first), len(second), max_overlap), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    # The splitter strips whitespace at chunk borders, the overlap may start after it
+    stripped = second.lstrip()
+    for size in range(min(len(first), len(stripped), max_overlap), 0, -1):
+        if first.endswith(stripped[:size]):
+            return first + stripped[size:]
+    return first + "\n" + second
+
+class ContextBuilder:
+    """Build the generation context from retrieved chunks within a token budget
+
+    Chunks under the score floor are dropped, duplicates are removed and consecutive
+    chunks of a file are merged into one passage without their overlap. Passages are
+    packed best first until the budget is used, the best one is always kept.
+    """
+    def __init__(self, max_tokens: int, min_score: float, max_overlap: int, chars_per_token: float):
+        self.max_tokens = max_tokens
+        self.min_score = min_score
+        self.max_overlap = max_overlap
+        self.chars_per_token = chars_per_token
+
+    def estimate_tokens(self, text: str) -> int:
+        """Estimate tokens of a text which was not counted by Gemini"""
+        return max(1, int(len(text) / self.chars_per_token))
+
+    def chunk_tokens(self, chunk: Dict) -> int:
+        """Tokens of a chunk, counted by Gemini at indexing when available"""
+        return chunk.get("token_count") or self.estimate_tokens(chunk["text"])
+
+    def _passes_floor(self, chunk: Dict) -> bool:
+        # Chunks found only by lexical search have no vector score, they matched query terms
+        score = chunk.get("vector_score")
+        return score is None or score >= self.min_score
+
+    def _deduplicate(self, chunks: List[Dict]) -> List[Dict]:
+        """Drop chunks whose text is already contained in a better chunk"""
+        kept = []
+        normalized = []
+        for chunk in chunks:
+            text = _normalize(chunk["text"])
+            if any(text in other for other in normalized):
+                continue
+            kept.append(chunk)
+            normalized.append(text)
+        return kept
+
+    def _merge_adjacent(self, chunks: List[Dict]) -> List[Dict]:
+        """Merge consecutive chunks of the same file into passages, ranked by their best chunk"""
+        by_position = sorted(
+            enumerate(chunks), key=lambda item: (item[1]["filename"], item[1].get("chunk_index", 0))
+        )
+        passages = []
+        for rank, chunk in by_position:
+            previous = passages[-1] if passages else None
+            if (
+                previous is not None
+                and previous["filename"] == chunk["filename"]
+                and chunk.get("chunk_index") is not None
+                and previous["last_chunk_index"] + 1 == chunk["chunk_index"]
+            ):
+                previous["text"] = merge_overlapping(previous["text"], chunk["text"], self.max_overlap)
+                previous["chunks"].append(chunk)
+                previous["rank"] = min(previous["rank"], rank)
+                previous["last_chunk_index"] = chunk["chunk_index"]
+                previous["page_end"] = chunk.get("page_end") or chunk.get("page")
+                continue
+            passages.append({
+                "filename": chunk["filename"],
+                "text": chunk["text"],
+                "chunks": [chunk],
+                "rank": rank,
+                "last_chunk_index": chunk.get("chunk_index", -2),
+                "page": chunk.get("page"),
+                "page_end": chunk.get("page_end") or chunk.get("page"),
+                "section": chunk.get("section"),
+            })
+
+        for passage in passages:
+            # Counted tokens of the chunks, minus the share of the removed overlap
+            counted = sum(self.chunk_tokens(chunk) for chunk in passage["chunks"])
+            total_length = sum(len(chunk["text"]) for chunk in passage["chunks"])
+            passage["tokens"] = max(1, round(counted * len(passage["text"]) / max(total_length, 1)))
+        return sorted(passages, key=lambda passage: passage["rank"])
+
+    def _truncate(self, passage: Dict, max_tokens: int) -> Dict:
+        """Cut a passage which alone exceeds the budget"""
+        length = int(len(passage["text"]) * max_tokens / passage["tokens"])
+        return dict(passage, text=passage["text"][:length], tokens=max_tokens)
+
+    def build(self, chunks: List[Dict]) -> Dict:
+        """Build context of ranked chunks
+
+        Returns the context text, its passages and the tokens used. Tokens left out are
+        reported by cause: "saved_tokens" by deduplicating and merging chunks,
+        "dropped_chunks" and "dropped_tokens" under the score floor, "over_budget_tokens"
+        of passages which did not fit the budget.
+        """
+        if not chunks:
+            return {
+                "context": "", "passages": [], "tokens": 0,
+                "saved_tokens": 0, "dropped_chunks": 0, "dropped_tokens": 0, "over_budget_tokens": 0,
+            }
+
+        selected = [chunk for idx, chunk in enumerate(chunks) if idx == 0 or self._passes_floor(chunk)]
+        dropped_tokens = sum(self.chunk_tokens(chunk) for chunk in chunks) - sum(self.chunk_tokens(chunk) for chunk in selected)
+        passages = self._merge_adjacent(self._deduplicate(selected))
+        passage_tokens = sum(passage["tokens"] for passage in passages)
+
+        packed = []
+        used_tokens = 0
+        for passage in passages:
+            if used_tokens + passage["tokens"] <= self.max_tokens:
+                packed.append(passage)
+                used_tokens += passage["tokens"]
+            elif not packed:
+                packed.append(self._truncate(passage, self.max_tokens))
+                used_tokens = self.max_tokens
+
+        context = "\n\n---\n\n".join(
+            f"[Document {idx} - {passage['filename']}]\n{passage['text']}"
+            for idx, passage in enumerate(packed, 1)
+        )
+        return {
+            "context": context,
+            "passages": packed,
+            "tokens": used_tokens,
+            "saved_tokens": max(sum(self.chunk_tokens(chunk) for chunk in selected) - passage_tokens, 0),
+            "dropped_chunks": len(chunks) - len(selected),
+            "dropped_tokens": dropped_tokens,
+            "over_budget_tokens": max(passage_tokens - used_tokens, 0),
+        }
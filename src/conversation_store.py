@@ -0,0 +1,212 @@
+import os
+import abc
+import json
+import time
+import redis
+import sqlite3
+import secrets
+import threading
+
+from typing import List, Dict, Optional
+
+# Numbers the message with the incremented message count of the conversation, pushes it to the
+# capped message list and renews expiration of both keys, in one step so appends never interleave
+_APPEND_SCRIPT = """
+local total = redis.call('HINCRBY', KEYS[1], 'total', 1)
+local message = cjson.decode(ARGV[1])
+message['seq'] = total - 1
+redis.call('RPUSH', KEYS[2], cjson.encode(message))
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return total
+"""
+
+class ConversationStore(abc.ABC):
+    """Chat history kept server side, keyed by the conversation id stored in the session cookie
+
+    Messages are {"seq", "role", "text", "html"}, the HTML is rendered once when the
+    message is stored. Only the last max_messages are kept, older ones live on in the
+    rolling summary of the conversation.
+    """
+    backend = "none"
+
+    def __init__(self, max_messages: int, ttl: int):
+        self.max_messages = max_messages
+        self.ttl = ttl
+
+    @staticmethod
+    def new_id() -> str:
+        """Create id of a new conversation"""
+        return secrets.token_urlsafe(16)
+
+    @abc.abstractmethod
+    def append(self, conversation_id: str, role: str, text: str, html: str) -> int:
+        """Store a message, returns the number of messages of the conversation"""
+
+    @abc.abstractmethod
+    def get_messages(self, conversation_id: str, last: Optional[int] = None) -> List[Dict]:
+        """Get stored messages, oldest first, or only the last ones"""
+
+    @abc.abstractmethod
+    def get_summary(self, conversation_id: str) -> Dict:
+        """Get rolling summary as {"text", "summarized"}, summarized is the number of messages it covers"""
+
+    @abc.abstractmethod
+    def set_summary(self, conversation_id: str, text: str, summarized: int):
+        """Store rolling summary covering the first summarized messages"""
+
+    @abc.abstractmethod
+    def clear(self, conversation_id: str):
+        """Delete messages and summary of a conversation"""
+
+class RedisConversationStore(ConversationStore):
+    """Conversations stored in Redis, shared by all workers and containers
+
+    A conversation is a capped list of JSON messages and a hash with its message count
+    and summary, both expire after ttl without activity.
+    """
+    backend = "redis"
+
+    def __init__(self, redis_url: str, max_messages: int, ttl: int):
+        super().__init__(max_messages, ttl)
+        self.redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
+        self._append_script = self.redis_client.register_script(_APPEND_SCRIPT)
+
+    def _messages_key(self, conversation_id: str) -> str:
+        return f"conversation:{conversation_id}:messages"
+
+    def _meta_key(self, conversation_id: str) -> str:
+        return f"conversation:{conversation_id}"
+
+    def append(self, conversation_id: str, role: str, text: str, html: str) -> int:
+        message = {"role": role, "text": text, "html": html}
+        return int(self._append_script(
+            keys=[self._meta_key(conversation_id), self._messages_key(conversation_id)],
+            args=[json.dumps(message, ensure_ascii=False), self.max_messages, self.ttl],
+        ))
+
+    def get_messages(self, conversation_id: str, last: Optional[int] = None) -> List[Dict]:
+        start = -last if last else 0
+        return [json.loads(message) for message in self.redis_client.lrange(self._messages_key(conversation_id), start, -1)]
+
+    def get_summary(self, conversation_id: str) -> Dict:
+        text, summarized = self.redis_client.hmget(self._meta_key(conversation_id), ["summary", "summarized"])
+        return {"text": text or "", "summarized": int(summarized or 0)}
+
+    def set_summary(self, conversation_id: str, text: str, summarized: int):
+        self.redis_client.hset(self._meta_key(conversation_id), mapping={"summary": text, "summarized": summarized})
+
+    def clear(self, conversation_id: str):
+        self.redis_client.delete(self._messages_key(conversation_id), self._meta_key(conversation_id))
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversations stored in a SQLite file shared by the gunicorn workers of this host"""
+    backend = "sqlite"
+
+    def __init__(self, path: str, max_messages: int, ttl: int):
+        super().__init__(max_messages, ttl)
+        self.path = path
+
+        # SQLite connections can not be shared between threads
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id TEXT PRIMARY KEY, total INTEGER NOT NULL, summary TEXT NOT NULL, "
+            "summarized INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "text TEXT NOT NULL, html TEXT NOT NULL, PRIMARY KEY (conversation_id, seq))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get SQLite connection of current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _expire(self, connection: sqlite3.Connection, now: float):
+        """Delete conversations without activity for ttl seconds"""
+        expired = [row[0] for row in connection.execute(
+            "SELECT id FROM conversations WHERE updated_at < ?", (now - self.ttl,)
+        )]
+        for conversation_id in expired:
+            connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def append(self, conversation_id: str, role: str, text: str, html: str) -> int:
+        connection = self._connection()
+        now = time.time()
+        with self._write_lock, connection:
+            connection.execute(
+                "INSERT INTO conversations (id, total, summary, summarized, updated_at) VALUES (?, 1, '', 0, ?) "
+                "ON CONFLICT (id) DO UPDATE SET total = total + 1, updated_at = excluded.updated_at",
+                (conversation_id, now)
+            )
+            total = connection.execute("SELECT total FROM conversations WHERE id = ?", (conversation_id,)).fetchone()[0]
+            connection.execute(
+                "INSERT INTO messages (conversation_id, seq, role, text, html) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, total - 1, role, text, html)
+            )
+            # Keep the last max_messages messages
+            connection.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND seq < ?",
+                (conversation_id, total - self.max_messages)
+            )
+            if total == 1:
+                self._expire(connection, now)
+        return total
+
+    def get_messages(self, conversation_id: str, last: Optional[int] = None) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT seq, role, text, html FROM messages WHERE conversation_id = ? ORDER BY seq DESC LIMIT ?",
+            (conversation_id, last or self.max_messages)
+        ).fetchall()
+        return [{"seq": seq, "role": role, "text": text, "html": html} for seq, role, text, html in reversed(rows)]
+
+    def get_summary(self, conversation_id: str) -> Dict:
+        row = self._connection().execute(
+            "SELECT summary, summarized FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return {"text": row[0], "summarized": row[1]} if row else {"text": "", "summarized": 0}
+
+    def set_summary(self, conversation_id: str, text: str, summarized: int):
+        connection = self._connection()
+        with self._write_lock, connection:
+            connection.execute(
+                "UPDATE conversations SET summary = ?, summarized = ? WHERE id = ?",
+                (text, summarized, conversation_id)
+            )
+
+    def clear(self, conversation_id: str):
+        connection = self._connection()
+        with self._write_lock, connection:
+            connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+def create_conversation_store(config) -> ConversationStore:
+    """Create conversation store, Redis when REDIS_URL is set, otherwise SQLite"""
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        return RedisConversationStore(
+            redis_url=redis_url,
+            max_messages=config.CONVERSATION_MAX_MESSAGES,
+            ttl=config.CONVERSATION_TTL,
+        )
+    return SQLiteConversationStore(
+        path=config.CONVERSATION_STORE_PATH,
+        max_messages=config.CONVERSATION_MAX_MESSAGES,
+        ttl=config.CONVERSATION_TTL,
+    )
@@ -0,0 +1,234 @@
+import os
+import abc
+import time
+import redis
+import sqlite3
+import hashlib
+import threading
+
+from array import array
+from typing import List, Dict, Optional
+from .metrics import record_cache_lookups
+
+class EmbeddingCache(abc.ABC):
+    """Content-addressed embedding cache keyed by model name, dimension and text hash"""
+    backend = "none"
+
+    def __init__(self, model_name: str, dim: int):
+        self.model_name = model_name
+        self.dim = dim
+
+        # Hit and miss counters of this process
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        """Create cache key of a text"""
+        return hashlib.sha256(f"{self.model_name}:{self.dim}:{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _encode(embedding: List[float]) -> bytes:
+        """Pack embedding as float32 bytes"""
+        return array("f", embedding).tobytes()
+
+    @staticmethod
+    def _decode(data: bytes) -> List[float]:
+        """Unpack float32 bytes to embedding"""
+        embedding = array("f")
+        embedding.frombytes(data)
+        return embedding.tolist()
+
+    @abc.abstractmethod
+    def _get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        """Get stored values of the keys which are cached"""
+
+    @abc.abstractmethod
+    def _set_many(self, items: Dict[str, bytes]):
+        """Store values by key"""
+
+    @abc.abstractmethod
+    def _count(self) -> Optional[int]:
+        """Number of cached embeddings, None when the backend can not count them"""
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Get cached embeddings of texts, None for texts which are not cached"""
+        keys = [self._key(text) for text in texts]
+        try:
+            found = self._get_many(keys)
+        except Exception as e:
+            print(f"Error reading embedding cache: {e}")
+            found = {}
+
+        with self._counter_lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        record_cache_lookups("embedding", len(found), len(keys) - len(found))
+        return [self._decode(found[key]) if key in found else None for key in keys]
+
+    def set_many(self, texts: List[str], embeddings: List[List[float]]):
+        """Store embeddings of texts"""
+        items = {self._key(text): self._encode(embedding) for text, embedding in zip(texts, embeddings)}
+        try:
+            self._set_many(items)
+        except Exception as e:
+            print(f"Error writing embedding cache: {e}")
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Get cached embedding of a text"""
+        return self.get_many([text])[0]
+
+    def set(self, text: str, embedding: List[float]):
+        """Store embedding of a text"""
+        self.set_many([text], [embedding])
+
+    def stats(self) -> Dict:
+        """Get hit and miss counters of the cache"""
+        lookups = self.hits + self.misses
+        try:
+            entries = self._count()
+        except Exception:
+            entries = None
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+        }
+
+class SQLiteEmbeddingCache(EmbeddingCache):
+    """Embedding cache stored in a SQLite file with least recently used eviction"""
+    backend = "sqlite"
+
+    # SQLite limits the number of parameters of one query
+    _MAX_QUERY_PARAMS = 500
+
+    def __init__(self, model_name: str, dim: int, path: str, max_entries: int):
+        super().__init__(model_name, dim)
+        self.path = path
+        self.max_entries = max_entries
+
+        # SQLite connections can not be shared between threads
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get SQLite connection of current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Several gunicorn workers share the file, WAL mode lets readers run during writes
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        connection = self._connection()
+        found = {}
+        for start in range(0, len(keys), self._MAX_QUERY_PARAMS):
+            batch = keys[start:start + self._MAX_QUERY_PARAMS]
+            placeholders = ",".join("?" * len(batch))
+            rows = connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            found.update(rows)
+
+        # Update last access time of hits for LRU eviction
+        if found:
+            now = time.time()
+            with self._write_lock:
+                connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                connection.commit()
+        return found
+
+    def _set_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+        connection = self._connection()
+        now = time.time()
+        with self._write_lock:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                [(key, vector, now) for key, vector in items.items()]
+            )
+            # Evict least recently used embeddings above the size bound
+            overflow = self._count() - self.max_entries
+            if overflow > 0:
+                connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                    (overflow,)
+                )
+            connection.commit()
+
+    def _count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+class RedisEmbeddingCache(EmbeddingCache):
+    """Embedding cache stored in Redis, shared by all workers and containers
+
+    Size is bounded by the Redis maxmemory LRU policy and the TTL of each entry.
+    """
+    backend = "redis"
+
+    def __init__(self, model_name: str, dim: int, redis_url: str, ttl: int):
+        super().__init__(model_name, dim)
+        self.ttl = ttl
+        self.redis_client = redis.Redis.from_url(redis_url)
+
+    def _redis_key(self, key: str) -> str:
+        return f"embedding:{key}"
+
+    def _get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        if not keys:
+            return {}
+        values = self.redis_client.mget([self._redis_key(key) for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def _set_many(self, items: Dict[str, bytes]):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key, vector in items.items():
+            pipeline.set(self._redis_key(key), vector, ex=self.ttl)
+        pipeline.execute()
+
+    def _count(self) -> Optional[int]:
+        # Counting keys would scan the whole Redis keyspace
+        return None
+
+def create_embedding_cache(config) -> Optional[EmbeddingCache]:
+    """Create embedding cache from configuration, None when cache is disabled"""
+    backend = config.EMBEDDING_CACHE_BACKEND
+    if backend == "none":
+        return None
+
+    if backend == "redis":
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            return RedisEmbeddingCache(
+                model_name=config.EMBEDDING_MODEL_NAME,
+                dim=config.EMBEDDING_DIM,
+                redis_url=redis_url,
+                ttl=config.EMBEDDING_CACHE_TTL,
+            )
+        print("REDIS_URL is not set, using SQLite embedding cache")
+
+    return SQLiteEmbeddingCache(
+        model_name=config.EMBEDDING_MODEL_NAME,
+        dim=config.EMBEDDING_DIM,
+        path=config.EMBEDDING_CACHE_PATH,
+        max_entries=config.EMBEDDING_CACHE_MAX_ENTRIES,
+    )
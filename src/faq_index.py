@@ -0,0 +1,183 @@
+import re
+import uuid
+import threading
+
+from typing import Dict, Iterable, List, Optional
+from qdrant_client import QdrantClient, models
+from .metrics import record_cache_lookups
+
+# Numbering of FAQ questions, e.g. "2.1 " or "Q3: "
+QUESTION_NUMBER_PATTERN = re.compile(r"^(?:\d+(?:\.\d+)*\.?|Q\d*[.:]?)\s+", re.IGNORECASE)
+# Blocks holding only the page number, in the footer of pages
+PAGE_NUMBER_PATTERN = re.compile(r"^\d{1,4}$")
+LIST_ITEM_PATTERN = re.compile(r"^(?:[•●▪◦*-]|\d{1,3}[.)])\s+")
+BULLET_PATTERN = re.compile(r"^[•●▪◦]\s*")
+
+def _block_markdown(text: str) -> str:
+    """Markdown of a text block, lines are wrapped by the PDF layout and joined again"""
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)
+    text = re.sub(r"\s*\n\s*", " ", text).strip()
+    return BULLET_PATTERN.sub("- ", text)
+
+def _answer_markdown(blocks: List[str]) -> str:
+    # List items follow each other, other blocks are paragraphs
+    parts = []
+    for block in blocks:
+        if parts:
+            parts.append("\n" if LIST_ITEM_PATTERN.match(block) else "\n\n")
+        parts.append(block)
+    return "".join(parts)
+
+def extract_faq_entries(pages: Iterable[Dict]) -> List[Dict]:
+    """Question and answer pairs of a FAQ document, as {"question", "answer", "page"}
+
+    A question is a heading ending with a question mark, without its numbering. Its
+    answer is the text of the blocks up to the next heading, as markdown.
+    """
+    entries = []
+    current = None
+    for page in pages:
+        for block in page["blocks"]:
+            text = block["text"].strip()
+            if block["heading"]:
+                question = QUESTION_NUMBER_PATTERN.sub("", " ".join(text.split()))
+                current = {"question": question, "page": page["page"], "blocks": []} if question.endswith("?") else None
+                if current is not None:
+                    entries.append(current)
+            elif current is not None and text and not PAGE_NUMBER_PATTERN.match(text):
+                current["blocks"].append(_block_markdown(text))
+    return [
+        {"question": entry["question"], "answer": _answer_markdown(entry["blocks"]), "page": entry["page"]}
+        for entry in entries if entry["blocks"]
+    ]
+
+class FAQIndex:
+    """Canonical answers of FAQ documents, looked up by similarity of question embeddings
+
+    Entries are stored in their own Qdrant collection, one set per version of the chunk
+    collection, so the served version only finds the entries of its corpus. A question
+    close enough to an entry is answered with it, without retrieval and generation.
+    """
+    def __init__(self, qdrant_client: QdrantClient, collection_name: str, dim: int, threshold: float):
+        self.qdrant_client = qdrant_client
+        self.collection_name = collection_name
+        self.threshold = threshold
+
+        # Lookups, and latency of answers from the index and of generated answers, in this process
+        self.hits = 0
+        self.misses = 0
+        self._answer_seconds = {"faq": [0, 0.0], "generated": [0, 0.0]}
+        self._counter_lock = threading.Lock()
+
+        if not self.qdrant_client.collection_exists(self.collection_name):
+            self.qdrant_client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+            )
+
+    def _version_filter(self, version: str) -> models.Filter:
+        return models.Filter(must=[models.FieldCondition(key="collection", match=models.MatchValue(value=version))])
+
+    def stored_vectors(self, version: str) -> Dict[str, List[float]]:
+        """Vectors of the questions of a version, keyed by question"""
+        vectors = {}
+        offset = None
+        while True:
+            records, offset = self.qdrant_client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=self._version_filter(version),
+                limit=256,
+                offset=offset,
+                with_payload=["question"],
+                with_vectors=True,
+            )
+            for record in records:
+                vectors[record.payload["question"]] = record.vector
+            if offset is None:
+                return vectors
+
+    def add(self, version: str, filename: str, entries: List[Dict], vectors: List[List[float]], language: str):
+        """Store entries of a FAQ document in a version"""
+        self.qdrant_client.upsert(
+            collection_name=self.collection_name,
+            points=[
+                models.PointStruct(
+                    id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{version}/{filename}/{entry['question']}")),
+                    vector=vector,
+                    payload=dict(entry, filename=filename, language=language, collection=version),
+                )
+                for entry, vector in zip(entries, vectors)
+            ]
+        )
+
+    def remove_other_versions(self, versions: List[str]):
+        """Remove entries of every version but the given ones"""
+        self.qdrant_client.delete(
+            collection_name=self.collection_name,
+            points_selector=models.FilterSelector(filter=models.Filter(must_not=[
+                models.FieldCondition(key="collection", match=models.MatchAny(any=versions))
+            ])),
+        )
+
+    def lookup(self, question_embedding: List[float], version: str, language: str) -> Optional[Dict]:
+        """Get the entry of the question closest to a question of the same language, None below threshold"""
+        try:
+            results = self.qdrant_client.query_points(
+                collection_name=self.collection_name,
+                query=question_embedding,
+                query_filter=models.Filter(must=[
+                    models.FieldCondition(key="collection", match=models.MatchValue(value=version)),
+                    models.FieldCondition(key="language", match=models.MatchValue(value=language)),
+                ]),
+                score_threshold=self.threshold,
+                limit=1,
+                with_payload=True,
+            )
+            entry = results.points[0].payload if results.points else None
+        except Exception as e:
+            print(f"Error reading FAQ index: {e}")
+            entry = None
+
+        with self._counter_lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache_lookups("faq", int(entry is not None), int(entry is None))
+        return entry
+
+    def record_answer(self, seconds: float, from_index: bool):
+        """Record latency of an answer, from the index or generated after a miss"""
+        with self._counter_lock:
+            latency = self._answer_seconds["faq" if from_index else "generated"]
+            latency[0] += 1
+            latency[1] += seconds
+
+    def _mean_ms(self, kind: str) -> Optional[float]:
+        count, seconds = self._answer_seconds[kind]
+        return round(seconds / count * 1000, 3) if count else None
+
+    def stats(self, version: Optional[str] = None) -> Dict:
+        """Get hit ratio of the index and latency saved by answering from it"""
+        with self._counter_lock:
+            lookups = self.hits + self.misses
+            faq_ms = self._mean_ms("faq")
+            generated_ms = self._mean_ms("generated")
+            # Estimate, each hit saves the mean latency of a generated answer minus its own
+            saved_ms = None
+            if faq_ms is not None and generated_ms is not None:
+                saved_ms = round(self.hits * max(generated_ms - faq_ms, 0.0), 3)
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "mean_faq_answer_ms": faq_ms,
+                "mean_generated_answer_ms": generated_ms,
+                "saved_ms": saved_ms,
+            }
+        if version is not None:
+            try:
+                stats["entries"] = self.qdrant_client.count(self.collection_name, count_filter=self._version_filter(version)).count
+            except Exception as e:
+                print(f"Error counting FAQ entries: {e}")
+        return stats
@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import threading
+import redis
+
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from .metrics import observe_stage, record_gemini_request
+
+class GeminiUnavailableError(Exception):
+    """Gemini could not answer within the deadline of the call: out of quota or failing"""
+    def __init__(self, message: str, rate_limited: bool = False):
+        super().__init__(message)
+        self.rate_limited = rate_limited
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Check if an error from Gemini API is a rate limit (429) error"""
+    if isinstance(error, GeminiUnavailableError):
+        return error.rate_limited
+    if getattr(error, "code", None) == 429:
+        return True
+    error_msg = str(error).lower()
+    return "429" in error_msg or "quota" in error_msg or "resource_exhausted" in error_msg
+
+def is_transient_error(error: Exception) -> bool:
+    """Check if a Gemini call may succeed when retried: rate limits, server errors and timeouts"""
+    if is_rate_limit_error(error):
+        return True
+    if getattr(error, "code", None) in (500, 502, 503, 504):
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    error_msg = f"{type(error).__name__} {error}".lower()
+    return any(term in error_msg for term in ("timeout", "timed out", "unavailable", "connection", "deadline"))
+
+def estimate_tokens(contents, chars_per_token: float) -> int:
+    """Estimate input tokens of generate or embed contents before calling Gemini"""
+    def characters(value) -> int:
+        if isinstance(value, str):
+            return len(value)
+        if isinstance(value, dict):
+            return characters(value.get("parts") or value.get("text") or "")
+        if isinstance(value, (list, tuple)):
+            return sum(characters(item) for item in value)
+        return len(str(value))
+    return max(1, int(characters(contents) / chars_per_token))
+
+# Takes from the requests and tokens buckets of a model only when both have enough left,
+# otherwise returns the seconds to wait. Buckets refill continuously at their limit per minute.
+_RESERVE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local amount = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    level = math.min(capacity, level + math.max(now - updated, 0) * capacity / 60)
+    levels[i] = level - amount
+    if level < amount then
+        wait = math.max(wait, (amount - level) * 60 / capacity)
+    end
+end
+if wait == 0 then
+    for i, key in ipairs(KEYS) do
+        redis.call('HSET', key, 'level', levels[i], 'updated', now)
+        redis.call('EXPIRE', key, 120)
+    end
+end
+return tostring(wait)
+"""
+
+class QuotaLimiter:
+    """Requests per minute and tokens per minute buckets of Gemini models
+
+    Buckets live in Redis when REDIS_URL is set, so every worker and container takes from
+    the same quota, otherwise in this process. Models without limits are not throttled.
+    """
+    def __init__(self, limits: Dict[str, Dict[str, int]], redis_url: Optional[str] = None):
+        self.limits = limits
+        self.redis_client = redis.Redis.from_url(redis_url) if redis_url else None
+        self._reserve_script = self.redis_client.register_script(_RESERVE_SCRIPT) if self.redis_client else None
+
+        # Bucket levels of this process, {key: (level, updated)}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _requests(self, model: str, tokens: int) -> Dict[str, Tuple[int, int]]:
+        """Buckets a call takes from, {key: (limit per minute, amount)}"""
+        limits = self.limits.get(model) or {}
+        buckets = {}
+        if limits.get("rpm"):
+            buckets[f"gemini_quota:{model}:rpm"] = (limits["rpm"], 1)
+        if limits.get("tpm"):
+            # A call bigger than the whole minute quota waits for a full bucket
+            buckets[f"gemini_quota:{model}:tpm"] = (limits["tpm"], min(tokens, limits["tpm"]))
+        return buckets
+
+    def reserve(self, model: str, tokens: int) -> float:
+        """Take quota of a call, returns 0 when taken, otherwise the seconds to wait before asking again"""
+        buckets = self._requests(model, tokens)
+        if not buckets:
+            return 0.0
+        if self._reserve_script is not None:
+            try:
+                args = [value for limit_amount in buckets.values() for value in limit_amount]
+                return float(self._reserve_script(keys=list(buckets), args=args))
+            except redis.exceptions.RedisError as e:
+                # Throttle within this process while Redis is unavailable
+                print(f"Error reserving Gemini quota in Redis: {e}")
+
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            levels = {}
+            for key, (capacity, amount) in buckets.items():
+                level, updated = self._buckets.get(key, (capacity, now))
+                level = min(capacity, level + (now - updated) * capacity / 60)
+                levels[key] = level - amount
+                if level < amount:
+                    wait = max(wait, (amount - level) * 60 / capacity)
+            if wait == 0.0:
+                for key, level in levels.items():
+                    self._buckets[key] = (level, now)
+            return wait
+
+class _Budget:
+    """Deadline of one call to Gemini, shared by its quota waits, retries and fallback model"""
+    def __init__(self, deadline: float, max_wait: float):
+        self.expires_at = time.monotonic() + deadline
+        self.max_wait = max_wait
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+class QuotaAwareModels:
+    """Gemini models API throttled by quota, with retries and a cheaper fallback model
+
+    Calls wait for quota of their model at most max_wait seconds, transient errors are
+    retried with jittered exponential backoff within the deadline of the call. When a
+    model is out of quota or keeps failing, its fallback model answers. Errors which are
+    not transient are raised as they are, GeminiUnavailableError when the call gave up.
+    Background calls, e.g. embeddings of indexing, wait for quota as long as their own
+    deadline allows instead, nobody is waiting for their answer.
+    """
+    def __init__(self, models, limiter: QuotaLimiter, config):
+        self._models = models
+        self.limiter = limiter
+        self.max_wait = config.GEMINI_QUOTA_MAX_WAIT
+        self.max_retries = config.GEMINI_MAX_RETRIES
+        self.retry_base_delay = config.GEMINI_RETRY_BASE_DELAY
+        self.retry_max_delay = config.GEMINI_RETRY_MAX_DELAY
+        self.deadline = config.GEMINI_REQUEST_DEADLINE
+        self.background_deadline = config.GEMINI_BACKGROUND_DEADLINE
+        self.fallback_models = config.GEMINI_FALLBACK_MODELS
+        self.chars_per_token = config.CONTEXT_CHARS_PER_TOKEN
+
+    def __getattr__(self, name):
+        # Other calls are not throttled
+        return getattr(self._models, name)
+
+    def _models_to_try(self, model: str) -> Iterator[str]:
+        tried = set()
+        while model and model not in tried:
+            tried.add(model)
+            yield model
+            model = self.fallback_models.get(model)
+
+    def _quota_wait(self, model: str, tokens: int, budget: _Budget) -> Optional[float]:
+        """Seconds to sleep before asking quota again, 0 when it was taken, None when the call must give up"""
+        wait = self.limiter.reserve(model, tokens)
+        if wait == 0.0:
+            return 0.0
+        if wait > min(budget.max_wait, budget.remaining()):
+            return None
+        return wait
+
+    def _retry_delay(self, attempt: int) -> float:
+        # Full jitter so workers which failed together do not retry together
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+
+    def _budget(self, background: bool) -> _Budget:
+        if background:
+            return _Budget(self.background_deadline, self.background_deadline)
+        return _Budget(self.deadline, self.max_wait)
+
+    def _call(
+        self, model: str, contents, call: Callable[[str], Any], background: bool = False, quota: Optional[str] = None
+    ) -> Any:
+        """Call Gemini with model, or its fallback models, within the deadline
+
+        A call with its own quota, e.g. "count_tokens", takes from it instead of the quota
+        of the model and never falls back to another model.
+        """
+        tokens = estimate_tokens(contents, self.chars_per_token)
+        budget = self._budget(background)
+        last_error = None
+        for model_name in ([model] if quota else self._models_to_try(model)):
+            # Calls with their own quota are recorded under it, not as requests of the model
+            label = quota or model_name
+            waited = 0.0
+            attempt = 0
+            while True:
+                wait = self._quota_wait(label, tokens, budget)
+                if wait is None:
+                    record_gemini_request(label, "throttled")
+                    last_error = GeminiUnavailableError(f"Quota of {model_name} exhausted", rate_limited=True)
+                    break
+                if wait > 0:
+                    time.sleep(wait)
+                    waited += wait
+                    continue
+                if waited:
+                    observe_stage("quota_wait", waited)
+                    waited = 0.0
+
+                try:
+                    result = call(model_name)
+                    record_gemini_request(label, "success" if model_name == model else "fallback")
+                    return result
+                except Exception as e:
+                    if not is_transient_error(e):
+                        record_gemini_request(label, "failed")
+                        raise
+                    last_error = e
+                    delay = self._retry_delay(attempt)
+                    attempt += 1
+                    if attempt > self.max_retries or delay > budget.remaining():
+                        record_gemini_request(label, "failed")
+                        break
+                    record_gemini_request(label, "retried")
+                    print(f"Gemini {model_name} error, retrying in {delay:.1f}s ({attempt}/{self.max_retries}): {e}")
+                    time.sleep(delay)
+
+        raise GeminiUnavailableError(
+            f"Gemini unavailable: {last_error}", rate_limited=is_rate_limit_error(last_error)
+        ) from last_error
+
+    def generate_content(self, model: str, contents, config=None):
+        return self._call(model, contents, lambda model_name: self._models.generate_content(
+            model=model_name, contents=contents, config=config
+        ))
+
+    def embed_content(self, model: str, contents, config=None, background: bool = False):
+        return self._call(model, contents, lambda model_name: self._models.embed_content(
+            model=model_name, contents=contents, config=config
+        ), background)
+
+    def count_tokens(self, model: str, contents, config=None):
+        """Count tokens, a background call throttled by the "count_tokens" quota"""
+        return self._call(model, contents, lambda model_name: self._models.count_tokens(
+            model=model_name, contents=contents, config=config
+        ), background=True, quota="count_tokens")
+
+    def generate_content_stream(self, model: str, contents, config=None) -> Iterator:
+        """Stream a generation, it is retried or falls back only until its first chunk"""
+        def start(model_name: str):
+            stream = iter(self._models.generate_content_stream(model=model_name, contents=contents, config=config))
+            return next(stream, None), stream
+
+        first, stream = self._call(model, contents, start)
+        if first is not None:
+            yield first
+            yield from stream
+
+class QuotaAwareGenaiClient:
+    """Gemini client whose models API is throttled by the quota shared by all workers
+
+    Wraps a google-genai client, or any client with the same models API.
+    """
+    def __init__(self, client, config):
+        self._client = client
+        self.limiter = QuotaLimiter(config.GEMINI_RATE_LIMITS, os.getenv("REDIS_URL"))
+        self.models = QuotaAwareModels(client.models, self.limiter, config)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -1,29 +1,80 @@
 import os
-import fitz
+import re
+import shutil
+import time
+import threading
+import uuid
 import hashlib
 
-from typing import List, Dict
+from typing import List, Dict, Callable, Iterator, Optional, Tuple
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client import models
+from qdrant_client.models import PointStruct
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from google import genai
 from google.genai import types
+from .embedding_cache import create_embedding_cache
+from .gemini_client import GeminiUnavailableError, QuotaAwareGenaiClient
+from .response_cache import SemanticResponseCache
+from .faq_index import FAQIndex, extract_faq_entries
+from .lexical_index import BM25Index, reciprocal_rank_fusion
+from .metrics import observe_stage, record_context_tokens, record_gemini_request, record_tokens, timed_stage
+from .pdf_extraction import PDFExtractor, chunk_pages
+from .context_builder import ContextBuilder
+from .query_rewriter import QueryRewriter
+from .reranker import create_reranker
+from .search_filters import (
+    build_search_filter, create_query_router, detect_language, document_type, filter_mask, matches_filters, validate_filters
+)
+from .single_flight import create_single_flight
+from .storage_profiles import (
+    FULL_VECTOR, create_collection, create_point_vector, create_query, create_search_params,
+    full_vector, get_storage_profile, storage_profile_signature,
+)
+
+# Header of answers made of document excerpts when Gemini can not answer
+RETRIEVAL_ONLY_ANSWER_HEADER = "Hệ thống đang quá tải, dưới đây là các đoạn tài liệu liên quan đến câu hỏi của bạn:"
 
 class RAGChatbot:
-    def __init__(self, config):
+    def __init__(self, config, genai_client=None, qdrant_client=None, embedding_cache=None):
         # Configurations
+        # Clients may be given to run against other backends, e.g. the offline benchmark,
+        # or to share them between the chatbots of tenants (see shared_clients)
         self.config = config
         
         # Gemini model and embedding
         self.model_name = self.config.MODEL_NAME
         self.embedding_model_name = self.config.EMBEDDING_MODEL_NAME
-        self.genai_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+        # Calls are throttled by the quota of each model, retried and fall back to a cheaper model
+        if isinstance(genai_client, QuotaAwareGenaiClient):
+            self.genai_client = genai_client
+        else:
+            # GEMINI_BASE_URL sends Gemini calls to another endpoint, e.g. a proxy or the load test mock server
+            base_url = os.getenv("GEMINI_BASE_URL")
+            self.genai_client = QuotaAwareGenaiClient(
+                genai_client or genai.Client(
+                    api_key=os.getenv("GOOGLE_API_KEY"),
+                    http_options=types.HttpOptions(base_url=base_url) if base_url else None,
+                ),
+                self.config,
+            )
+        self.embedding_cache = embedding_cache or create_embedding_cache(self.config)
+        # Concurrent cache misses of the same text share one embedding request
+        self.embedding_flight = create_single_flight("embedding", self.config, across_workers=False)
         
         # Connect to Qdrant
         qdrant_url = os.getenv("QDRANT_URL")
-        self.qdrant_client = QdrantClient(url=qdrant_url)
+        self.qdrant_client = qdrant_client or QdrantClient(url=qdrant_url)
         self.collection_name = self.config.QDRANT_COLLECTION_NAME
+        # Corpus hash and file manifest of each collection version, kept out of the vector space
+        self.metadata_collection_name = f"{self.collection_name}_metadata"
+
+        # Storage profile of the chunk collection: quantization, on-disk storage, HNSW and payload indexes
+        self.storage_profile = get_storage_profile(self.config)
+        self.storage_profile_signature = storage_profile_signature(self.storage_profile)
+        self.search_params = create_search_params(self.storage_profile)
 
         # Text splitter configuration
         # Chunk overlap to keep context
@@ -42,297 +93,1275 @@ class RAGChatbot:
             separators=["\n\n", "\n", ". ", " ", ""], 
             length_function=len,
         )
+        self.pdf_extractor = PDFExtractor(self.config)
 
-        # Initialize collection
-        self._init_collection()
+        # Context builder packs retrieved chunks into the token budget of the prompt
+        self.context_builder = ContextBuilder(
+            max_tokens=self.config.CONTEXT_MAX_TOKENS,
+            min_score=self.config.CONTEXT_MIN_SCORE,
+            max_overlap=self.config.TEXT_SPLITTER_CHUNK_OVERLAP,
+            chars_per_token=self.config.CONTEXT_CHARS_PER_TOKEN,
+        )
+
+        # Query rewriter builds standalone retrieval queries of follow-up questions
+        self.query_rewriter = QueryRewriter(self.config, self.genai_client)
+        self.reranker = create_reranker(self.config)
+        # Query router scopes searches to the documents a question is about
+        self.query_router = create_query_router(self.config)
+
+        # Hash of files, and corpus version served behind the collection alias, refreshed periodically
+        self._file_hash_cache = {}
+        self._corpus_hash = ""
+        self._live_collection = None
+        self._served_document_fields = False
+        # Prefix dimension of the served collection when it is tiered, searches follow its layout
+        self._served_coarse_dim = None
+        self._served_index_checked_at = 0.0
+
+        # BM25 index of the served collection for hybrid retrieval
+        self._lexical_index = None
+        self._lexical_index_collection = None
+        self._lexical_index_lock = threading.Lock()
+
+        # Semantic response cache
+        self.response_cache = None
+        if self.config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = SemanticResponseCache(
+                qdrant_client=self.qdrant_client,
+                collection_name=self.config.RESPONSE_CACHE_COLLECTION_NAME,
+                dim=self.config.EMBEDDING_DIM,
+                threshold=self.config.RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+                ttl=self.config.RESPONSE_CACHE_TTL,
+            )
+
+        # Indexing lock and status of the collection, created by src.indexing when first used
+        self.index_lock = None
+        self.index_status = None
+
+        # Answers of FAQ documents, questions matching one of them are answered without generation
+        self.faq_index = None
+        if self.config.FAQ_INDEX_ENABLED:
+            self.faq_index = FAQIndex(
+                qdrant_client=self.qdrant_client,
+                collection_name=f"{self.collection_name}_faq",
+                dim=self.config.EMBEDDING_DIM,
+                threshold=self.config.FAQ_SIMILARITY_THRESHOLD,
+            )
+
+    def shared_clients(self) -> Dict:
+        """Clients which other chatbots can share, given as keyword arguments of RAGChatbot
+
+        Sharing them keeps one connection pool, one quota limiter and one embedding cache
+        per process however many chatbots there are.
+        """
+        return {
+            "genai_client": self.genai_client,
+            "qdrant_client": self.qdrant_client,
+            "embedding_cache": self.embedding_cache,
+        }
+
+    def _calculate_file_hash(self, file_path: str) -> str:
+        """Calculate MD5 hash of a file content, reuse it while the file is not modified"""
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._file_hash_cache.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
 
-    def _calculate_corpus_hash(self) -> str:
-        """Calculate hash of corpus folder to detectect content changes"""
-        if not os.path.exists(self.config.CORPUS_PATH):
-            return ""
-        
-        # Initialize hash with MD5 algorithm
         hasher = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+        self._file_hash_cache[file_path] = (signature, hasher.hexdigest())
+        return hasher.hexdigest()
+
+    def _calculate_file_hashes(self) -> Dict[str, str]:
+        """Calculate hash of each PDF file in corpus folder to detect content changes"""
+        if not os.path.exists(self.config.CORPUS_PATH):
+            return {}
 
-        # Read content of each file and hash it
+        file_hashes = {}
         for filename in sorted(os.listdir(self.config.CORPUS_PATH)):
             file_path = os.path.join(self.config.CORPUS_PATH, filename)
-            
             if os.path.isfile(file_path) and filename.endswith('.pdf'):
-                with open(file_path, 'rb') as f:
-                    hasher.update(f.read())
+                file_hashes[filename] = self._calculate_file_hash(file_path)
+        return file_hashes
+
+    def _calculate_corpus_hash(self, file_hashes: Dict[str, str]) -> str:
+        """Calculate hash of the whole corpus from the hashes of its files"""
+        if not file_hashes:
+            return ""
+
+        # Initialize hash with MD5 algorithm
+        hasher = hashlib.md5()
+        for filename in sorted(file_hashes):
+            hasher.update(f"{filename}:{file_hashes[filename]}\n".encode("utf-8"))
 
         # Return hash string in hexadecimal format
         return hasher.hexdigest()
 
-    def _get_stored_hash(self) -> str:
-        """Get stored hash from collection metadata"""
+    def _metadata_point_id(self, collection_name: str) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, collection_name))
+
+    def _get_stored_metadata(self, collection_name: Optional[str] = None) -> Dict:
+        """Get stored corpus hash and file manifest of a collection version, the served one by default"""
         try:
-            result =self.qdrant_client.retrieve(
-                collection_name=self.collection_name,
-                ids=[0]
-            )
+            collection_name = collection_name or self._get_live_collection()
+            if collection_name is None:
+                return {}
+            if self.qdrant_client.collection_exists(self.metadata_collection_name):
+                result = self.qdrant_client.retrieve(
+                    collection_name=self.metadata_collection_name,
+                    ids=[self._metadata_point_id(collection_name)]
+                )
+                if result:
+                    return result[0].payload or {}
+
+            # Collections indexed before metadata moved out of them keep it in point 0, with a dummy vector
+            result = self.qdrant_client.retrieve(collection_name=collection_name, ids=[0])
             if result:
-                return result[0].payload.get("corpus_hash", "")
-            else:
-                return ""
-        except:
-            return ""
+                return dict(result[0].payload or {}, legacy=True)
+            return {}
+        except Exception:
+            return {}
 
-    def _init_collection(self):
-        """Initialize collection and document indexs if not exists"""
-        collections = self.qdrant_client.get_collections().collections
-        collection_exists = any(c.name == self.collection_name for c in collections)
-        
-        # Calculate current corpur hash
-        current_hash = self._calculate_corpus_hash()
+    def _store_metadata(self, collection_name: str, metadata: Dict):
+        """Store corpus hash and file manifest of a collection version in the metadata collection"""
+        if not self.qdrant_client.collection_exists(self.metadata_collection_name):
+            # Payload only collection, it has no vectors
+            self.qdrant_client.create_collection(collection_name=self.metadata_collection_name, vectors_config={})
+        self.qdrant_client.upsert(
+            collection_name=self.metadata_collection_name,
+            points=[PointStruct(
+                id=self._metadata_point_id(collection_name),
+                vector={},
+                payload=dict(metadata, collection=collection_name),
+            )]
+        )
+
+    def _refresh_served_index(self):
+        """Check which collection and corpus version are served behind the collection alias"""
+        # Another process may swap the alias, so it is checked again periodically
+        now = time.time()
+        if now - self._served_index_checked_at > self.config.INDEX_STATE_REFRESH_INTERVAL:
+            try:
+                self._live_collection = self._get_live_collection()
+                metadata = self._get_stored_metadata(self._live_collection) if self._live_collection else {}
+                self._corpus_hash = metadata.get("corpus_hash", "")
+                # Chunks of collections indexed before metadata moved out of them have no document fields
+                self._served_document_fields = bool(metadata) and not metadata.get("legacy")
+                self._served_coarse_dim = metadata.get("coarse_dim")
+            except Exception as e:
+                print(f"Error checking served collection: {e}")
+            self._served_index_checked_at = now
+
+    @property
+    def corpus_hash(self) -> str:
+        """Hash of the corpus served behind the collection alias"""
+        self._refresh_served_index()
+        return self._corpus_hash
+
+    def get_index_state(self) -> Dict:
+        """Get state of the served index: missing, stale (corpus or storage profile changed since indexing) or ready"""
+        live_collection = self._get_live_collection()
+        metadata = self._get_stored_metadata(live_collection) if live_collection else {}
+        if not metadata:
+            return {"state": "missing"}
+
+        current_hash = self._calculate_corpus_hash(self._calculate_file_hashes())
+        return {
+            "state": "ready" if self._is_up_to_date(metadata, current_hash) else "stale",
+            "collection": live_collection,
+            "indexed_at": metadata.get("indexed_at"),
+        }
+
+    def _is_up_to_date(self, metadata: Dict, current_hash: str) -> bool:
+        """Check if a collection version holds the current corpus with the current storage profile"""
+        return (
+            metadata.get("corpus_hash") == current_hash
+            and metadata.get("storage_profile") == self.storage_profile_signature
+            # Collections with their metadata in the vector space are rebuilt without it
+            and not metadata.get("legacy")
+            # Collections indexed without FAQ answers are rebuilt once the FAQ index is enabled
+            and (self.faq_index is None or metadata.get("faq_index", False))
+        )
+
+    def _get_live_collection(self) -> Optional[str]:
+        """Get name of the collection served behind the collection alias"""
+        for alias in self.qdrant_client.get_aliases().aliases:
+            if alias.alias_name == self.collection_name:
+                return alias.collection_name
+
+        # Collection created before aliases were used has the alias name itself
+        if self.qdrant_client.collection_exists(self.collection_name):
+            return self.collection_name
+        return None
+
+    def _collection_versions(self) -> List[str]:
+        """Names of the collection versions, oldest first
+
+        Versions are named by their creation time, so their names sort by age.
+        """
+        version_pattern = re.compile(rf"^{re.escape(self.collection_name)}_\d+$")
+        return sorted(
+            collection.name for collection in self.qdrant_client.get_collections().collections
+            if version_pattern.match(collection.name)
+        )
+
+    def _swap_collection_alias(self, new_collection: str):
+        """Point the collection alias to the new collection and remove older collections
+
+        Versions created after the new one belong to indexing still running in another
+        process, they are kept and an alias already pointing to one of them is not moved.
+        """
+        # Another process may have swapped the alias while this one was indexing
+        live_collection = self._get_live_collection()
+        versions = self._collection_versions()
+        if live_collection is not None and live_collection in versions and live_collection > new_collection:
+            print(f"Newer collection {live_collection} is already served, keeping it")
+            return
+        operations = []
+        if live_collection == self.collection_name:
+            # Alias can not have the name of an existing collection, so the legacy collection is removed
+            # right before the alias is created. Its chunks were copied into the new collection, which
+            # is served by the next indexing if creating the alias fails
+            self.qdrant_client.delete_collection(live_collection)
+        elif live_collection is not None:
+            operations.append(models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name)
+            ))
+        operations.append(models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=new_collection, alias_name=self.collection_name)
+        ))
+        self.qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+
+        # Remove previous collection and collections left by interrupted indexing, never newer ones
+        kept = [version for version in versions if version >= new_collection]
+        for version in versions:
+            if version < new_collection:
+                self.qdrant_client.delete_collection(version)
+        # Remove metadata of removed collections
+        self.qdrant_client.delete(
+            collection_name=self.metadata_collection_name,
+            points_selector=models.FilterSelector(filter=models.Filter(must_not=[
+                models.FieldCondition(key="collection", match=models.MatchAny(any=kept))
+            ])),
+        )
+
+        if self.faq_index is not None:
+            self.faq_index.remove_other_versions(kept)
+
+        # Remove lexical indexes of removed collections
+        if os.path.isdir(self.config.LEXICAL_INDEX_DIR):
+            for name in os.listdir(self.config.LEXICAL_INDEX_DIR):
+                if name not in kept and name.startswith(f"{self.collection_name}_"):
+                    shutil.rmtree(os.path.join(self.config.LEXICAL_INDEX_DIR, name), ignore_errors=True)
+
+    def _recover_unaliased_version(self) -> Optional[str]:
+        """Serve the newest complete version when the legacy collection was removed but the alias was not created"""
+        for version in reversed(self._collection_versions()):
+            # Metadata is stored once a version is complete
+            if self._get_stored_metadata(version):
+                print(f"Collection alias is missing, serving {version}")
+                self._swap_collection_alias(version)
+                self._served_index_checked_at = 0.0
+                return version
+        return None
+
+    def index_corpus(self, progress_callback: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Index corpus into a new collection and swap the collection alias to it
+
+        Only new or changed files are extracted and embedded, the other points are
+        copied from the served collection. Queries keep using the served collection
+        until the new one is complete. Returns True when a new collection was built.
+        """
+        # Calculate current hash of each file and of the whole corpus
+        file_hashes = self._calculate_file_hashes()
+        current_hash = self._calculate_corpus_hash(file_hashes)
         
-        if collection_exists:
-            stored_hash = self._get_stored_hash()
+        stored_files = {}
+        live_collection = self._get_live_collection() or self._recover_unaliased_version()
+        if live_collection is not None:
+            metadata = self._get_stored_metadata(live_collection)
             # Check current hash if it changes or not
-            if current_hash == stored_hash:
-                print(f"Vector database already initialized ({self.qdrant_client.count(self.collection_name).count} chunks)")
-                return
-            # If corpus changed
+            same_profile = metadata.get("storage_profile") == self.storage_profile_signature
+            if self._is_up_to_date(metadata, current_hash):
+                print(f"Vector database already initialized ({self.qdrant_client.count(live_collection).count} chunks)")
+                return False
+            stored_files = metadata.get("files", {})
+            if not same_profile:
+                # Points of unchanged files are copied into a collection with the new profile
+                print(f"Storage profile changed, rebuilding collection with profile {self.config.STORAGE_PROFILE}...")
+            elif current_hash == metadata.get("corpus_hash", "") and metadata.get("legacy"):
+                print("Moving collection metadata out of the vector space, copying chunks...")
+            elif current_hash == metadata.get("corpus_hash", ""):
+                print("Building FAQ answer index, copying chunks...")
             else:
-                print("Corpus changed, re-indexing...")
-                self.qdrant_client.delete_collection(self.collection_name)
-
-        # Initialize vector database if it does not exist    
-        print("Initializing vector database...")
-        self.qdrant_client.create_collection(
-            collection_name=self.collection_name,
-            vectors_config=VectorParams(
-                size=self.config.EMBEDDING_DIM,
-                distance=Distance.COSINE, # Use cosine distance for similarity search
-            )
-        )
+                print("Corpus changed, re-indexing changed files...")
+        else:
+            print("Initializing vector database...")
 
-        # Index all PDFs
-        self._index_corpus(current_hash)
+        # Build a new version of the collection
+        new_collection = f"{self.collection_name}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        create_collection(self.qdrant_client, new_collection, self.config.EMBEDDING_DIM, self.storage_profile)
 
-    def _extract_text_from_pdf(self, pdf_path: str) -> str:
-        """Extract text from PDF file"""
+        # Only index new or changed PDFs, deleted ones are not copied
+        changed_files = [f for f in file_hashes if stored_files.get(f) != file_hashes[f]]
+        unchanged_files = [f for f in file_hashes if stored_files.get(f) == file_hashes[f]]
         try:
-            doc = fitz.open(pdf_path)
-            text = ""
+            self._index_corpus(
+                new_collection, live_collection, file_hashes, changed_files, unchanged_files, progress_callback
+            )
+        except Exception:
+            self.qdrant_client.delete_collection(new_collection)
+            raise
+
+        # Serve the new collection and remove answers of the previous corpus
+        if self.config.RETRIEVAL_MODE == "hybrid":
+            self._build_lexical_index(new_collection)
+        self._swap_collection_alias(new_collection)
+        self._served_index_checked_at = 0.0
+        if self.response_cache is not None:
+            self.response_cache.invalidate(self.corpus_hash)
+        return True
 
-            # Read each page of pdf file
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text += page.get_text()
-            
-            # Close reader
-            doc.close()
-            return text
-        except Exception as e:
-            print(f"Error extracting text from {pdf_path}: {e}")
-            return ""
-        
     def _get_embedding(self, text: str) -> List[float]:
-        """Get embedding from Gemini model"""
+        """Get embedding from Gemini model, or from embedding cache if it was computed before"""
+        if self.embedding_cache is not None:
+            embedding = self.embedding_cache.get(text)
+            if embedding is not None:
+                return embedding
         try:
+            if self.embedding_flight is None:
+                return self._embed_and_cache(text)
+            key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            return self.embedding_flight.do(key, lambda: self._embed_and_cache(text))
+        except Exception as e:
+            print(f"Error getting embedding from Gemini model: {e}")
+            return None
+
+    def _embed_and_cache(self, text: str) -> List[float]:
+        """Get embedding of a text missing from embedding cache and cache it"""
+        with timed_stage("embed"):
             result = self.genai_client.models.embed_content(
                 model=self.embedding_model_name,
                 contents=text,
                 config=types.EmbedContentConfig(output_dimensionality=self.config.EMBEDDING_DIM) # Only get 768 dimensions
             )
-            return result.embeddings[0].values
+        embedding = list(result.embeddings[0].values)
+        if self.embedding_cache is not None:
+            self.embedding_cache.set(text, embedding)
+        return embedding
+
+    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Get embeddings of many texts from Gemini model in one request
+
+        It is a background call: it waits for embedding quota as long as it takes, the
+        quota-aware client retries transient errors.
+        """
+        result = self.genai_client.models.embed_content(
+            model=self.embedding_model_name,
+            contents=texts,
+            config=types.EmbedContentConfig(output_dimensionality=self.config.EMBEDDING_DIM),
+            background=True,
+        )
+        if len(result.embeddings) != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got {len(result.embeddings)}")
+        return [embedding.values for embedding in result.embeddings]
+
+    def _embed_texts(self, texts: List[str]) -> Iterator[Tuple[int, Optional[List[float]]]]:
+        """Embed texts in batches with a bounded number of concurrent requests
+
+        Yields (index, embedding) pairs in completion order. Cached embeddings are
+        yielded first. Chunks of a batch rejected by Gemini are retried one by one, so one
+        bad chunk does not fail the others. Embedding is None when Gemini is unavailable,
+        its client already waited and retried, or when the chunk is rejected too.
+        """
+        # Only embed texts which are not in embedding cache
+        missing = list(range(len(texts)))
+        if self.embedding_cache is not None:
+            missing = []
+            for idx, embedding in enumerate(self.embedding_cache.get_many(texts)):
+                if embedding is None:
+                    missing.append(idx)
+                else:
+                    yield idx, embedding
+            print(f"Found {len(texts) - len(missing)} cached embeddings, embedding {len(missing)} chunks")
+
+        batch_size = self.config.EMBEDDING_BATCH_SIZE
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+
+        failed = []
+        embedded_count = 0
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.config.EMBEDDING_MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(self._get_embeddings, [texts[idx] for idx in batch]): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    embeddings = future.result()
+                except GeminiUnavailableError as e:
+                    print(f"Error embedding batch of {len(batch)} chunks: {e}")
+                    for idx in batch:
+                        yield idx, None
+                    continue
+                except Exception as e:
+                    print(f"Error embedding batch of {len(batch)} chunks: {e}")
+                    failed.extend(batch)
+                    continue
+
+                if self.embedding_cache is not None:
+                    self.embedding_cache.set_many([texts[idx] for idx in batch], embeddings)
+                for idx, embedding in zip(batch, embeddings):
+                    yield idx, embedding
+
+                # Report progress and throughput
+                embedded_count += len(batch)
+                elapsed = max(time.perf_counter() - start_time, 1e-9)
+                print(f"Embedded {embedded_count}/{len(missing)} chunks ({embedded_count / elapsed:.1f} chunks/s)")
+
+        # Retry chunks of failed batches one by one
+        for idx in sorted(failed):
+            try:
+                embedding = self._get_embeddings([texts[idx]])[0]
+            except Exception as e:
+                print(f"Error embedding chunk {idx}: {e}")
+                embedding = None
+            if embedding is not None and self.embedding_cache is not None:
+                self.embedding_cache.set(texts[idx], embedding)
+            yield idx, embedding
+
+    def _count_chunk_tokens(self, text: str) -> Optional[int]:
+        """Count tokens of a chunk with the Gemini token counter, None when it fails
+
+        Counting is throttled by the "count_tokens" quota and waits for it like embeddings.
+        """
+        try:
+            return self.genai_client.models.count_tokens(model=self.model_name, contents=text).total_tokens
         except Exception as e:
-            print(f"Error getting embedding from Gemini model: {e}")
+            print(f"Error counting tokens of chunk: {e}")
             return None
 
-    def _index_corpus(self, corpus_hash: str):
-        """Index all documents into Qdrant with chunking"""
-        # Check corpus folder exists
-        if not os.path.exists(self.config.CORPUS_PATH):
-            print("Corpus folder does not exist")
-            return
-        
-        points = []
-        point_id = 1 # Store from index 1, 0 for current hash
+    def _count_tokens(self, texts: List[str]) -> List[Optional[int]]:
+        """Count tokens of chunks, they are packed into the context budget without counting again"""
+        if self.config.CONTEXT_TOKEN_COUNTER != "gemini":
+            return [self.context_builder.estimate_tokens(text) for text in texts]
+        with ThreadPoolExecutor(max_workers=self.config.EMBEDDING_MAX_WORKERS) as executor:
+            return list(executor.map(self._count_chunk_tokens, texts))
 
-        # Get pdf filenames
-        pdf_files = sorted([f for f in os.listdir(self.config.CORPUS_PATH) if f.endswith('.pdf')])
-        if not pdf_files:
-            print("No PDF files found in corpus folder")
-            return
-        
-        print(f"Indexing {len(pdf_files)} PDF files...")
-        for filename in pdf_files:
-            file_path = os.path.join(self.config.CORPUS_PATH, filename)
+    def _document_fields(self, filename: str, text: str) -> Dict:
+        """Payload fields searches can be filtered by, besides file name and pages"""
+        return {
+            "doc_type": document_type(filename, self.config.DOCUMENT_TYPES, self.config.DEFAULT_DOCUMENT_TYPE),
+            "language": detect_language(text),
+        }
+
+    def _is_faq_file(self, filename: str) -> bool:
+        """Check if a document holds question and answer pairs for the FAQ index"""
+        doc_type = document_type(filename, self.config.DOCUMENT_TYPES, self.config.DEFAULT_DOCUMENT_TYPE)
+        return self.faq_index is not None and doc_type in self.config.FAQ_DOCUMENT_TYPES
+
+    def _chunk_point_id(self, filename: str, chunk_index: int, content_hash: str) -> str:
+        """Create stable point id derived from the chunk location and content"""
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{filename}/{chunk_index}/{content_hash}"))
+
+    def _filename_filter(self, filename: str) -> models.Filter:
+        """Create filter matching all points of a file"""
+        return models.Filter(must=[
+            models.FieldCondition(key="filename", match=models.MatchValue(value=filename))
+        ])
+
+    def _scroll_file_points(self, collection_name: str, filename: str, with_payload=True) -> Iterator[models.Record]:
+        """Iterate all points of a file with their vectors"""
+        offset = None
+        while True:
+            records, offset = self.qdrant_client.scroll(
+                collection_name=collection_name,
+                scroll_filter=self._filename_filter(filename),
+                limit=self.config.QDRANT_UPSERT_BATCH_SIZE,
+                offset=offset,
+                with_payload=with_payload,
+                with_vectors=True,
+            )
+            yield from records
+            if offset is None:
+                return
+
+    def _get_stored_vectors(self, collection_name: str, filename: str) -> Dict[str, Tuple[List[float], Optional[int]]]:
+        """Get stored vectors and token counts of a file, keyed by chunk content hash"""
+        vectors = {}
+        for record in self._scroll_file_points(collection_name, filename, with_payload=["content_hash", "token_count"]):
+            payload = record.payload or {}
+            content_hash = payload.get("content_hash")
+            vector = full_vector(record.vector)
+            if content_hash and vector is not None:
+                vectors[content_hash] = (vector, payload.get("token_count"))
+        return vectors
+
+    def _point_vector(self, embedding: List[float]):
+        """Vector of a chunk point in the layout of the storage profile"""
+        return create_point_vector(embedding, self.storage_profile.get("coarse_dim"))
 
+    def _upsert_points(self, collection_name: str, points: List[PointStruct]):
+        """Upload points to Qdrant in batches"""
+        batch_size = self.config.QDRANT_UPSERT_BATCH_SIZE
+        for start in range(0, len(points), batch_size):
+            batch = points[start:start + batch_size]
+            self.qdrant_client.upsert(
+                collection_name=collection_name,
+                points=batch
+            )
+            print(f"Uploaded {len(batch)} points")
+
+    def _index_corpus(
+        self,
+        collection_name: str,
+        source_collection: Optional[str],
+        file_hashes: Dict[str, str],
+        changed_files: List[str],
+        unchanged_files: List[str],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        """Index documents into a collection with chunking
+
+        Points of unchanged files are copied from the source collection, changed
+        files are extracted and split again and only chunks with new content are embedded.
+        """
+        # Copy points of unchanged files, with document fields of the current configuration
+        for filename in unchanged_files:
+            points = [
+                PointStruct(
+                    id=record.id,
+                    vector=self._point_vector(full_vector(record.vector)),
+                    payload=dict(record.payload, **self._document_fields(filename, record.payload["text"])),
+                )
+                for record in self._scroll_file_points(source_collection, filename)
+            ]
+            print(f"Copying {len(points)} chunks of {filename}...")
+            self._upsert_points(collection_name, points)
+        
+        # Extract and split changed documents first, so chunks can be embedded in batches
+        points = []
+        chunks = []
+        failed_files = set()
+        faq_entries = {}
+        print(f"Indexing {len(changed_files)} PDF files...")
+        documents = self.pdf_extractor.iter_documents({
+            filename: (os.path.join(self.config.CORPUS_PATH, filename), file_hashes[filename])
+            for filename in changed_files
+        })
+        for filename, pages in documents:
             print(f"Processing {filename}...")
-            # Extract text
-            full_text = self._extract_text_from_pdf(file_path)
-            if not full_text.strip():
+            # Pages are split as soon as they are extracted, chunks keep their page and section
+            try:
+                if self._is_faq_file(filename):
+                    # FAQ documents are short, their pages are kept to extract question and answer pairs
+                    pages = list(pages)
+                    faq_entries[filename] = extract_faq_entries(pages)
+                file_chunks = list(chunk_pages(pages, self.text_splitter, self.config.TEXT_SPLITTER_CHUNK_SIZE * 8))
+            except Exception as e:
+                print(f"Error extracting text from {filename}: {e}")
+                failed_files.add(filename)
+                continue
+            if not file_chunks:
                 print(f"Skipping {filename} because it is empty")
+
+            # Reuse vectors of chunks whose content did not change
+            stored_vectors = self._get_stored_vectors(source_collection, filename) if source_collection else {}
+            content_hashes = [hashlib.md5(chunk["text"].encode("utf-8")).hexdigest() for chunk in file_chunks]
+            # Only new chunks are counted, reused chunks keep their stored count
+            new_indexes = [idx for idx, content_hash in enumerate(content_hashes) if content_hash not in stored_vectors]
+            token_counts = {
+                idx: stored_vectors[content_hash][1]
+                for idx, content_hash in enumerate(content_hashes) if content_hash in stored_vectors
+            }
+            token_counts.update(zip(new_indexes, self._count_tokens([file_chunks[idx]["text"] for idx in new_indexes])))
+            for chunk_idx, chunk in enumerate(file_chunks):
+                content_hash = content_hashes[chunk_idx]
+                point_id = self._chunk_point_id(filename, chunk_idx, content_hash)
+                payload = {
+                    "filename": filename, 
+                    "chunk_index": chunk_idx, 
+                    "total_chunks": len(file_chunks), 
+                    "text": chunk["text"], 
+                    "text_length": len(chunk["text"]),
+                    "token_count": token_counts[chunk_idx],
+                    "page": chunk["page"],
+                    "page_end": chunk["page_end"],
+                    "section": chunk["section"],
+                    "file_hash": file_hashes[filename],
+                    "content_hash": content_hash,
+                    **self._document_fields(filename, chunk["text"]),
+                }
+                if content_hash in stored_vectors:
+                    points.append(PointStruct(id=point_id, vector=self._point_vector(stored_vectors[content_hash][0]), payload=payload))
+                else:
+                    chunks.append((point_id, payload))
+        print(f"Reusing {len(points)} unchanged chunks, embedding {len(chunks)} new chunks")
+
+        # Upload reused chunks
+        self._upsert_points(collection_name, points)
+        points = []
+
+        # Create embeddings for new chunks and upload them in batches
+        processed_count = 0
+        start_time = time.perf_counter()
+        embeddings = self._embed_texts([payload["text"] for _, payload in chunks])
+        for idx, embedding in embeddings:
+            point_id, payload = chunks[idx]
+            processed_count += 1
+            if progress_callback is not None:
+                progress_callback(processed_count, len(chunks))
+            if embedding is None:
+                print(f"Failed to embed {payload['filename']} chunk {payload['chunk_index']}")
+                failed_files.add(payload["filename"])
                 continue
+            points.append(PointStruct(id=point_id, vector=self._point_vector(embedding), payload=payload))
 
-            # Split into chunks
-            chunks = self.text_splitter.split_text(full_text)
-            # Create embeddings for each chunk
-            for chunk_idx, chunk in enumerate(chunks):
-                # Get embedding
-                embedding = self._get_embedding(chunk)
-                if embedding is None:
-                    continue
-                # Create point
-                points.append(PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload={
-                        "filename": filename, 
-                        "chunk_index": chunk_idx, 
-                        "total_chunks": len(chunks), 
-                        "text": chunk, 
-                        "text_length": len(chunk)
-                    }
-                ))
-                point_id += 1
-
-                # Upload in batches of 100
-                if len(points) >= 100:
-                    self.qdrant_client.upsert(
-                        collection_name=self.collection_name, 
-                        points=points
-                    )
-                    print(f"Uploaded {len(points)} points")
-                    points = []
+            if len(points) >= self.config.QDRANT_UPSERT_BATCH_SIZE:
+                self._upsert_points(collection_name, points)
+                points = []
         # Upload remaining points
-        if points:
-            self.qdrant_client.upsert(
-                collection_name=self.collection_name,
-                points=points
-            )
+        self._upsert_points(collection_name, points)
+
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        print(f"Embedded and uploaded {len(chunks)} chunks in {elapsed:.1f}s ({len(chunks) / elapsed:.1f} chunks/s)")
+
+        if self.faq_index is not None:
+            unchanged_faq_files = [filename for filename in unchanged_files if self._is_faq_file(filename)]
+            self._index_faq_entries(collection_name, source_collection, file_hashes, faq_entries, unchanged_faq_files)
+
+        # Files with missing chunks are left out of the manifest, so the next indexing processes them again
+        files = {filename: file_hash for filename, file_hash in file_hashes.items() if filename not in failed_files}
         
-        # Update corpus hash in collection metadata
-        metadata_point = PointStruct(
-            id=0,
-            vector=[0.0] * self.config.EMBEDDING_DIM, # Dummy vector
-            payload={
-                "type": "metadata",
-                "corpus_hash": corpus_hash,
-                "indexed_at": str(datetime.now())
-            }
-        )
-        self.qdrant_client.upsert(
-            collection_name=self.collection_name,
-            points=[metadata_point]
-        )
+        # Update corpus hash and file manifest in collection metadata
+        self._store_metadata(collection_name, {
+            "corpus_hash": self._calculate_corpus_hash(files),
+            "files": files,
+            "storage_profile": self.storage_profile_signature,
+            # Searches of every process follow the vector layout of the served collection
+            "coarse_dim": self.storage_profile.get("coarse_dim"),
+            "faq_index": self.faq_index is not None,
+            "indexed_at": str(datetime.now())
+        })
 
-        total_count = self.qdrant_client.count(self.collection_name).count
+        total_count = self.qdrant_client.count(collection_name).count
         print(f"Indexed {total_count} chunks")
 
-    def search_relevant_chunks(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Search top-k relevant chunks from vector database"""
+    def _index_faq_entries(
+        self,
+        collection_name: str,
+        source_collection: Optional[str],
+        file_hashes: Dict[str, str],
+        faq_entries: Dict[str, List[Dict]],
+        unchanged_files: List[str],
+    ):
+        """Index question and answer pairs of FAQ documents for a collection version
+
+        Pairs of unchanged files are extracted again from the extraction cache, vectors of
+        questions already indexed in the source version are reused.
+        """
+        documents = self.pdf_extractor.iter_documents({
+            filename: (os.path.join(self.config.CORPUS_PATH, filename), file_hashes[filename])
+            for filename in unchanged_files
+        })
+        for filename, pages in documents:
+            try:
+                faq_entries[filename] = extract_faq_entries(pages)
+            except Exception as e:
+                print(f"Error extracting FAQ entries from {filename}: {e}")
+
+        stored_vectors = self.faq_index.stored_vectors(source_collection) if source_collection else {}
+        for filename, entries in faq_entries.items():
+            if not entries:
+                print(f"No question and answer pairs found in {filename}")
+                continue
+            vectors = [stored_vectors.get(entry["question"]) for entry in entries]
+            missing = [idx for idx, vector in enumerate(vectors) if vector is None]
+            for idx, embedding in self._embed_texts([entries[missing_idx]["question"] for missing_idx in missing]):
+                vectors[missing[idx]] = embedding
+            embedded = [(entry, vector) for entry, vector in zip(entries, vectors) if vector is not None]
+            if len(embedded) < len(entries):
+                print(f"Failed to embed {len(entries) - len(embedded)} FAQ questions of {filename}")
+            language = detect_language(" ".join(entry["question"] + " " + entry["answer"] for entry in entries))
+            if embedded:
+                self.faq_index.add(
+                    collection_name, filename, [entry for entry, _ in embedded], [vector for _, vector in embedded], language
+                )
+            print(f"Indexed {len(embedded)} FAQ answers of {filename}")
+
+    def _build_lexical_index(self, collection_name: str) -> BM25Index:
+        """Build BM25 index over chunk texts of a collection and save it, with the payload fields searches filter by"""
+        point_ids = []
+        texts = []
+        fields = {"filename": [], "doc_type": [], "language": [], "page": [], "page_end": []}
+        offset = None
+        while True:
+            records, offset = self.qdrant_client.scroll(
+                collection_name=collection_name,
+                limit=self.config.QDRANT_UPSERT_BATCH_SIZE,
+                offset=offset,
+                with_payload=["text", *fields],
+                with_vectors=False,
+            )
+            for record in records:
+                # Metadata point of collections indexed before it moved out of them has no text
+                if record.payload and "text" in record.payload:
+                    point_ids.append(str(record.id))
+                    texts.append(record.payload["text"])
+                    for name, values in fields.items():
+                        # Pages are 0 when unknown
+                        values.append(record.payload.get(name) or (0 if name.startswith("page") else ""))
+            if offset is None:
+                break
+
+        lexical_index = BM25Index.build(point_ids, texts, k1=self.config.BM25_K1, b=self.config.BM25_B, fields=fields)
+        os.makedirs(self.config.LEXICAL_INDEX_DIR, exist_ok=True)
+        lexical_index.save(os.path.join(self.config.LEXICAL_INDEX_DIR, collection_name))
+        print(f"Built lexical index of {len(point_ids)} chunks with {len(lexical_index.vocabulary)} terms")
+        return lexical_index
+
+    def _get_lexical_index(self) -> Optional[BM25Index]:
+        """Get BM25 index of the served collection, load it or build it when it is missing"""
+        self._refresh_served_index()
+        live_collection = self._live_collection
+        if live_collection is None:
+            return None
+        with self._lexical_index_lock:
+            if self._lexical_index_collection != live_collection:
+                index_path = os.path.join(self.config.LEXICAL_INDEX_DIR, live_collection)
+                if os.path.isdir(index_path):
+                    self._lexical_index = BM25Index.load(index_path)
+                else:
+                    # Index was built on another host or before hybrid retrieval was enabled
+                    self._lexical_index = self._build_lexical_index(live_collection)
+                self._lexical_index_collection = live_collection
+            return self._lexical_index
+
+    def _format_chunk(self, point, score: float) -> Dict:
+        """Format a search result as chunk"""
+        return {
+            "id": str(point.id),
+            "text": point.payload["text"],
+            "filename": point.payload["filename"],
+            "score": score,
+            # Cosine score of vector search, chunks found only by lexical search have none
+            "vector_score": getattr(point, "score", None),
+            "chunk_index": point.payload["chunk_index"],
+            "token_count": point.payload.get("token_count"),
+            "page": point.payload.get("page"),
+            "section": point.payload.get("section"),
+        }
+
+    def _fuse_rankings(
+        self, query: str, dense_points: List[models.ScoredPoint], top_k: int, filters: Optional[Dict] = None
+    ) -> Tuple[List[Tuple[str, float]], List[str]]:
+        """Fuse dense and lexical rankings with reciprocal rank fusion
+
+        Returns fused (point id, score) pairs and ids of the chunks found only by
+        lexical search, whose payloads still have to be retrieved.
+        """
+        lexical_index = self._get_lexical_index()
+        with timed_stage("lexical_search"):
+            lexical_hits = []
+            if lexical_index:
+                mask = filter_mask(lexical_index.fields, filters)
+                lexical_hits = lexical_index.search(query, self.config.HYBRID_CANDIDATES, mask)
+        fused = reciprocal_rank_fusion(
+            [[str(point.id) for point in dense_points], [point_id for point_id, _ in lexical_hits]],
+            k=self.config.RRF_K,
+        )[:top_k]
+        dense_ids = {str(point.id) for point in dense_points}
+        return fused, [point_id for point_id, _ in fused if point_id not in dense_ids]
+
+    def _candidate_count(self, top_k: int) -> int:
+        """Number of chunks searched, a larger pool when it is reranked"""
+        return max(top_k, self.config.RERANK_CANDIDATES) if self.reranker is not None else top_k
+
+    def _dense_query(self, query_embedding: List[float], filters: Optional[Dict], limit: int) -> Dict:
+        """Arguments of the vector search in the served collection, in two stages when it is tiered"""
+        self._refresh_served_index()
+        return create_query(
+            query_embedding,
+            limit,
+            query_filter=build_search_filter(filters),
+            search_params=self.search_params,
+            coarse_dim=self._served_coarse_dim,
+            prefetch_oversampling=self.storage_profile.get("prefetch_oversampling", 4.0),
+        )
+
+    def _with_vectors(self):
+        """Vectors returned by searches, full vectors of the pool are compared with each other when reranking"""
+        if self.reranker is None:
+            return False
+        return [FULL_VECTOR] if self._served_coarse_dim else True
+
+    def _route_query(self, query: str, filters: Optional[Dict]) -> Optional[Dict]:
+        """Filters of the documents the query router picks for a search without filters, None when it is not routed"""
+        if filters is not None or self.query_router is None:
+            return None
+        self._refresh_served_index()
+        if not self._served_document_fields:
+            return None
+        return self.query_router.route(query)
+
+    def _is_weak_route(self, chunks: List[Dict]) -> bool:
+        """Whether chunks of a routed search are too weak to trust the route, then every document is searched"""
+        # Chunks found only by lexical search have no vector score
+        return not any((chunk.get("vector_score") or 0.0) >= self.config.QUERY_ROUTER_MIN_SCORE for chunk in chunks)
+
+    def _select_chunks(
+        self, query: str, query_embedding: List[float], scored_points: List[Tuple], top_k: int, filters: Optional[Dict] = None
+    ) -> List[Dict]:
+        """Format best (point, score) pairs as chunks, the pool is reranked when reranking is enabled"""
+        # Collections indexed before metadata moved out of them still hold the metadata point, and
+        # chunks found by a lexical index without payload fields are not filtered yet
+        scored_points = [
+            (point, score) for point, score in scored_points
+            if point.payload.get("type") != "metadata" and matches_filters(point.payload, filters)
+        ]
+        chunks = [self._format_chunk(point, score) for point, score in scored_points]
+        if self.reranker is None:
+            return chunks[:top_k]
+        with timed_stage("rerank"):
+            vectors = [full_vector(getattr(point, "vector", None)) for point, _ in scored_points]
+            return self.reranker.rerank(query, query_embedding, chunks, vectors, top_k)
+
+    def search_relevant_chunks(
+        self, query: str, top_k: int = 5, filters: Optional[Dict] = None, query_embedding: Optional[List[float]] = None
+    ) -> List[Dict]:
+        """Search top-k relevant chunks from vector database, fused with lexical search in hybrid mode
+
+        Filters scope the search by "filename", "doc_type", "language" (a value or a list
+        of values) and pages ("page_from", "page_to"). Without filters, the query router
+        may search the documents the query is about first. Query embedding is computed
+        when it is not given.
+        """
+        filters = validate_filters(filters)
+        routed_filters = self._route_query(query, filters)
+        if routed_filters is None:
+            return self._search_chunks(query, top_k, filters, query_embedding)
+        query_embedding = query_embedding or self._get_embedding(query)
+        if query_embedding is None:
+            return []
+        chunks = self._search_chunks(query, top_k, routed_filters, query_embedding)
+        if not self._is_weak_route(chunks):
+            return chunks
+        return self._search_chunks(query, top_k, None, query_embedding)
+
+    def _search_chunks(
+        self, query: str, top_k: int, filters: Optional[Dict], query_embedding: Optional[List[float]]
+    ) -> List[Dict]:
+        """Search top-k relevant chunks with validated filters"""
         try:
             # Get query embedding
-            query_embedding = self._get_embedding(query)
+            query_embedding = query_embedding or self._get_embedding(query)
             if query_embedding is None:
                 return []
+
+            hybrid = self.config.RETRIEVAL_MODE == "hybrid"
+            candidates = self._candidate_count(top_k)
+            dense_query = self._dense_query(query_embedding, filters, max(candidates, self.config.HYBRID_CANDIDATES) if hybrid else candidates)
+            with_vectors = self._with_vectors()
             
             # Search
-            search_results = self.qdrant_client.query_points(
-                collection_name=self.collection_name,
-                query=query_embedding,
-                limit=top_k,
-                with_payload=True,
-            )
+            with timed_stage("search"):
+                search_results = self.qdrant_client.query_points(
+                    collection_name=self.collection_name,
+                    with_payload=True,
+                    with_vectors=with_vectors,
+                    **dense_query,
+                )
+            if not hybrid:
+                # Format results
+                return self._select_chunks(
+                    query, query_embedding, [(point, point.score) for point in search_results.points], top_k, filters
+                )
 
-            # Format results
-            chunks = []
-            for result in search_results.points:
-                chunks.append({
-                    "text": result.payload["text"],
-                    "filename": result.payload["filename"],
-                    "score": result.score,
-                    "chunk_index": result.payload["chunk_index"],
-                })
-            return chunks
+            fused, missing_ids = self._fuse_rankings(query, search_results.points, candidates, filters)
+            points = {str(point.id): point for point in search_results.points}
+            if missing_ids:
+                with timed_stage("search"):
+                    records = self.qdrant_client.retrieve(
+                        collection_name=self.collection_name, ids=missing_ids, with_vectors=with_vectors
+                    )
+                for record in records:
+                    points[str(record.id)] = record
+            scored_points = [(points[point_id], score) for point_id, score in fused if point_id in points]
+            return self._select_chunks(query, query_embedding, scored_points, top_k, filters)
         except Exception as e:
             print(f"Error searching relevant chunks: {e}")
+            # Another process may have swapped in a collection of another vector layout
+            self._served_index_checked_at = 0.0
             return []
+
+    def search_relevant_chunks_batch(
+        self, queries: List[str], top_k: int = 5, filters: Optional[List[Optional[Dict]]] = None
+    ) -> Tuple[List[Optional[List[float]]], List[List[Dict]]]:
+        """Search top-k relevant chunks of many queries, embedded together and searched in one Qdrant request
+
+        Each query may have its own filters, like search_relevant_chunks. Returns embeddings
+        of the queries and their chunks, queries which could not be embedded have no
+        embedding and no chunks.
+        """
+        filters = [validate_filters(query_filters) for query_filters in filters or [None] * len(queries)]
+        routed_filters = [self._route_query(query, query_filters) for query, query_filters in zip(queries, filters)]
+        embeddings, results = self._search_chunks_batch(
+            queries, top_k, [routed or query_filters for routed, query_filters in zip(routed_filters, filters)]
+        )
+        # Routed searches with weak chunks are run again in every document
+        for idx, routed in enumerate(routed_filters):
+            if routed is not None and embeddings[idx] is not None and self._is_weak_route(results[idx]):
+                results[idx] = self._search_chunks(queries[idx], top_k, None, embeddings[idx])
+        return embeddings, results
+
+    def _search_chunks_batch(
+        self, queries: List[str], top_k: int, filters: List[Optional[Dict]]
+    ) -> Tuple[List[Optional[List[float]]], List[List[Dict]]]:
+        """Search top-k relevant chunks of many queries with validated filters in one Qdrant request"""
+        embeddings = [None] * len(queries)
+        with timed_stage("embed"):
+            for idx, embedding in self._embed_texts(queries):
+                embeddings[idx] = embedding
+        searched = [idx for idx, embedding in enumerate(embeddings) if embedding is not None]
+        results = [[] for _ in queries]
+        if not searched:
+            return embeddings, results
+
+        hybrid = self.config.RETRIEVAL_MODE == "hybrid"
+        candidates = self._candidate_count(top_k)
+        dense_queries = [
+            self._dense_query(embeddings[idx], filters[idx], max(candidates, self.config.HYBRID_CANDIDATES) if hybrid else candidates)
+            for idx in searched
+        ]
+        with_vectors = self._with_vectors()
+
+        with timed_stage("search"):
+            responses = self.qdrant_client.query_batch_points(
+                collection_name=self.collection_name,
+                requests=[
+                    models.QueryRequest(
+                        query=dense_query["query"],
+                        using=dense_query.get("using"),
+                        prefetch=dense_query.get("prefetch"),
+                        filter=dense_query["query_filter"],
+                        limit=dense_query["limit"],
+                        params=dense_query.get("search_params"),
+                        with_payload=True,
+                        with_vector=with_vectors,
+                    )
+                    for dense_query in dense_queries
+                ],
+            )
+        if not hybrid:
+            for idx, response in zip(searched, responses):
+                scored_points = [(point, point.score) for point in response.points]
+                results[idx] = self._select_chunks(queries[idx], embeddings[idx], scored_points, top_k, filters[idx])
+            return embeddings, results
+
+        # Chunks found only by lexical search are retrieved in one request for every query
+        fused_rankings = []
+        missing_ids = set()
+        for idx, response in zip(searched, responses):
+            fused, missing = self._fuse_rankings(queries[idx], response.points, candidates, filters[idx])
+            fused_rankings.append(fused)
+            missing_ids.update(missing)
+        records = {}
+        if missing_ids:
+            with timed_stage("search"):
+                for record in self.qdrant_client.retrieve(
+                    collection_name=self.collection_name, ids=list(missing_ids), with_vectors=with_vectors
+                ):
+                    records[str(record.id)] = record
+        for idx, response, fused in zip(searched, responses, fused_rankings):
+            # Scored points of the query itself, their vector score is the one of this query
+            points = dict(records, **{str(point.id): point for point in response.points})
+            scored_points = [(points[point_id], score) for point_id, score in fused if point_id in points]
+            results[idx] = self._select_chunks(queries[idx], embeddings[idx], scored_points, top_k, filters[idx])
+        return embeddings, results
+
+    def _generation_config(self) -> Dict:
+        """Get generation config with system instruction of the assistant"""
+        return {
+            "system_instruction": self.config.SYSTEM_PROMPT,
+            "temperature": self.config.MODEL_TEMPERATURE,
+            "top_p": self.config.MODEL_TOP_P,
+            "top_k": self.config.MODEL_TOP_K,
+            "max_output_tokens": self.config.MODEL_MAX_OUTPUT_TOKENS,
+        }
+
+    def _build_generation(self, prompt: str, relevant_chunks: List[Dict], question_embedding: Optional[List[float]]) -> Dict:
+        """Build full generation prompt from relevant chunks"""
+        # 2. Build context from relevant chunks, merged and packed into the token budget
+        built_context = self.context_builder.build(relevant_chunks)
+        record_context_tokens(
+            built_context["tokens"], built_context["saved_tokens"],
+            built_context["dropped_tokens"], built_context["over_budget_tokens"],
+        )
+        context = built_context["context"]
         
-    def generate_response(self, prompt: str) -> str:
-        """Generate response with RAG from vector database"""
-        system_instruction = """
-            Bạn là trợ lý ảo của TechShop, một nền tảng thương mại điện tử.
-
-            NHIỆM VỤ CHÍNH:
-            - Trả lời câu hỏi của khách hàng DỰA TRÊN các tài liệu hướng dẫn, FAQ và troubleshooting được cung cấp trong Context
-            - Ưu tiên thông tin từ Context, KHÔNG sử dụng kiến thức chung
-            - Nếu Context không có thông tin liên quan, hãy trả lời: "Xin lỗi, tôi không tìm thấy thông tin này. Vui lòng liên hệ support@techshop.com"
-
-            PHONG CÁCH:
-            - Thân thiện, chuyên nghiệp
-            - Câu trả lời ngắn gọn, rõ ràng (2-3 đoạn văn)
-            - Sử dụng bullet points khi liệt kê nhiều mục
-            - Luôn kết thúc với câu hỏi "Bạn còn thắc mắc gì khác không?"
-
-            QUY TẮC QUAN TRỌNG:
-            - CHỈ trả lời dựa trên thông tin trong Context
-            - KHÔNG bịa đặt hoặc suy đoán thông tin
-            - Nếu không chắc chắn, hãy thừa nhận và đề nghị liên hệ support
+        # 3. Build full prompt
+        full_prompt = f"""
+            Context từ tài liệu {self.config.BRAND_NAME}:
+
+            {context}
+
+            ---
+
+            Câu hỏi của khách hàng: {prompt}
+
+            Trả lời dựa trên Context phía trên:
+        """
+        return {
+            "full_prompt": full_prompt,
+            "question_embedding": question_embedding,
+            "chunk_ids": [chunk["id"] for chunk in relevant_chunks],
+            "passages": built_context["passages"],
+        }
+
+    def build_conversation_prompt(self, question: str, history: Optional[List[Dict]] = None, summary: str = "") -> str:
+        """Create prompt of the latest question with recent messages and summary of the conversation"""
+        # Create context from chat history
+        context_parts = []
+        if summary:
+            context_parts.append(f"Tóm tắt hội thoại trước đó: {summary}")
+        for message in history or []:
+            role_name = "Khách hàng" if message["role"] == "user" else "Trợ lý"
+            context_parts.append(f"{role_name}: {message['text']}")
+        context = "\n".join(context_parts)
+
+        # Create prompt with context
+        if context:
+            return f"""
+            Lịch sử hội thoại gần đây:
+            {context}
+            Câu hỏi mới nhất: {question}
+        """
+        return question
+
+    def _faq_answer(self, query: str, query_embedding: Optional[List[float]]) -> Optional[str]:
+        """Answer of the FAQ entry matching a standalone query, None when no entry is close enough"""
+        if self.faq_index is None or query_embedding is None:
+            return None
+        self._refresh_served_index()
+        if self._live_collection is None:
+            return None
+        with timed_stage("faq"):
+            entry = self.faq_index.lookup(query_embedding, self._live_collection, detect_language(query))
+        if entry is None:
+            return None
+        return self.config.FAQ_ANSWER_TEMPLATE.format(**entry)
+
+    def _prepare_generation(self, prompt: str, question: str, history: Optional[List[Dict]]) -> Dict:
+        """Search relevant chunks and build the generation prompt
+
+        Chunks are searched with a standalone query of the question, the full history
+        only goes to generation. Returns {"answer": ...} when no generation is needed
+        (FAQ answer, no relevant chunks or cached answer), otherwise the full prompt and
+        semantic response cache keys.
         """
+        started_at = time.perf_counter()
+        retrieval_query = self.query_rewriter.rewrite(prompt, question, history)
+        query_embedding = self._get_embedding(retrieval_query)
+
+        # Questions of the FAQ are answered from it
+        faq_answer = self._faq_answer(retrieval_query, query_embedding)
+        if faq_answer is not None:
+            self.faq_index.record_answer(time.perf_counter() - started_at, from_index=True)
+            return {"answer": faq_answer}
+
+        # 1. Search relevant chunks
+        relevant_chunks = self.search_relevant_chunks(
+            retrieval_query,
+            top_k=self.config.TOP_K_SEARCH_RELEVANT_CHUNKS,
+            query_embedding=query_embedding,
+        )
         
-        try:
-            # 1. Search relevant chunks
-            relevant_chunks = self.search_relevant_chunks(
-                prompt,
-                top_k=self.config.TOP_K_SEARCH_RELEVANT_CHUNKS
+        return dict(self._generation_from_chunks(prompt, question, relevant_chunks), started_at=started_at)
+
+    def _generation_from_chunks(
+        self, prompt: str, question: str, relevant_chunks: List[Dict], question_embedding: Optional[List[float]] = None
+    ) -> Dict:
+        """Build the generation prompt of relevant chunks, or {"answer": ...} when no generation is needed
+
+        Question embedding is only used by the semantic response cache, it is computed
+        when it is not given.
+        """
+        if not relevant_chunks:
+            return {"answer": self.config.NO_RELEVANT_CHUNKS_ANSWER}
+
+        # Reuse answer of a similar question with the same relevant chunks
+        cache_embedding = None
+        if self.response_cache is not None:
+            cache_embedding = question_embedding or self._get_embedding(question)
+            if cache_embedding is not None:
+                chunk_ids = [chunk["id"] for chunk in relevant_chunks]
+                with timed_stage("response_cache"):
+                    cached_answer = self.response_cache.get(cache_embedding, chunk_ids, self.corpus_hash)
+                if cached_answer is not None:
+                    return {"answer": cached_answer}
+
+        with timed_stage("prompt_build"):
+            return self._build_generation(prompt, relevant_chunks, cache_embedding)
+
+    def _cache_response(self, question: str, generation: Dict, answer: str):
+        """Store generated answer in semantic response cache, and its latency for FAQ index stats"""
+        if self.faq_index is not None and "started_at" in generation:
+            self.faq_index.record_answer(time.perf_counter() - generation["started_at"], from_index=False)
+        if generation["question_embedding"] is not None and answer:
+            self.response_cache.set(
+                question, generation["question_embedding"], generation["chunk_ids"], self.corpus_hash, answer
             )
-            
-            if not relevant_chunks:
-                return "Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau hoặc liên hệ support@techshop.com"
-            
-            # 2. Build context from relevant chunks
-            context_parts = []
-            for idx, chunk in enumerate(relevant_chunks, 1):
-                context_parts.append(
-                    f"[Document {idx} - {chunk['filename']}]\n{chunk['text']}"
-                )
-            
-            context = "\n\n---\n\n".join(context_parts)
-            
-            # 3. Build full prompt
-            full_prompt = f"""
-                Context từ tài liệu TechShop:
 
-                {context}
+    def _retrieval_only_answer(self, generation: Dict, error: GeminiUnavailableError) -> str:
+        """Answer with excerpts of the best passages when no model can answer"""
+        if not self.config.GEMINI_RETRIEVAL_ONLY_FALLBACK:
+            raise error
+        print(f"Answering with document excerpts: {error}")
+        record_gemini_request(self.model_name, "retrieval_only")
 
-                ---
+        max_chars = self.config.GEMINI_RETRIEVAL_ONLY_EXCERPT_CHARS
+        excerpts = []
+        for passage in generation["passages"][:self.config.GEMINI_RETRIEVAL_ONLY_PASSAGES]:
+            text = re.sub(r"\s+", " ", passage["text"]).strip()
+            if len(text) > max_chars:
+                text = text[:max_chars].rsplit(" ", 1)[0] + "..."
+            page = f", trang {passage['page']}" if passage.get("page") else ""
+            excerpts.append(f"- **{passage['filename']}{page}**: {text}")
+        return "\n".join([RETRIEVAL_ONLY_ANSWER_HEADER, ""] + excerpts)
 
-                Câu hỏi của khách hàng: {prompt}
+    def _raise_generation_error(self, e: Exception):
+        """Log generation error and raise an error with user facing message"""
+        error_type = type(e).__name__
+        error_msg = str(e)
+        
+        print(f"Generation error: {error_type} - {error_msg}")
+        
+        # Handle specific errors
+        if "quota" in error_msg.lower() or "429" in error_msg:
+            raise Exception("API quota exceeded. Please try again later.")
+        elif "timeout" in error_msg.lower():
+            raise Exception("Request timeout. Please try again.")
+        else:
+            raise Exception(f"API error: {error_type}")
 
-                Trả lời dựa trên Context phía trên:
-            """
-            
-            # 4. Generate response
+    def summarize_conversation(self, summary: str, messages: List[Dict]) -> str:
+        """Fold messages into the rolling summary of a conversation"""
+        transcript = "\n".join(
+            f"{'Khách hàng' if message['role'] == 'user' else 'Trợ lý'}: {message['text']}" for message in messages
+        )
+        prompt = f"""
+            Tóm tắt trước đó:
+            {summary or "(chưa có)"}
+
+            Tin nhắn mới:
+            {transcript}
+
+            Viết lại tóm tắt ngắn gọn của cuộc hội thoại, giữ lại nhu cầu của khách hàng, sản phẩm,
+            mã đơn hàng và thông tin đã được trả lời:
+        """
+        with timed_stage("summarize"):
             response = self.genai_client.models.generate_content(
                 model=self.model_name,
-                contents=[{"role": "user", "parts": [{"text": full_prompt}]}],
+                contents=[{"role": "user", "parts": [{"text": prompt}]}],
                 config={
-                    "system_instruction": system_instruction,
-                    "temperature": self.config.MODEL_TEMPERATURE,
-                    "top_p": self.config.MODEL_TOP_P,
-                    "top_k": self.config.MODEL_TOP_K,
-                    "max_output_tokens": self.config.MODEL_MAX_OUTPUT_TOKENS,
+                    "temperature": 0.2,
+                    "max_output_tokens": self.config.CONVERSATION_SUMMARY_MAX_TOKENS,
                 }
             )
-            
-            return response.text
-            
+        record_tokens(self.model_name, response.usage_metadata)
+        return (response.text or "").strip()
+
+    def generate_response(self, prompt: str, question: Optional[str] = None, history: Optional[List[Dict]] = None) -> str:
+        """Generate response with RAG from vector database
+
+        The prompt may contain chat history, question is the latest user message
+        alone and is used as key of the semantic response cache. History is the list
+        of recent {"role", "text"} messages, used to rewrite follow-up questions.
+        """
+        question = question or prompt
+        try:
+            generation = self._prepare_generation(prompt, question, history)
+            return self._complete_generation(question, generation)
         except Exception as e:
-            error_type = type(e).__name__
-            error_msg = str(e)
-            
-            print(f"Generation error: {error_type} - {error_msg}")
-            
-            # Handle specific errors
-            if "quota" in error_msg.lower() or "429" in error_msg:
-                raise Exception("API quota exceeded. Please try again later.")
-            elif "timeout" in error_msg.lower():
-                raise Exception("Request timeout. Please try again.")
-            else:
-                raise Exception(f"API error: {error_type}")
\ No newline at end of file
+            self._raise_generation_error(e)
+
+    def _complete_generation(self, question: str, generation: Dict, retrieval_only: bool = True) -> str:
+        """Generate the answer of a prepared generation
+
+        When no model can answer, the answer is made of document excerpts, or the error
+        is raised when retrieval_only is False.
+        """
+        if "answer" in generation:
+            return generation["answer"]
+
+        # 4. Generate response
+        try:
+            with timed_stage("generate"):
+                response = self.genai_client.models.generate_content(
+                    model=self.model_name,
+                    contents=[{"role": "user", "parts": [{"text": generation["full_prompt"]}]}],
+                    config=self._generation_config()
+                )
+        except GeminiUnavailableError as e:
+            if not retrieval_only:
+                raise
+            return self._retrieval_only_answer(generation, e)
+        record_tokens(self.model_name, response.usage_metadata)
+
+        self._cache_response(question, generation, response.text)
+        return response.text
+
+    def answer_with_chunks(
+        self, question: str, relevant_chunks: List[Dict], question_embedding: Optional[List[float]] = None, retrieval_only: bool = True
+    ) -> str:
+        """Generate answer of a standalone question from chunks searched beforehand, e.g. by batch search"""
+        try:
+            faq_answer = self._faq_answer(question, question_embedding)
+            if faq_answer is not None:
+                return faq_answer
+            generation = self._generation_from_chunks(question, question, relevant_chunks, question_embedding)
+            return self._complete_generation(question, generation, retrieval_only)
+        except Exception as e:
+            self._raise_generation_error(e)
+
+    def generate_response_stream(self, prompt: str, question: Optional[str] = None, history: Optional[List[Dict]] = None) -> Iterator[str]:
+        """Generate response with RAG from vector database, yield text as soon as it is generated"""
+        question = question or prompt
+        try:
+            generation = self._prepare_generation(prompt, question, history)
+            if "answer" in generation:
+                yield generation["answer"]
+                return
+
+            # 4. Generate response with streaming API
+            # Usage metadata comes with the last chunks of the stream
+            answer_parts = []
+            usage_metadata = None
+            start = time.perf_counter()
+            try:
+                with timed_stage("generate"):
+                    for chunk in self.genai_client.models.generate_content_stream(
+                        model=self.model_name,
+                        contents=[{"role": "user", "parts": [{"text": generation["full_prompt"]}]}],
+                        config=self._generation_config()
+                    ):
+                        usage_metadata = chunk.usage_metadata or usage_metadata
+                        if chunk.text:
+                            if not answer_parts:
+                                observe_stage("first_token", time.perf_counter() - start)
+                            answer_parts.append(chunk.text)
+                            yield chunk.text
+            except GeminiUnavailableError as e:
+                # Raised before the first chunk, streams are not retried once they started
+                yield self._retrieval_only_answer(generation, e)
+                return
+            record_tokens(self.model_name, usage_metadata)
+
+            self._cache_response(question, generation, "".join(answer_parts))
+
+        except Exception as e:
+            self._raise_generation_error(e)
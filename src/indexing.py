@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import redis
+import threading
+
+from typing import Dict
+from datetime import datetime
+
+class IndexLock:
+    """Lock which makes sure exactly one process indexes a collection
+
+    Uses Redis when REDIS_URL is set, so every container sharing Qdrant is coordinated,
+    otherwise a file lock shared by the gunicorn workers of this host. One lock is
+    shared by the indexing thread and the readiness probes of the process.
+    """
+    def __init__(self, name: str, lock_dir: str, ttl: int):
+        self.ttl = ttl
+        self._redis_lock = None
+        self._lock_file = None
+        self.lock_path = os.path.join(lock_dir, f"{name}.lock")
+        # Probes of this process must not hold the file lock while indexing tries to take it
+        self._thread_lock = threading.Lock()
+
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            redis_client = redis.Redis.from_url(redis_url)
+            # The lock is refreshed by the heartbeat thread, not only by the thread which took it
+            self._redis_lock = redis_client.lock(
+                f"index_lock:{name}", timeout=ttl, blocking=False, thread_local=False
+            )
+        else:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def acquire(self) -> bool:
+        """Try to acquire the lock without waiting"""
+        if self._redis_lock is not None:
+            return self._redis_lock.acquire(blocking=False)
+
+        with self._thread_lock:
+            if self._lock_file is not None:
+                return False
+            lock_file = open(self.lock_path, "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            return True
+
+    def refresh(self):
+        """Extend the lock expiration while indexing is still running"""
+        if self._redis_lock is not None:
+            self._redis_lock.reacquire()
+
+    def keep_alive(self) -> threading.Event:
+        """Refresh the lock from a heartbeat thread until the returned event is set
+
+        Indexing holds the lock while it extracts, counts and uploads, not only while
+        it reports embedding progress.
+        """
+        stopped = threading.Event()
+        def heartbeat():
+            while not stopped.wait(self.ttl / 3):
+                try:
+                    self.refresh()
+                except redis.exceptions.RedisError as e:
+                    print(f"Error refreshing index lock: {e}")
+        if self._redis_lock is not None:
+            threading.Thread(target=heartbeat, name="index-lock-heartbeat", daemon=True).start()
+        return stopped
+
+    def release(self):
+        """Release the lock"""
+        if self._redis_lock is not None:
+            try:
+                self._redis_lock.release()
+            except redis.exceptions.LockError:
+                print("Index lock expired before it was released")
+        else:
+            with self._thread_lock:
+                if self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def is_locked(self) -> bool:
+        """Check if any process holds the lock"""
+        if self._redis_lock is not None:
+            return self._redis_lock.locked()
+        with self._thread_lock:
+            if self._lock_file is not None:
+                return True
+            with open(self.lock_path, "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return True
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+class IndexStatus:
+    """Progress of the indexing job, shared by all workers
+
+    Stored in a Redis hash when REDIS_URL is set, otherwise in a JSON file.
+    """
+    def __init__(self, name: str, status_dir: str):
+        self.redis_client = None
+        self.key = f"index_status:{name}"
+        self.status_path = os.path.join(status_dir, f"{name}.json")
+
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            self.redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
+        else:
+            os.makedirs(status_dir, exist_ok=True)
+
+    def get(self) -> Dict:
+        """Get current status"""
+        try:
+            if self.redis_client is not None:
+                data = self.redis_client.get(self.key)
+            else:
+                with open(self.status_path, "r", encoding="utf-8") as f:
+                    data = f.read()
+            return json.loads(data) if data else {}
+        except (OSError, ValueError, redis.exceptions.RedisError):
+            return {}
+
+    def update(self, **fields):
+        """Update fields of current status"""
+        status = self.get()
+        status.update(fields)
+        data = json.dumps(status)
+        if self.redis_client is not None:
+            self.redis_client.set(self.key, data)
+        else:
+            # Write to a temporary file first so readers never see a partial file
+            tmp_path = f"{self.status_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.status_path)
+
+# Guards creation of the lock and status of chatbots
+_create_lock = threading.Lock()
+
+def get_index_lock(chatbot) -> IndexLock:
+    """Indexing lock of a chatbot collection, created once so probes reuse its Redis client"""
+    with _create_lock:
+        if chatbot.index_lock is None:
+            chatbot.index_lock = IndexLock(
+                chatbot.collection_name, chatbot.config.INDEX_STATE_DIR, chatbot.config.INDEX_LOCK_TTL
+            )
+        return chatbot.index_lock
+
+def get_index_status(chatbot) -> IndexStatus:
+    """Indexing status of a chatbot collection, created once so probes reuse its Redis client"""
+    with _create_lock:
+        if chatbot.index_status is None:
+            chatbot.index_status = IndexStatus(chatbot.collection_name, chatbot.config.INDEX_STATE_DIR)
+        return chatbot.index_status
+
+def get_index_state(chatbot) -> Dict:
+    """Get state of the served index, with progress when a process is indexing"""
+    lock = get_index_lock(chatbot)
+    status = get_index_status(chatbot).get()
+
+    state = chatbot.get_index_state()
+    # Status of a process which stopped while indexing is ignored, its lock is released
+    if status.get("state") == "indexing" and lock.is_locked():
+        state["state"] = "indexing"
+        state["progress"] = {
+            "embedded_chunks": status.get("embedded_chunks", 0),
+            "total_chunks": status.get("total_chunks", 0),
+            "started_at": status.get("started_at"),
+        }
+    elif status.get("state") == "failed":
+        state["last_error"] = status.get("error")
+    return state
+
+def run_indexing(chatbot) -> bool:
+    """Index the corpus if no other process is indexing it, returns False when indexing did not run"""
+    lock = get_index_lock(chatbot)
+    if not lock.acquire():
+        print("Another process is indexing the corpus")
+        return False
+
+    status = get_index_status(chatbot)
+    heartbeat = lock.keep_alive()
+    try:
+        status.update(state="indexing", embedded_chunks=0, total_chunks=0, started_at=str(datetime.now()), error=None)
+
+        # Report progress at most once per second
+        last_update = [0.0]
+        def report_progress(embedded_chunks: int, total_chunks: int):
+            now = time.time()
+            if now - last_update[0] >= 1 or embedded_chunks == total_chunks:
+                last_update[0] = now
+                status.update(embedded_chunks=embedded_chunks, total_chunks=total_chunks)
+
+        chatbot.index_corpus(progress_callback=report_progress)
+        status.update(state="idle", finished_at=str(datetime.now()))
+        return True
+    except Exception as e:
+        print(f"Error indexing corpus: {e}")
+        status.update(state="failed", error=str(e), finished_at=str(datetime.now()))
+        return False
+    finally:
+        heartbeat.set()
+        lock.release()
+
+def start_background_indexing(chatbot) -> threading.Thread:
+    """Index the corpus in a background thread, so the app serves requests immediately"""
+    thread = threading.Thread(target=run_indexing, args=(chatbot,), name="corpus-indexing", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    # Index corpus from command line: python -m src.indexing
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from .config import Config
+    from .gemini_rag_model import RAGChatbot
+
+    sys.exit(0 if run_indexing(RAGChatbot(config=Config)) else 1)
@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import math
+import shutil
+import unicodedata
+import numpy as np
+
+from typing import List, Dict, Optional, Tuple
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-_./]\w+)*")
+TOKEN_SEPARATOR_PATTERN = re.compile(r"[-_./]")
+
+def strip_diacritics(text: str) -> str:
+    """Remove Vietnamese diacritics, so queries typed without accents still match"""
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    return text.replace("đ", "d").replace("Đ", "D")
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase terms for lexical search
+
+    Compound tokens like order ids, error codes or SKUs (ERR-1024, TS-5G.128) are kept
+    whole and also split into their parts, accented words also get an accent-free term.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(unicodedata.normalize("NFC", text.lower())):
+        terms.append(token)
+        if TOKEN_SEPARATOR_PATTERN.search(token):
+            terms.extend(part for part in TOKEN_SEPARATOR_PATTERN.split(token) if part)
+        folded = strip_diacritics(token)
+        if folded != token:
+            terms.append(folded)
+    return terms
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fuse ranked id lists, score of an id is the sum of 1 / (k + rank) over the lists"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, 1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+class BM25Index:
+    """Compact BM25 inverted index over chunk texts
+
+    Postings are stored as CSR arrays with precomputed BM25 weights, so a query only
+    sums weights of its terms. Arrays are saved as .npy files and loaded memory-mapped,
+    every worker of the host shares the same pages. Payload fields of the chunks, e.g.
+    their file name, are kept as arrays so searches can be filtered.
+    """
+    def __init__(
+        self, vocabulary: Dict[str, int], point_ids: List[str], offsets: np.ndarray, postings: np.ndarray, weights: np.ndarray,
+        fields: Optional[Dict[str, list]] = None,
+    ):
+        self.vocabulary = vocabulary
+        self.point_ids = point_ids
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        self.fields = {name: np.asarray(values) for name, values in (fields or {}).items()}
+
+    @classmethod
+    def build(
+        cls, point_ids: List[str], texts: List[str], k1: float = 1.2, b: float = 0.75, fields: Optional[Dict[str, list]] = None
+    ) -> "BM25Index":
+        """Build index from chunk texts"""
+        term_frequencies = [Counter(tokenize(text)) for text in texts]
+        doc_lengths = np.array([sum(tf.values()) for tf in term_frequencies], dtype=np.float32)
+        avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) and doc_lengths.mean() > 0 else 1.0
+
+        # Collect postings of each term
+        term_postings = {}
+        for doc_idx, tf in enumerate(term_frequencies):
+            for term, count in tf.items():
+                term_postings.setdefault(term, []).append((doc_idx, count))
+
+        vocabulary = {}
+        offsets = [0]
+        postings = []
+        weights = []
+        doc_count = len(texts)
+        for term in sorted(term_postings):
+            docs = term_postings[term]
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_idx, count in docs:
+                norm = k1 * (1 - b + b * doc_lengths[doc_idx] / avg_doc_length)
+                postings.append(doc_idx)
+                weights.append(idf * count * (k1 + 1) / (count + norm))
+            vocabulary[term] = len(vocabulary)
+            offsets.append(len(postings))
+
+        return cls(
+            vocabulary=vocabulary,
+            point_ids=list(point_ids),
+            offsets=np.array(offsets, dtype=np.int64),
+            postings=np.array(postings, dtype=np.int32),
+            weights=np.array(weights, dtype=np.float32),
+            fields=fields,
+        )
+
+    def search(self, query: str, top_k: int, mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """Search top-k chunks of a query, returns (point id, BM25 score) pairs
+
+        Only chunks set in mask are returned when it is given.
+        """
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+        if not term_ids or not self.point_ids:
+            return []
+
+        scores = np.zeros(len(self.point_ids), dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # A document appears at most once in the postings of a term
+            scores[self.postings[start:end]] += self.weights[start:end]
+        if mask is not None:
+            scores[~mask] = 0.0
+
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        if top_k == 0:
+            return []
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.point_ids[idx], float(scores[idx])) for idx in top]
+
+    def save(self, path: str):
+        """Save index to a folder, the folder is replaced atomically"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, "offsets.npy"), self.offsets)
+        np.save(os.path.join(tmp_path, "postings.npy"), self.postings)
+        np.save(os.path.join(tmp_path, "weights.npy"), self.weights)
+        with open(os.path.join(tmp_path, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "vocabulary": self.vocabulary,
+                "point_ids": self.point_ids,
+                "fields": {name: values.tolist() for name, values in self.fields.items()},
+            }, f, ensure_ascii=False)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another worker saved the same index first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Load index saved in a folder, arrays are memory-mapped"""
+        with open(os.path.join(path, "terms.json"), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+        return cls(
+            vocabulary=terms["vocabulary"],
+            point_ids=terms["point_ids"],
+            offsets=np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+            postings=np.load(os.path.join(path, "postings.npy"), mmap_mode="r"),
+            weights=np.load(os.path.join(path, "weights.npy"), mmap_mode="r"),
+            # Indexes saved before searches could be filtered have no fields
+            fields=terms.get("fields"),
+        )
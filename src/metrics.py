@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import contextvars
+
+from typing import Optional, Tuple
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+# Buckets from 1ms (cache lookups, BM25 search) to 30s (long generations)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_DURATION = Histogram(
+    "techshop_stage_duration_seconds", "Duration of RAG pipeline stages", ["stage"], buckets=DURATION_BUCKETS
+)
+REQUEST_DURATION = Histogram(
+    "techshop_request_duration_seconds", "Duration of HTTP requests, streamed responses until the last event",
+    ["endpoint", "method", "status"], buckets=DURATION_BUCKETS
+)
+GEMINI_TOKENS = Counter("techshop_gemini_tokens", "Tokens counted by Gemini usage metadata", ["model", "kind"])
+GEMINI_REQUESTS = Counter(
+    "techshop_gemini_requests", "Outcomes of Gemini calls: success, fallback, retried, throttled, failed, retrieval_only",
+    ["model", "outcome"]
+)
+CACHE_LOOKUPS = Counter("techshop_cache_lookups", "Lookups of embedding and response caches", ["cache", "result"])
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "techshop_single_flight_requests", "Requests calling upstream (leader) or sharing a call in progress (followers)",
+    ["flight", "role"]
+)
+CONTEXT_TOKENS = Counter(
+    "techshop_context_tokens", "Tokens of generation contexts, and tokens left out by the context builder", ["kind"]
+)
+
+class RequestTrace:
+    """Stage timings, token counts and cache lookups of one request"""
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.cache = {}
+        self.error = None
+
+    def add_stage(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind: str, count: int):
+        self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def add_cache_lookups(self, cache: str, hits: int, misses: int):
+        counts = self.cache.setdefault(cache, {"hits": 0, "misses": 0})
+        counts["hits"] += hits
+        counts["misses"] += misses
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+# Trace of the current request
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+def start_trace() -> RequestTrace:
+    """Start tracing a request in current context"""
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+def current_trace() -> Optional[RequestTrace]:
+    """Get trace of the current request, None outside of requests"""
+    return _current_trace.get()
+
+def clear_trace():
+    """Stop tracing in current context, so a request thread does not keep the trace of its last request"""
+    _current_trace.set(None)
+
+def observe_stage(stage: str, seconds: float):
+    """Record duration of a pipeline stage"""
+    STAGE_DURATION.labels(stage=stage).observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+@contextmanager
+def timed_stage(stage: str):
+    """Time a block of code as a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def record_tokens(model: str, usage_metadata):
+    """Record token counts of a Gemini response"""
+    if usage_metadata is None:
+        return
+    counts = {
+        "prompt": usage_metadata.prompt_token_count,
+        "output": usage_metadata.candidates_token_count,
+        "cached": usage_metadata.cached_content_token_count,
+        "thoughts": usage_metadata.thoughts_token_count,
+    }
+    trace = _current_trace.get()
+    for kind, count in counts.items():
+        if count:
+            GEMINI_TOKENS.labels(model=model, kind=kind).inc(count)
+            if trace is not None:
+                trace.add_tokens(kind, count)
+
+def record_gemini_request(model: str, outcome: str):
+    """Record outcome of a Gemini call attempt"""
+    GEMINI_REQUESTS.labels(model=model, outcome=outcome).inc()
+
+def record_context_tokens(used: int, saved: int, dropped: int = 0, over_budget: int = 0):
+    """Record tokens of a generation context, and tokens saved by deduplicating and merging chunks,
+    dropped under the score floor or left out by the budget"""
+    CONTEXT_TOKENS.labels(kind="used").inc(used)
+    CONTEXT_TOKENS.labels(kind="saved").inc(saved)
+    CONTEXT_TOKENS.labels(kind="dropped").inc(dropped)
+    CONTEXT_TOKENS.labels(kind="over_budget").inc(over_budget)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_tokens("context", used)
+        trace.add_tokens("context_saved", saved)
+        trace.add_tokens("context_dropped", dropped)
+
+def record_single_flight(flight: str, role: str):
+    """Record a request leading an upstream call, or following one of this process or another worker"""
+    SINGLE_FLIGHT_REQUESTS.labels(flight=flight, role=role).inc()
+
+def record_cache_lookups(cache: str, hits: int, misses: int):
+    """Record hits and misses of a cache, hit rate is hits / (hits + misses)"""
+    if hits:
+        CACHE_LOOKUPS.labels(cache=cache, result="hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache=cache, result="miss").inc(misses)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_cache_lookups(cache, hits, misses)
+
+def record_error(error: str):
+    """Record error of the current request"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.error = error
+
+def finish_trace(trace: RequestTrace, endpoint: str, method: str, status: int):
+    """Record request duration and print a structured log line of the request"""
+    duration = trace.elapsed()
+    REQUEST_DURATION.labels(endpoint=endpoint, method=method, status=str(status)).observe(duration)
+    print(json.dumps({
+        "event": "request",
+        "endpoint": endpoint,
+        "method": method,
+        "status": status,
+        "duration_ms": round(duration * 1000, 2),
+        "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in trace.stages.items()},
+        "tokens": trace.tokens,
+        "cache": trace.cache,
+        "error": trace.error,
+    }, ensure_ascii=False), flush=True)
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Render metrics in Prometheus text format
+
+    Under gunicorn every worker writes its metrics to PROMETHEUS_MULTIPROC_DIR, they are
+    aggregated here so any worker serving /metrics reports the whole server.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,230 @@
+import os
+import json
+import fitz
+import bisect
+import multiprocessing
+
+from functools import partial
+from typing import List, Dict, Callable, Iterable, Iterator, Optional, Tuple
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# Version of the extracted page format, cached extractions of other versions are ignored
+EXTRACTION_VERSION = 1
+
+# Headings of table of contents sections
+CONTENTS_HEADINGS = {"contents", "table of contents", "mục lục"}
+
+def extract_pages(pdf_path: str, start: int, end: int, heading_size_ratio: float) -> List[Dict]:
+    """Extract text blocks of pages [start, end) of a PDF file
+
+    Runs in worker processes. A block is a heading when its font is larger than the body
+    font of the page (the size used by most characters) by heading_size_ratio.
+    """
+    pages = []
+    # Ligatures are expanded so words like "offer" are searchable
+    flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_LIGATURES
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(start, min(end, len(doc))):
+            blocks = []
+            size_chars = Counter()
+            for block in doc[page_num].get_text("dict", flags=flags)["blocks"]:
+                lines = []
+                size = 0.0
+                for line in block.get("lines", []):
+                    line_text = "".join(span["text"] for span in line["spans"])
+                    if line_text.strip():
+                        lines.append(line_text)
+                    for span in line["spans"]:
+                        size = max(size, span["size"])
+                        size_chars[round(span["size"], 1)] += len(span["text"].strip())
+                if lines:
+                    blocks.append({"lines": lines, "size": round(size, 1)})
+
+            body_size = size_chars.most_common(1)[0][0] if size_chars else 0.0
+            for block in blocks:
+                block["heading"] = block["size"] >= body_size * heading_size_ratio
+                # Heading numbers and titles are separate lines, they are joined on one line
+                block["text"] = (" " if block["heading"] else "\n").join(block.pop("lines"))
+            pages.append({"page": page_num + 1, "blocks": blocks})
+    return pages
+
+class ExtractionCache:
+    """Extracted pages of PDF files stored as JSON lines, keyed by file hash"""
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.join(cache_dir, f"v{EXTRACTION_VERSION}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, file_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{file_hash}.jsonl")
+
+    def contains(self, file_hash: str) -> bool:
+        """Check if a file was extracted before"""
+        return os.path.exists(self._path(file_hash))
+
+    def read(self, file_hash: str) -> Iterator[Dict]:
+        """Iterate cached pages of a file"""
+        with open(self._path(file_hash), "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def write(self, file_hash: str, pages: Iterable[Dict]) -> Iterator[Dict]:
+        """Pass pages through while writing them to the cache, the entry is only visible once complete"""
+        path = self._path(file_hash)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for page in pages:
+                    f.write(json.dumps(page, ensure_ascii=False) + "\n")
+                    yield page
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def _raise(error: Exception):
+    raise error
+
+class PDFExtractor:
+    """Extract pages of PDF files with a process pool across files and pages
+
+    Pages are yielded in order as soon as they are extracted, so chunking starts
+    before whole documents are read. Files extracted before are read from cache.
+    """
+    def __init__(self, config):
+        self.max_workers = config.PDF_EXTRACTION_WORKERS
+        self.pages_per_task = config.PDF_EXTRACTION_PAGES_PER_TASK
+        self.min_parallel_pages = config.PDF_EXTRACTION_MIN_PARALLEL_PAGES
+        self.heading_size_ratio = config.PDF_HEADING_SIZE_RATIO
+        self.cache = ExtractionCache(config.EXTRACTION_CACHE_DIR)
+
+    def _extraction_tasks(self, pdf_path: str, page_count: int, executor: Optional[ProcessPoolExecutor]) -> List[Callable[[], List[Dict]]]:
+        """Split pages of a file into ranges, each one extracted by a task of the pool"""
+        tasks = []
+        for start in range(0, page_count, self.pages_per_task):
+            task = partial(extract_pages, pdf_path, start, start + self.pages_per_task, self.heading_size_ratio)
+            tasks.append(executor.submit(task).result if executor is not None else task)
+        return tasks
+
+    @staticmethod
+    def _iter_file_pages(tasks: List[Callable[[], List[Dict]]]) -> Iterator[Dict]:
+        """Yield pages of a file from its extraction tasks, in page order"""
+        for task in tasks:
+            yield from task()
+
+    def iter_documents(self, files: Dict[str, Tuple[str, str]]) -> Iterator[Tuple[str, Iterator[Dict]]]:
+        """Yield (filename, pages) of files given as {filename: (path, file hash)}
+
+        Pages of a file must be consumed before the next file is yielded. Iterating pages
+        of a file which can not be read raises its error, nothing is cached for it.
+        """
+        page_counts = {}
+        tasks = {}
+        for filename, (path, file_hash) in files.items():
+            if self.cache.contains(file_hash):
+                continue
+            try:
+                with fitz.open(path) as doc:
+                    page_counts[filename] = len(doc)
+            except Exception as e:
+                tasks[filename] = [partial(_raise, e)]
+
+        executor = None
+        if self.max_workers > 1 and sum(page_counts.values()) >= self.min_parallel_pages:
+            # Spawned workers do not inherit threads and locks of the web worker
+            executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        try:
+            # Submit every page range first, so workers extract later files while earlier ones are chunked
+            for filename, page_count in page_counts.items():
+                tasks[filename] = self._extraction_tasks(files[filename][0], page_count, executor)
+
+            for filename, (_, file_hash) in files.items():
+                if filename in tasks:
+                    yield filename, self.cache.write(file_hash, self._iter_file_pages(tasks[filename]))
+                else:
+                    print(f"Using cached extraction of {filename}")
+                    yield filename, self.cache.read(file_hash)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+def _iter_segments(pages: Iterable[Dict]) -> Iterator[Tuple[str, int, str]]:
+    """Yield (text, page, section) segments of pages, a segment starts at each heading
+
+    Table of contents sections are skipped, they repeat every heading of the document
+    and would match most questions.
+    """
+    # Open headings from the document title to the current section, with their font size
+    headings = []
+    in_contents = False
+    for page in pages:
+        for block in page["blocks"]:
+            if block["heading"]:
+                while headings and headings[-1][0] <= block["size"]:
+                    headings.pop()
+                headings.append((block["size"], block["text"]))
+                in_contents = block["text"].strip().lower() in CONTENTS_HEADINGS
+                if in_contents:
+                    continue
+                # Blank line before headings, so the splitter prefers to split at sections
+                yield "\n\n" + block["text"], page["page"], " > ".join(text for _, text in headings)
+            elif not in_contents:
+                yield "\n" + block["text"], page["page"], " > ".join(text for _, text in headings)
+
+def chunk_pages(pages: Iterable[Dict], text_splitter, buffer_size: int) -> Iterator[Dict]:
+    """Split streamed pages into chunks which keep their page numbers and section heading
+
+    Text is buffered up to buffer_size characters and split, the last chunk of the buffer
+    is kept and split again with the following text. With a buffer several times the chunk
+    size, chunks are the same as when splitting the whole document string, except rarely
+    around buffer boundaries, and the document string is never built.
+    """
+    buffer = []
+    buffer_length = 0
+    # Start offsets of segments in the buffer, with their page and section
+    offsets, segment_pages, sections = [], [], []
+
+    def split(final: bool) -> Iterator[Dict]:
+        nonlocal buffer, buffer_length, offsets, segment_pages, sections
+        text = "".join(buffer)
+        chunks = text_splitter.split_text(text)
+        # The last chunk may continue in the next pages, it is split again with them
+        last_chunk = None if final else chunks.pop()
+
+        cursor = 0
+        for chunk in chunks:
+            position = text.find(chunk, cursor)
+            position = cursor if position < 0 else position
+            cursor = position + 1
+            start = bisect.bisect_right(offsets, position) - 1
+            end = bisect.bisect_right(offsets, position + len(chunk) - 1) - 1
+            yield {
+                "text": chunk,
+                "page": segment_pages[max(start, 0)],
+                "page_end": segment_pages[max(end, 0)],
+                "section": sections[max(start, 0)],
+            }
+
+        if last_chunk is not None:
+            # Keep text from the start of the last chunk, it still overlaps the emitted chunks
+            keep_from = max(text.find(last_chunk, cursor), 0)
+            first = max(bisect.bisect_right(offsets, keep_from) - 1, 0)
+            buffer = [text[keep_from:]]
+            buffer_length = len(buffer[0])
+            offsets = [0] + [offset - keep_from for offset in offsets[first + 1:]]
+            segment_pages = segment_pages[first:]
+            sections = sections[first:]
+
+    for segment, page, section in _iter_segments(pages):
+        offsets.append(buffer_length)
+        segment_pages.append(page)
+        sections.append(section)
+        buffer.append(segment)
+        buffer_length += len(segment)
+        if buffer_length >= buffer_size:
+            yield from split(final=False)
+
+    if buffer_length and "".join(buffer).strip():
+        yield from split(final=True)
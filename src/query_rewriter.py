@@ -0,0 +1,128 @@
+import hashlib
+import threading
+import unicodedata
+
+from typing import List, Dict, Optional
+from collections import OrderedDict
+from .lexical_index import TOKEN_PATTERN
+from .metrics import record_cache_lookups, record_tokens, timed_stage
+
+# Pronouns which always refer back to earlier messages, in English and Vietnamese
+FOLLOW_UP_PRONOUNS = {"they", "them", "their", "those", "nó", "chúng"}
+
+# Pronouns and ellipses which refer back to earlier messages when they start or end a question,
+# e.g. "and international?", "what if it already shipped?", "how do I claim it?", "còn hàng quốc tế?".
+# Elsewhere they are as common in standalone questions ("is it possible to ...")
+FOLLOW_UP_MARKERS = [
+    "it", "its", "that", "and", "also", "then", "instead", "what about", "how about", "what if",
+    "đó", "ấy", "kia", "còn", "vậy còn", "thế còn",
+]
+
+class QueryRewriter:
+    """Build a standalone retrieval query from the latest question and the chat history
+
+    "heuristic" prefixes follow-up questions (short, or starting or ending with words like
+    "and" or "đó") with the previous user messages, "llm" asks a small Gemini model to
+    rewrite them, "prompt" searches with the whole prompt as before. Assistant answers
+    never go into the query, so retrieval is not dragged toward earlier answers.
+    """
+    def __init__(self, config, genai_client):
+        self.mode = config.QUERY_REWRITE_MODE
+        self.model_name = config.QUERY_REWRITE_MODEL
+        self.max_output_tokens = config.QUERY_REWRITE_MAX_TOKENS
+        self.history_turns = config.QUERY_REWRITE_HISTORY_TURNS
+        self.short_query_terms = config.QUERY_REWRITE_SHORT_QUERY_TERMS
+        self.genai_client = genai_client
+        self.markers = [marker.split() for marker in FOLLOW_UP_MARKERS]
+
+        # Least recently used cache of rewritten queries
+        self.cache_size = config.QUERY_REWRITE_CACHE_SIZE
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def is_follow_up(self, question: str) -> bool:
+        """Check if a question probably depends on earlier messages, only asked of questions with prior turns"""
+        words = TOKEN_PATTERN.findall(unicodedata.normalize("NFC", question.lower()))
+        if len(words) <= self.short_query_terms or any(word in FOLLOW_UP_PRONOUNS for word in words):
+            return True
+        return any(words[:len(marker)] == marker or words[-len(marker):] == marker for marker in self.markers)
+
+    def _previous_questions(self, history: List[Dict]) -> List[str]:
+        return [message["text"] for message in history if message["role"] == "user"][-self.history_turns:]
+
+    def heuristic_query(self, question: str, history: List[Dict]) -> str:
+        """Prefix a follow-up question with the previous user messages"""
+        return " ".join(self._previous_questions(history) + [question])
+
+    def _rewrite_prompt(self, question: str, history: List[Dict]) -> str:
+        transcript = "\n".join(
+            f"{'Khách hàng' if message['role'] == 'user' else 'Trợ lý'}: {message['text']}" for message in history
+        )
+        return f"""
+            Hội thoại:
+            {transcript}
+
+            Câu hỏi mới nhất: {question}
+
+            Viết lại câu hỏi mới nhất thành một truy vấn tìm kiếm độc lập, đầy đủ ngữ cảnh,
+            cùng ngôn ngữ với câu hỏi. Chỉ trả về truy vấn tìm kiếm:
+        """
+
+    def _generation_config(self) -> Dict:
+        return {"temperature": 0.0, "max_output_tokens": self.max_output_tokens}
+
+    def _cache_key(self, question: str, history: List[Dict]) -> str:
+        return hashlib.sha256("\n".join([self.mode] + [
+            f"{message['role']}:{message['text']}" for message in history
+        ] + [question]).encode("utf-8")).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self._cache_lock:
+            query = self._cache.get(key)
+            if query is not None:
+                self._cache.move_to_end(key)
+        record_cache_lookups("query_rewrite", int(query is not None), int(query is None))
+        return query
+
+    def _cache_set(self, key: str, query: str):
+        with self._cache_lock:
+            self._cache[key] = query
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _needs_model(self, question: str, history: Optional[List[Dict]]) -> bool:
+        return bool(history) and self.is_follow_up(question)
+
+    def rewrite(self, prompt: str, question: str, history: Optional[List[Dict]]) -> str:
+        """Get the retrieval query of a question, prompt is the full generation prompt"""
+        if self.mode == "prompt":
+            return prompt
+        if not self._needs_model(question, history):
+            return question
+        if self.mode != "llm":
+            return self.heuristic_query(question, history)
+
+        key = self._cache_key(question, history)
+        query = self._cache_get(key)
+        if query is not None:
+            return query
+        try:
+            with timed_stage("query_rewrite"):
+                response = self.genai_client.models.generate_content(
+                    model=self.model_name,
+                    contents=[{"role": "user", "parts": [{"text": self._rewrite_prompt(question, history)}]}],
+                    config=self._generation_config(),
+                )
+            record_tokens(self.model_name, response.usage_metadata)
+            query = (response.text or "").strip() or self.heuristic_query(question, history)
+        except Exception as e:
+            print(f"Error rewriting query: {e}")
+            return self.heuristic_query(question, history)
+        self._cache_set(key, query)
+        return query
+
+    def clear_cache(self):
+        """Forget rewritten queries"""
+        with self._cache_lock:
+            self._cache.clear()
@@ -0,0 +1,115 @@
+import time
+import threading
+import numpy as np
+
+from typing import List, Dict, Optional
+from collections import OrderedDict
+from .lexical_index import tokenize
+
+def _scale(values: np.ndarray) -> np.ndarray:
+    """Scale scores of the pool to [0, 1], so features of different ranges can be weighted"""
+    low, high = float(values.min()), float(values.max())
+    if high - low < 1e-9:
+        return np.zeros_like(values)
+    return (values - low) / (high - low)
+
+class MMRReranker:
+    """Rerank a pool of retrieved chunks on CPU, without a cross-encoder
+
+    Relevance of a chunk mixes its cosine similarity to the query, the share of query
+    terms it contains, its first stage score and its closeness to other relevant chunks
+    of the same file. Chunks are then picked by maximal marginal relevance, relevance
+    minus similarity to the chunks already picked, so near duplicates do not fill the
+    prompt. When the latency budget is used up, the remaining chunks follow by relevance.
+    """
+    def __init__(self, weights: Dict[str, float], mmr_lambda: float, budget_ms: float, terms_cache_size: int = 10000):
+        self.weights = weights
+        self.mmr_lambda = mmr_lambda
+        self.budget_ms = budget_ms
+
+        # Terms of recently reranked chunks, tokenizing them is most of the reranking time
+        self.terms_cache_size = terms_cache_size
+        self._terms = OrderedDict()
+        self._terms_lock = threading.Lock()
+
+    def _chunk_terms(self, chunk: Dict) -> set:
+        key = chunk.get("id")
+        with self._terms_lock:
+            terms = self._terms.get(key)
+            if terms is not None:
+                self._terms.move_to_end(key)
+                return terms
+        terms = set(tokenize(chunk["text"]))
+        if key is not None:
+            with self._terms_lock:
+                self._terms[key] = terms
+                while len(self._terms) > self.terms_cache_size:
+                    self._terms.popitem(last=False)
+        return terms
+
+    def relevance(self, query: str, query_embedding: List[float], chunks: List[Dict], vectors: np.ndarray) -> np.ndarray:
+        """Relevance of each chunk of the pool, vectors are normalized"""
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        dense = vectors @ query_vector
+
+        query_terms = set(tokenize(query))
+        lexical = np.array([
+            len(query_terms & self._chunk_terms(chunk)) / max(len(query_terms), 1) for chunk in chunks
+        ], dtype=np.float32)
+        first_stage = np.array([chunk["score"] or 0.0 for chunk in chunks], dtype=np.float32)
+
+        base = (
+            self.weights.get("dense", 0.0) * _scale(dense)
+            + self.weights.get("lexical", 0.0) * lexical
+            + self.weights.get("first_stage", 0.0) * _scale(first_stage)
+        )
+
+        # Chunks next to relevant chunks of the same file, closeness decays with the distance in chunks
+        filenames = np.array([chunk["filename"] for chunk in chunks])
+        positions = np.array([chunk.get("chunk_index", 0) for chunk in chunks], dtype=np.float32)
+        same_file = filenames[:, None] == filenames[None, :]
+        np.fill_diagonal(same_file, False)
+        closeness = same_file / (1.0 + np.abs(positions[:, None] - positions[None, :]))
+        proximity = (closeness * base[None, :]).max(axis=1)
+        return base + self.weights.get("proximity", 0.0) * _scale(proximity)
+
+    def rerank(self, query: str, query_embedding: List[float], chunks: List[Dict], vectors: List[Optional[List[float]]], top_k: int) -> List[Dict]:
+        """Pick the top_k chunks of the pool, each gets its "rerank_score\""""
+        if not chunks or any(vector is None for vector in vectors):
+            return chunks[:top_k]
+        start = time.perf_counter()
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        relevance = self.relevance(query, query_embedding, chunks, matrix)
+        similarity = matrix @ matrix.T
+
+        selected = []
+        available = np.ones(len(chunks), dtype=bool)
+        max_similarity = np.zeros(len(chunks), dtype=np.float32)
+        while len(selected) < min(top_k, len(chunks)):
+            if (time.perf_counter() - start) * 1000 > self.budget_ms:
+                break
+            marginal = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * max_similarity
+            marginal[~available] = -np.inf
+            pick = int(np.argmax(marginal))
+            selected.append(pick)
+            available[pick] = False
+            max_similarity = np.maximum(max_similarity, similarity[pick])
+
+        # Out of budget, the rest by relevance alone
+        if len(selected) < top_k:
+            rest = [idx for idx in np.argsort(-relevance).tolist() if available[idx]]
+            selected.extend(rest[:top_k - len(selected)])
+        return [dict(chunks[idx], rerank_score=float(relevance[idx])) for idx in selected]
+
+def create_reranker(config) -> Optional[MMRReranker]:
+    """Create reranker of the candidate pool, None when reranking is disabled"""
+    if not config.RERANK_ENABLED:
+        return None
+    return MMRReranker(
+        weights=config.RERANK_WEIGHTS,
+        mmr_lambda=config.RERANK_MMR_LAMBDA,
+        budget_ms=config.RERANK_BUDGET_MS,
+    )
@@ -0,0 +1,112 @@
+import time
+import uuid
+import threading
+
+from typing import List, Dict, Optional
+from qdrant_client import QdrantClient, models
+from .metrics import record_cache_lookups
+
+class SemanticResponseCache:
+    """Cache of generated answers, looked up by similarity of question embeddings
+
+    Entries are stored in their own Qdrant collection, so every worker and container
+    shares them. An answer is reused when the new question is close enough to a cached
+    question, the same chunks were retrieved and the corpus did not change since.
+    """
+    def __init__(self, qdrant_client: QdrantClient, collection_name: str, dim: int, threshold: float, ttl: int):
+        self.qdrant_client = qdrant_client
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.ttl = ttl
+
+        # Hit and miss counters of this process
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+        if not self.qdrant_client.collection_exists(self.collection_name):
+            self.qdrant_client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+            )
+
+    def _count(self, hit: bool):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache_lookups("response", int(hit), int(not hit))
+
+    def get(self, question_embedding: List[float], chunk_ids: List[str], corpus_hash: str) -> Optional[str]:
+        """Get cached answer of a similar question with the same retrieved chunks"""
+        try:
+            results = self.qdrant_client.query_points(
+                collection_name=self.collection_name,
+                query=question_embedding,
+                query_filter=models.Filter(must=[
+                    models.FieldCondition(key="corpus_hash", match=models.MatchValue(value=corpus_hash)),
+                    models.FieldCondition(key="expires_at", range=models.Range(gt=time.time())),
+                ]),
+                score_threshold=self.threshold,
+                limit=5,
+                with_payload=True,
+            )
+        except Exception as e:
+            print(f"Error reading response cache: {e}")
+            self._count(False)
+            return None
+
+        for result in results.points:
+            if sorted(result.payload["chunk_ids"]) == sorted(chunk_ids):
+                self._count(True)
+                return result.payload["answer"]
+        self._count(False)
+        return None
+
+    def set(self, question: str, question_embedding: List[float], chunk_ids: List[str], corpus_hash: str, answer: str):
+        """Store answer of a question"""
+        now = time.time()
+        point_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{corpus_hash}/{question.strip().lower()}"))
+        try:
+            self.qdrant_client.upsert(
+                collection_name=self.collection_name,
+                points=[models.PointStruct(
+                    id=point_id,
+                    vector=question_embedding,
+                    payload={
+                        "question": question,
+                        "answer": answer,
+                        "chunk_ids": chunk_ids,
+                        "corpus_hash": corpus_hash,
+                        "created_at": now,
+                        "expires_at": now + self.ttl,
+                    }
+                )]
+            )
+        except Exception as e:
+            print(f"Error writing response cache: {e}")
+
+    def invalidate(self, corpus_hash: str):
+        """Remove answers of other corpus versions and expired answers"""
+        try:
+            self.qdrant_client.delete(
+                collection_name=self.collection_name,
+                points_selector=models.Filter(should=[
+                    models.Filter(must_not=[
+                        models.FieldCondition(key="corpus_hash", match=models.MatchValue(value=corpus_hash))
+                    ]),
+                    models.FieldCondition(key="expires_at", range=models.Range(lte=time.time())),
+                ])
+            )
+        except Exception as e:
+            print(f"Error invalidating response cache: {e}")
+
+    def stats(self) -> Dict:
+        """Get hit and miss counters of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
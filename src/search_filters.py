@@ -0,0 +1,127 @@
+import numpy as np
+
+from typing import List, Dict, Optional
+from qdrant_client import models
+from .lexical_index import TOKEN_PATTERN, strip_diacritics
+
+# Keyword fields of chunk payloads which searches can be filtered by, one value or a list of values
+KEYWORD_FILTERS = ["filename", "doc_type", "language"]
+# Chunks overlapping the page range [page_from, page_to] are kept, chunks of unknown page (0) never are
+PAGE_FILTERS = ["page_from", "page_to"]
+
+# Letters only found in Vietnamese text
+VIETNAMESE_LETTERS = set(
+    "ăâđêôơưàảãáạằẳẵắặầẩẫấậèẻẽéẹềểễếệìỉĩíịòỏõóọồổỗốộờởỡớợùủũúụừửữứựỳỷỹýỵ"
+)
+
+def detect_language(text: str, min_share: float = 0.03) -> str:
+    """Detect language of a chunk, "vi" when enough of its letters are Vietnamese, otherwise "en\""""
+    letters = [c for c in text.lower() if c.isalpha()]
+    if not letters:
+        return "en"
+    vietnamese = sum(1 for c in letters if c in VIETNAMESE_LETTERS)
+    return "vi" if vietnamese / len(letters) >= min_share else "en"
+
+def document_type(filename: str, document_types: Dict[str, str], default: str) -> str:
+    """Type of a document, given by the first pattern found in its file name"""
+    name = filename.lower()
+    for pattern, doc_type in document_types.items():
+        if pattern in name:
+            return doc_type
+    return default
+
+def _values(value) -> List:
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+def validate_filters(filters: Optional[Dict]) -> Optional[Dict]:
+    """Check filters of a search, returns None when there is nothing to filter"""
+    if not filters:
+        return None
+    unknown = set(filters) - set(KEYWORD_FILTERS) - set(PAGE_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown search filters: {', '.join(sorted(unknown))}")
+    for field in PAGE_FILTERS:
+        if filters.get(field) is not None and not isinstance(filters[field], int):
+            raise ValueError(f"Search filter {field} must be an integer")
+    return {field: value for field, value in filters.items() if value is not None} or None
+
+def _has_page_filter(filters: Dict) -> bool:
+    return any(field in filters for field in PAGE_FILTERS)
+
+def build_search_filter(filters: Optional[Dict]) -> Optional[models.Filter]:
+    """Build Qdrant filter of a search, served by the payload indexes of the collection"""
+    if not filters:
+        return None
+    conditions = []
+    for field in KEYWORD_FILTERS:
+        if field in filters:
+            conditions.append(models.FieldCondition(key=field, match=models.MatchAny(any=_values(filters[field]))))
+    if "page_from" in filters:
+        conditions.append(models.FieldCondition(key="page_end", range=models.Range(gte=filters["page_from"])))
+    if _has_page_filter(filters):
+        conditions.append(models.FieldCondition(key="page", range=models.Range(gte=1, lte=filters.get("page_to"))))
+    return models.Filter(must=conditions)
+
+def matches_filters(payload: Dict, filters: Optional[Dict]) -> bool:
+    """Check a chunk payload against filters, like the Qdrant filter does"""
+    if not filters:
+        return True
+    for field in KEYWORD_FILTERS:
+        if field in filters and payload.get(field) not in _values(filters[field]):
+            return False
+    if "page_from" in filters and (payload.get("page_end") or 0) < filters["page_from"]:
+        return False
+    page = payload.get("page") or 0
+    if _has_page_filter(filters) and page < 1:
+        return False
+    if "page_to" in filters and page > filters["page_to"]:
+        return False
+    return True
+
+def filter_mask(fields: Dict[str, np.ndarray], filters: Optional[Dict]) -> Optional[np.ndarray]:
+    """Mask of the chunks of a lexical index matching filters, None when the index has no payload fields"""
+    if not filters or not fields:
+        return None
+    mask = np.ones(len(next(iter(fields.values()))), dtype=bool)
+    for field in KEYWORD_FILTERS:
+        if field in filters:
+            mask &= np.isin(fields[field], _values(filters[field]))
+    if "page_from" in filters:
+        mask &= fields["page_end"] >= filters["page_from"]
+    if _has_page_filter(filters):
+        mask &= fields["page"] >= 1
+    if "page_to" in filters:
+        mask &= fields["page"] <= filters["page_to"]
+    return mask
+
+def _normalize(text: str) -> str:
+    return " " + " ".join(TOKEN_PATTERN.findall(strip_diacritics(text.lower()))) + " "
+
+class QueryRouter:
+    """Pick the documents a question is about from its wording, without a model call
+
+    Each route lists phrases, matched on lowercase terms without diacritics, and the
+    document types searched when one of them is in the question. The first matching
+    route wins, questions matching none search every document. Routes should only
+    cover questions whose answers are in one kind of document, e.g. error reports in
+    the troubleshooting guide. Searches whose routed results are weak are run again
+    in every document, so a wrong route costs a search instead of hiding the answer.
+    """
+    def __init__(self, routes: List[Dict]):
+        self.routes = [
+            (route["doc_types"], [_normalize(phrase) for phrase in route["phrases"]]) for route in routes
+        ]
+
+    def route(self, query: str) -> Optional[Dict]:
+        """Filters of the documents a query is about, None when it may be about any document"""
+        text = _normalize(query)
+        for doc_types, phrases in self.routes:
+            if any(phrase in text for phrase in phrases):
+                return {"doc_type": doc_types}
+        return None
+
+def create_query_router(config) -> Optional[QueryRouter]:
+    """Create query router, None when routing is disabled"""
+    if not config.QUERY_ROUTER_ENABLED:
+        return None
+    return QueryRouter(config.QUERY_ROUTES)
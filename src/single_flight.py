@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import uuid
+import redis
+import redis.lock
+import threading
+import contextvars
+
+from typing import Any, Callable, Iterator, Optional, Tuple
+from .metrics import record_single_flight
+
+def normalize_query(text: str) -> str:
+    """Normalize a question for coalescing, case, spacing and final punctuation do not matter"""
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?!. ")
+
+class _Flight:
+    """Events of one upstream call, replayed to every request waiting for it"""
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, event: Tuple[str, Any]):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def replay(self, timeout: float) -> Iterator[Tuple[str, Any]]:
+        idx = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: idx < len(self.events) or self.done, timeout):
+                    raise TimeoutError("Timed out waiting for coalesced request")
+                events = self.events[idx:]
+                idx = len(self.events)
+                finished = self.done and idx == len(self.events)
+                error = self.error
+            yield from events
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+class SingleFlight:
+    """Share one upstream call between concurrent identical requests
+
+    Requests of the same key in this process wait for one call. A call returning one
+    result runs in the thread of its first request, a streamed call runs in its own
+    thread so a client disconnecting does not cancel it for the others. With Redis,
+    that call first takes a lock shared by every worker: the holder publishes events of
+    the call to a Redis stream, callers of other workers read them instead of calling
+    upstream. Results must be JSON serializable.
+    """
+    def __init__(self, name: str, redis_url: Optional[str], lock_ttl: int, wait_timeout: int, result_ttl: int):
+        self.name = name
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.redis_client = redis.Redis.from_url(redis_url) if redis_url else None
+
+        # Flights in progress in this process, keyed by request key
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Call fn, or wait for the result of the same call in progress"""
+        def produce():
+            yield "result", fn()
+
+        for kind, value in self._events(key, produce, detach=False):
+            if kind == "result":
+                return value
+
+    def stream(self, key: str, fn: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """Iterate texts of fn, or of the same call in progress from its first text"""
+        def produce():
+            for text in fn():
+                yield "text", text
+            yield "result", None
+
+        for kind, value in self._events(key, produce, detach=True):
+            if kind == "text":
+                yield value
+
+    def _events(
+        self, key: str, produce: Callable[[], Iterator[Tuple[str, Any]]], detach: bool
+    ) -> Iterator[Tuple[str, Any]]:
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if leader and detach:
+            # Stage timings of the call are recorded in the trace of the first request
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run, key, flight, produce), daemon=True).start()
+        elif leader:
+            self._run(key, flight, produce)
+        else:
+            record_single_flight(self.name, "local_follower")
+        yield from flight.replay(self.wait_timeout)
+
+    def _run(self, key: str, flight: _Flight, produce: Callable[[], Iterator[Tuple[str, Any]]]):
+        try:
+            events = self._redis_events(key, produce) if self.redis_client is not None else self._lead(produce)
+            for event in events:
+                flight.add(event)
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            with self._flights_lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def _lead(self, produce: Callable[[], Iterator[Tuple[str, Any]]]) -> Iterator[Tuple[str, Any]]:
+        record_single_flight(self.name, "leader")
+        yield from produce()
+
+    def _acquire(self, lock_name: str) -> Tuple[bool, str, Optional[redis.lock.Lock]]:
+        """Take the lock of a call, returns (leader, flight id, lock), or the flight id of the leader"""
+        while True:
+            flight_id = uuid.uuid4().hex
+            lock = self.redis_client.lock(lock_name, timeout=self.lock_ttl)
+            if lock.acquire(blocking=False, token=flight_id):
+                return True, flight_id, lock
+            leader_id = self.redis_client.get(lock_name)
+            if leader_id is not None:
+                return False, leader_id.decode(), None
+            # Leader finished between both calls, try to lead
+
+    def _redis_events(self, key: str, produce: Callable[[], Iterator[Tuple[str, Any]]]) -> Iterator[Tuple[str, Any]]:
+        """Lead the call for every worker, or follow the worker which leads it"""
+        lock_name = f"single_flight:{self.name}:{key}"
+        try:
+            leader, flight_id, lock = self._acquire(lock_name)
+        except redis.exceptions.RedisError as e:
+            print(f"Error coalescing {self.name} request through Redis: {e}")
+            yield from self._lead(produce)
+            return
+
+        events_key = f"{lock_name}:{flight_id}"
+        if not leader:
+            record_single_flight(self.name, "redis_follower")
+            yield from self._follow(events_key, produce)
+            return
+
+        try:
+            for kind, value in self._lead(produce):
+                self._publish(events_key, kind, value)
+                yield kind, value
+        except Exception as e:
+            self._publish(events_key, "error", str(e))
+            raise
+        finally:
+            try:
+                # Events stay readable for followers which are still reading them
+                self.redis_client.expire(events_key, self.result_ttl)
+                lock.release()
+            except redis.exceptions.RedisError as e:
+                print(f"Error releasing {self.name} single flight lock: {e}")
+
+    def _publish(self, events_key: str, kind: str, value: Any):
+        try:
+            self.redis_client.xadd(events_key, {"kind": kind, "value": json.dumps(value, ensure_ascii=False)})
+        except redis.exceptions.RedisError as e:
+            # Followers time out and call upstream themselves
+            print(f"Error publishing {self.name} single flight event: {e}")
+
+    def _follow(self, events_key: str, produce: Callable[[], Iterator[Tuple[str, Any]]]) -> Iterator[Tuple[str, Any]]:
+        """Read events published by the leading worker"""
+        last_id = "0"
+        received = False
+        while True:
+            response = self.redis_client.xread({events_key: last_id}, count=100, block=self.wait_timeout * 1000)
+            if not response:
+                if received:
+                    raise TimeoutError("Timed out waiting for coalesced request")
+                # Leader died before publishing anything, call upstream
+                print(f"Leader of {self.name} request timed out, calling upstream")
+                yield from self._lead(produce)
+                return
+
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                received = True
+                kind = fields[b"kind"].decode()
+                value = json.loads(fields[b"value"])
+                if kind == "error":
+                    raise Exception(value)
+                yield kind, value
+                if kind == "result":
+                    return
+
+def create_single_flight(name: str, config, across_workers: bool = True) -> Optional[SingleFlight]:
+    """Create single flight of a kind of request, coalesced across workers when REDIS_URL is set
+
+    Short calls, e.g. embeddings, are only coalesced within the process: the Redis lock
+    and event stream would cost more round trips than the call saves.
+    """
+    if not config.SINGLE_FLIGHT_ENABLED:
+        return None
+    return SingleFlight(
+        name=name,
+        redis_url=os.getenv("REDIS_URL") if across_workers else None,
+        lock_ttl=config.SINGLE_FLIGHT_LOCK_TTL,
+        wait_timeout=config.SINGLE_FLIGHT_WAIT_TIMEOUT,
+        result_ttl=config.SINGLE_FLIGHT_RESULT_TTL,
+    )
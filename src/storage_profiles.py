@@ -0,0 +1,188 @@
+import json
+import math
+import hashlib
+
+from typing import Dict, List, Optional, Union
+from qdrant_client import QdrantClient, models
+
+# Named vectors of tiered collections: the whole embedding, and its prefix searched first
+FULL_VECTOR = "full"
+COARSE_VECTOR = "coarse"
+
+def get_storage_profile(config) -> Dict:
+    """Get storage profile selected in configuration"""
+    if config.STORAGE_PROFILE not in config.STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {config.STORAGE_PROFILE}")
+    return config.STORAGE_PROFILES[config.STORAGE_PROFILE]
+
+def storage_profile_signature(profile: Dict) -> str:
+    """Hash of a storage profile, a collection is rebuilt when the profile changes"""
+    return hashlib.md5(json.dumps(profile, sort_keys=True).encode("utf-8")).hexdigest()
+
+def create_quantization_config(profile: Dict) -> Optional[models.QuantizationConfig]:
+    """Create quantization config of a profile, quantized vectors are kept in RAM"""
+    quantization = profile.get("quantization")
+    if quantization == "scalar":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=profile.get("quantile", 0.99),
+            always_ram=True,
+        ))
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if quantization is not None:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    return None
+
+def create_search_params(profile: Dict) -> Optional[models.SearchParams]:
+    """Create search params of a profile, quantized results are rescored with original vectors"""
+    quantization = None
+    if profile.get("quantization") is not None:
+        quantization = models.QuantizationSearchParams(
+            rescore=profile.get("rescore", True),
+            oversampling=profile.get("oversampling"),
+        )
+    if quantization is None and profile.get("hnsw_ef") is None:
+        return None
+    return models.SearchParams(hnsw_ef=profile.get("hnsw_ef"), quantization=quantization)
+
+def truncate_embedding(embedding: List[float], dim: int) -> List[float]:
+    """First dimensions of an embedding, normalized again
+
+    gemini-embedding-001 is trained with Matryoshka representation learning, the prefix
+    of an embedding is the embedding output_dimensionality=dim would return.
+    """
+    prefix = list(embedding[:dim])
+    norm = math.sqrt(sum(value * value for value in prefix))
+    return [value / norm for value in prefix] if norm > 0 else prefix
+
+def create_point_vector(embedding: List[float], coarse_dim: Optional[int]) -> Union[List[float], Dict[str, List[float]]]:
+    """Vector of a chunk point, tiered collections also store the prefix of the embedding"""
+    if not coarse_dim:
+        return embedding
+    return {FULL_VECTOR: embedding, COARSE_VECTOR: truncate_embedding(embedding, coarse_dim)}
+
+def full_vector(vector) -> Optional[List[float]]:
+    """Whole embedding of a stored point vector, of a tiered collection or not"""
+    if isinstance(vector, dict):
+        return vector.get(FULL_VECTOR)
+    return vector
+
+def get_vector_sizes(collection_info: models.CollectionInfo) -> Dict[str, int]:
+    """Size of each vector of a chunk collection, the vector of single vector collections is named full"""
+    vectors = collection_info.config.params.vectors
+    if isinstance(vectors, dict):
+        return {name: params.size for name, params in vectors.items()}
+    return {FULL_VECTOR: vectors.size}
+
+def create_query(
+    embedding: List[float],
+    limit: int,
+    query_filter: Optional[models.Filter] = None,
+    search_params: Optional[models.SearchParams] = None,
+    coarse_dim: Optional[int] = None,
+    prefetch_oversampling: float = 4.0,
+) -> Dict:
+    """Arguments of query_points searching the embedding
+
+    A tiered collection is searched in two stages: the prefix of the embedding selects
+    prefetch_oversampling times more candidates with the search params of the profile,
+    then the full vectors of the candidates rescore them exactly.
+    """
+    if not coarse_dim:
+        return {"query": embedding, "query_filter": query_filter, "search_params": search_params, "limit": limit}
+    return {
+        "prefetch": models.Prefetch(
+            query=truncate_embedding(embedding, coarse_dim),
+            using=COARSE_VECTOR,
+            filter=query_filter,
+            params=search_params,
+            limit=math.ceil(limit * prefetch_oversampling),
+        ),
+        "query": embedding,
+        "using": FULL_VECTOR,
+        "query_filter": query_filter,
+        "limit": limit,
+    }
+
+def create_collection(qdrant_client: QdrantClient, collection_name: str, dim: int, profile: Dict):
+    """Create a collection of chunk vectors with a storage profile
+
+    With "coarse_dim" the collection has two named vectors. The HNSW graph and the
+    quantization of the profile are built on the prefix only, full vectors are just
+    read to rescore candidates.
+    """
+    coarse_dim = profile.get("coarse_dim")
+    vector_params = models.VectorParams(
+        size=coarse_dim or dim,
+        distance=models.Distance.COSINE, # Use cosine distance for similarity search
+        on_disk=profile.get("vectors_on_disk", False),
+    )
+    quantization_config = create_quantization_config(profile)
+    if coarse_dim:
+        vector_params.quantization_config = quantization_config
+        quantization_config = None
+        vectors_config = {
+            COARSE_VECTOR: vector_params,
+            FULL_VECTOR: models.VectorParams(
+                size=dim,
+                distance=models.Distance.COSINE,
+                on_disk=profile.get("vectors_on_disk", False),
+                hnsw_config=models.HnswConfigDiff(m=0), # Never searched by itself, no graph
+            ),
+        }
+    else:
+        vectors_config = vector_params
+    qdrant_client.create_collection(
+        collection_name=collection_name,
+        vectors_config=vectors_config,
+        hnsw_config=models.HnswConfigDiff(
+            m=profile.get("hnsw_m"),
+            ef_construct=profile.get("hnsw_ef_construct"),
+            on_disk=profile.get("hnsw_on_disk", False),
+        ),
+        quantization_config=quantization_config,
+        on_disk_payload=profile.get("payload_on_disk", False),
+    )
+    create_payload_indexes(qdrant_client, collection_name, profile.get("payload_indexes", {}))
+
+def create_payload_indexes(qdrant_client: QdrantClient, collection_name: str, payload_indexes: Dict[str, str]):
+    """Create payload indexes given as {field: schema type}, e.g. {"filename": "keyword"}"""
+    for field_name, schema in payload_indexes.items():
+        qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=models.PayloadSchemaType(schema),
+        )
+
+def estimate_memory(profile: Dict, points: int, dim: int, payload_bytes: int) -> Dict[str, int]:
+    """Estimate RAM and disk bytes of a collection stored with a profile
+
+    Counts vectors, quantized vectors, HNSW links (about 2 * m links of 4 bytes per point
+    on level 0) and payloads, the overhead of Qdrant itself is not included. Tiered
+    profiles store the prefix too, quantized and indexed instead of the full vectors.
+    """
+    coarse_dim = profile.get("coarse_dim") or 0
+    searched_dim = coarse_dim or dim
+    vector_bytes = points * (dim + coarse_dim) * 4
+    quantization = profile.get("quantization")
+    if quantization == "scalar":
+        quantized_bytes = points * searched_dim
+    elif quantization == "binary":
+        quantized_bytes = points * ((searched_dim + 7) // 8)
+    else:
+        quantized_bytes = 0
+    hnsw_bytes = points * (profile.get("hnsw_m") or 16) * 2 * 4
+
+    ram = quantized_bytes
+    disk = 0
+    for size, on_disk in (
+        (vector_bytes, profile.get("vectors_on_disk", False)),
+        (hnsw_bytes, profile.get("hnsw_on_disk", False)),
+        (payload_bytes, profile.get("payload_on_disk", False)),
+    ):
+        if on_disk:
+            disk += size
+        else:
+            ram += size
+    return {"ram_bytes": ram, "disk_bytes": disk}
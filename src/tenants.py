@@ -0,0 +1,148 @@
+import os
+import re
+import json
+import threading
+
+from typing import Callable, Dict, Optional
+from collections import OrderedDict
+
+# Tenant ids are used in URLs and collection names
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]{0,39}$")
+
+# Settings of clients and stores shared by every tenant of the process, tenants cannot override them
+SHARED_SETTINGS = {
+    "EMBEDDING_MODEL_NAME", "EMBEDDING_DIM",
+    "EMBEDDING_CACHE_BACKEND", "EMBEDDING_CACHE_PATH", "EMBEDDING_CACHE_MAX_ENTRIES", "EMBEDDING_CACHE_TTL",
+    "GEMINI_RATE_LIMITS", "GEMINI_QUOTA_MAX_WAIT", "GEMINI_MAX_RETRIES", "GEMINI_RETRY_BASE_DELAY",
+    "GEMINI_RETRY_MAX_DELAY", "GEMINI_REQUEST_DEADLINE", "GEMINI_BACKGROUND_DEADLINE", "GEMINI_FALLBACK_MODELS",
+    "SINGLE_FLIGHT_ENABLED", "SINGLE_FLIGHT_LOCK_TTL", "SINGLE_FLIGHT_WAIT_TIMEOUT", "SINGLE_FLIGHT_RESULT_TTL",
+    "CONVERSATION_STORE_PATH", "CONVERSATION_MAX_MESSAGES", "CONVERSATION_TTL",
+    "INDEX_STATE_DIR",
+    "DEFAULT_TENANT", "TENANTS", "TENANTS_FILE", "TENANT_MAX_LOADED",
+}
+
+def _class_name(tenant_id: str) -> str:
+    return "".join(part.capitalize() for part in tenant_id.split("-")) + "Config"
+
+def load_tenants(config) -> Dict[str, Dict]:
+    """Read tenants of TENANTS and TENANTS_FILE, returns {tenant id: {"hosts", "config"}}
+
+    The config of a tenant is a subclass of config with its settings, its collections
+    are named after the tenant unless it names them. The default tenant uses config
+    as it is. Raises ValueError on invalid tenants, so a bad file fails at startup.
+    """
+    tenants = dict(config.TENANTS)
+    if config.TENANTS_FILE and os.path.exists(config.TENANTS_FILE):
+        with open(config.TENANTS_FILE, "r", encoding="utf-8") as f:
+            tenants.update(json.load(f))
+
+    loaded = {config.DEFAULT_TENANT: {"hosts": [], "config": config}}
+    for tenant_id, tenant in tenants.items():
+        if not TENANT_ID_PATTERN.match(tenant_id):
+            raise ValueError(f"Invalid tenant id {tenant_id!r}, use lowercase letters, digits and dashes")
+        if tenant_id == config.DEFAULT_TENANT:
+            raise ValueError(f"Tenant {tenant_id} is the default tenant, its settings are the Config")
+        settings = dict(tenant.get("config", {}))
+        unknown = [key for key in settings if not hasattr(config, key)]
+        if unknown:
+            raise ValueError(f"Unknown settings of tenant {tenant_id}: {', '.join(sorted(unknown))}")
+        shared = [key for key in settings if key in SHARED_SETTINGS]
+        if shared:
+            raise ValueError(f"Settings of tenant {tenant_id} are shared by all tenants: {', '.join(sorted(shared))}")
+
+        settings.setdefault("QDRANT_COLLECTION_NAME", f"{tenant_id}_docs")
+        settings.setdefault("RESPONSE_CACHE_COLLECTION_NAME", f"{tenant_id}_response_cache")
+        loaded[tenant_id] = {
+            "hosts": [host.lower() for host in tenant.get("hosts", [])],
+            "config": type(_class_name(tenant_id), (config,), settings),
+        }
+
+    collections = [tenant["config"].QDRANT_COLLECTION_NAME for tenant in loaded.values()]
+    if len(set(collections)) < len(collections):
+        raise ValueError("Tenants must not share a Qdrant collection")
+    return loaded
+
+class TenantRegistry:
+    """Chatbots of the tenants served by this process
+
+    A tenant is picked by the Host header of the request or by the tenant id of its
+    path. Chatbots are created on their first request and share the Gemini client,
+    its quota limiter, the Qdrant clients, the embedding cache and the event loop of
+    the default tenant, so a tenant only adds its own indexes and caches. Beyond
+    TENANT_MAX_LOADED tenants the least recently used chatbot is unloaded, its data
+    stays in Qdrant and it is loaded again on its next request. on_load runs once per
+    tenant, reloading an unloaded tenant does not start its indexing again.
+    """
+    def __init__(self, config, create_chatbot: Callable, on_load: Optional[Callable] = None):
+        self.config = config
+        self.default_tenant = config.DEFAULT_TENANT
+        self.max_loaded = max(config.TENANT_MAX_LOADED, 1)
+        self.tenants = load_tenants(config)
+        self.hosts = {host: tenant_id for tenant_id, tenant in self.tenants.items() for host in tenant["hosts"]}
+        self._create_chatbot = create_chatbot
+        self._on_load = on_load
+        # Tenants whose on_load already ran in this process
+        self._started = set()
+
+        self._chatbots = OrderedDict()
+        self._lock = threading.Lock()
+        # Chatbots are created outside of the registry lock, one at a time per tenant
+        self._load_locks = {tenant_id: threading.Lock() for tenant_id in self.tenants}
+
+        # Default tenant is loaded at startup, it owns the shared clients and is never unloaded
+        self.default_chatbot = self._load(self.default_tenant)
+
+    def resolve(self, host: Optional[str], path_tenant: Optional[str] = None) -> Optional[str]:
+        """Tenant id of a request, None when its path names an unknown tenant"""
+        if path_tenant is not None:
+            return path_tenant if path_tenant in self.tenants else None
+        host = (host or "").split(":")[0].lower()
+        return self.hosts.get(host, self.default_tenant)
+
+    def _load(self, tenant_id: str):
+        config = self.tenants[tenant_id]["config"]
+        if tenant_id == self.default_tenant:
+            chatbot = self._create_chatbot(config)
+        else:
+            chatbot = self._create_chatbot(config, **self.default_chatbot.shared_clients())
+        print(f"Loaded tenant {tenant_id} (collection {chatbot.collection_name})")
+        if self._on_load is not None and tenant_id not in self._started:
+            self._started.add(tenant_id)
+            self._on_load(chatbot)
+        return chatbot
+
+    def get(self, tenant_id: str):
+        """Chatbot of a tenant, loaded when it is not"""
+        if tenant_id == self.default_tenant:
+            return self.default_chatbot
+        with self._lock:
+            chatbot = self._chatbots.get(tenant_id)
+            if chatbot is not None:
+                self._chatbots.move_to_end(tenant_id)
+                return chatbot
+
+        with self._load_locks[tenant_id]:
+            with self._lock:
+                chatbot = self._chatbots.get(tenant_id)
+            if chatbot is None:
+                chatbot = self._load(tenant_id)
+
+            with self._lock:
+                self._chatbots[tenant_id] = chatbot
+                self._chatbots.move_to_end(tenant_id)
+                # The default tenant counts as loaded and the tenant just requested stays loaded,
+                # requests still holding an unloaded chatbot finish with it
+                while len(self._chatbots) > 1 and len(self._chatbots) + 1 > self.max_loaded:
+                    unloaded, _ = self._chatbots.popitem(last=False)
+                    print(f"Unloaded tenant {unloaded}")
+        return chatbot
+
+    def stats(self) -> Dict:
+        with self._lock:
+            loaded = [self.default_tenant] + list(self._chatbots)
+        return {
+            "tenants": sorted(self.tenants),
+            "default": self.default_tenant,
+            "loaded": loaded,
+            "max_loaded": self.max_loaded,
+        }
@@ -1,104 +1,168 @@
-import bleach
 import re
 
-def convert_markdown_to_html(markdown):
-    allowed_tags = ['b', 'strong', 'i', 'em', 'u', 'p', 'br', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'code', 'pre', 'span', 'div']
-    allowed_attrs = {'*': ['class']}
-
-    html = bleach.clean(markdown, tags=[], strip=True)
-
-    def replace_code_block(match):
-        code_content = match.group(1).strip()
-        return f'<pre><code>{code_content}</code></pre>'
-
-    html = re.sub(r'``````', replace_code_block, html)
-    html = re.sub(r'`([^`]+)`', r'<code>\1</code>', html)
-    html = re.sub(r'^#### (.*?)$', r'<h4>\1</h4>', html, flags=re.MULTILINE)
-    html = re.sub(r'^### (.*?)$', r'<h3>\1</h3>', html, flags=re.MULTILINE)
-    html = re.sub(r'^## (.*?)$', r'<h2>\1</h2>', html, flags=re.MULTILINE)
-    html = re.sub(r'^# (.*?)$', r'<h1>\1</h1>', html, flags=re.MULTILINE)
-    html = re.sub(r'\*\*\*(.*?)\*\*\*', r'<b><i>\1</i></b>', html)
-    html = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', html)
-    html = re.sub(r'\*(.*?)\*', r'<i>\1</i>', html)
-
-    processed_lines = []
-    in_ordered_list = False
-    in_unordered_list = False
-    prev_was_list_item = False
-
-    for line in html.split('\n'):
-        stripped = line.strip()
-
-        if not stripped or stripped.startswith('<h') or stripped.startswith('<pre>') or stripped.startswith('</pre>') or stripped.startswith('<code>'):
-            if in_unordered_list and not prev_was_list_item:
-                processed_lines.append('</ul>')
-                in_unordered_list = False
-            if in_ordered_list and not prev_was_list_item:
-                processed_lines.append('</ol>')
-                in_ordered_list = False
-            processed_lines.append(line)
-            prev_was_list_item = False
-            continue
-
-        ordered_match = re.match(r'^\d+[.)\s]\s*(.+)$', stripped)
-        unordered_match = re.match(r'^[*\-]\s+(.+)$', stripped)
-
-        if ordered_match:
-            if not in_ordered_list:
-                if in_unordered_list:
-                    processed_lines.append('</ul>')
-                    in_unordered_list = False
-                processed_lines.append('<ol>')
-                in_ordered_list = True
-            processed_lines.append(f'<li>{ordered_match.group(1)}</li>')
-            prev_was_list_item = True
-        elif unordered_match:
-            if not in_unordered_list:
-                if in_ordered_list and not prev_was_list_item:
-                    processed_lines.append('</ol>')
-                    in_ordered_list = False
-                processed_lines.append('<ul>')
-                in_unordered_list = True
-            processed_lines.append(f'<li>{unordered_match.group(1)}</li>')
-            prev_was_list_item = True
+from typing import List
+
+# Tags and comments of the input are removed, their text is kept
+TAG_PATTERN = re.compile(r"<!--.*?-->|</?[A-Za-z][^>]*>")
+# Ampersands which do not start an entity
+AMPERSAND_PATTERN = re.compile(r"&(?!#?\w+;)")
+
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([\w+#-]*)[^`]*$")
+HEADING_PATTERN = re.compile(r"^ {0,3}(#{1,4})\s+(.+?)\s*$")
+LIST_ITEM_PATTERN = re.compile(r"^(\s*)(?:(\d{1,9}[.)])|[*-])\s+(\S.*?)\s*$")
+INLINE_PATTERN = re.compile(
+    r"`([^`]+)`"
+    r"|\*\*\*(?!\s)(.+?)(?<!\s)\*\*\*"
+    r"|\*\*(?!\s)(.+?)(?<!\s)\*\*"
+    r"|\*(?![\s*])(.+?)(?<![\s*])\*"
+)
+
+def _escape(text: str) -> str:
+    return AMPERSAND_PATTERN.sub("&amp;", text).replace("<", "&lt;").replace(">", "&gt;")
+
+def _inline_replacement(match: re.Match) -> str:
+    code, strong_emphasis, strong, emphasis = match.groups()
+    if code is not None:
+        return f"<code>{code}</code>"
+    if strong_emphasis is not None:
+        return f"<b><i>{render_inline(strong_emphasis)}</i></b>"
+    if strong is not None:
+        return f"<b>{render_inline(strong)}</b>"
+    return f"<i>{render_inline(emphasis)}</i>"
+
+def render_inline(text: str) -> str:
+    """Render code spans, bold and italic of escaped text"""
+    return INLINE_PATTERN.sub(_inline_replacement, text)
+
+class MarkdownRenderer:
+    """Render the markdown of Gemini answers to HTML in one pass over its lines
+
+    Supports headings (# to ####), paragraphs, ordered and unordered lists nested by
+    indentation, fenced code blocks, inline code, bold and italic. Tags of the input are
+    removed and its text is escaped, so the HTML only holds tags made by the renderer.
+    Text can be fed as it is streamed, each feed returns the HTML of the lines completed
+    so far. Lists are left open until they end, browsers close them when shown.
+    """
+    def __init__(self):
+        self._buffer = ""
+        # Raw lines not rendered yet, shown as text while streaming
+        self._raw = []
+        self._paragraph = []
+        # Open lists, (tag, indentation)
+        self._lists = []
+        self._fence = None
+        self._fence_language = ""
+        self._code_lines = []
+
+    def feed(self, text: str) -> str:
+        """Add text, returns HTML of the lines it completes"""
+        *lines, self._buffer = (self._buffer + text).split("\n")
+        out = []
+        for line in lines:
+            self._render_line(line, out)
+        return "".join(out)
+
+    def close(self) -> str:
+        """End the text, returns HTML of everything not rendered yet"""
+        out = []
+        if self._buffer:
+            self._render_line(self._buffer, out)
+            self._buffer = ""
+        if self._fence is not None:
+            self._close_code_block(out)
+        self._close_blocks(out)
+        self._raw = []
+        return "".join(out)
+
+    def pending(self) -> str:
+        """Text fed but not rendered yet: open paragraph, code block and last line"""
+        return "\n".join(self._raw + [self._buffer])
+
+    def _render_line(self, line: str, out: List[str]):
+        rendered = len(out)
+        self._render_block(line.rstrip("\r"), out)
+        if len(out) > rendered:
+            self._raw = []
         else:
-            if in_unordered_list:
-                processed_lines.append('</ul>')
-                in_unordered_list = False
-            if in_ordered_list:
-                processed_lines.append('</ol>')
-                in_ordered_list = False
-            processed_lines.append(line)
-            prev_was_list_item = False
-
-    if in_unordered_list:
-        processed_lines.append('</ul>')
-    if in_ordered_list:
-        processed_lines.append('</ol>')
-
-    html = '\n'.join(processed_lines)
-
-    blocks = []
-    current_block = []
-
-    for line in html.split('\n'):
-        stripped = line.strip()
-        if re.match(r'^</?(?:ol|ul|h[1-4]|pre)', stripped):
-            if current_block:
-                block_text = ' '.join(current_block)
-                if block_text and not re.match(r'^<[^>]+>$', block_text):
-                    blocks.append(f'<p>{block_text}</p>')
-                current_block = []
-            blocks.append(line)
-        elif stripped:
-            current_block.append(stripped)
-
-    if current_block:
-        block_text = ' '.join(current_block)
-        if block_text and not re.match(r'^<[^>]+>$', block_text):
-            blocks.append(f'<p>{block_text}</p>')
-
-    html = ''.join(blocks)
-    html = bleach.clean(html, tags=allowed_tags, attributes=allowed_attrs, strip=False)
-
-    return html
+            self._raw.append(line)
+
+    def _render_block(self, line: str, out: List[str]):
+        if self._fence is not None:
+            if line.strip().startswith(self._fence) and not line.strip().strip(self._fence[0]):
+                self._close_code_block(out)
+            else:
+                self._code_lines.append(_escape(line))
+            return
+
+        fence = FENCE_PATTERN.match(line)
+        if fence:
+            self._close_blocks(out)
+            self._fence = fence.group(1)
+            self._fence_language = fence.group(2)
+            return
+
+        text = TAG_PATTERN.sub("", line)
+        stripped = text.strip()
+        if not stripped:
+            # A blank line ends the paragraph, lists go on if another item follows
+            self._close_paragraph(out)
+            return
+
+        heading = HEADING_PATTERN.match(text)
+        if heading:
+            self._close_blocks(out)
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{render_inline(_escape(heading.group(2)))}</h{level}>")
+            return
+
+        item = LIST_ITEM_PATTERN.match(text)
+        if item:
+            self._close_paragraph(out)
+            indent = len(item.group(1).expandtabs(4))
+            self._list_item("ol" if item.group(2) else "ul", indent, render_inline(_escape(item.group(3))), out)
+            return
+
+        self._close_lists(out)
+        self._paragraph.append(render_inline(_escape(stripped)))
+
+    def _list_item(self, tag: str, indent: int, html: str, out: List[str]):
+        # Close lists nested deeper than the item
+        while self._lists and indent < self._lists[-1][1]:
+            out.append(f"</li></{self._lists.pop()[0]}>")
+
+        top = self._lists[-1] if self._lists else None
+        if top is None or indent >= top[1] + 2:
+            out.append(f"<{tag}><li>")
+            self._lists.append((tag, indent))
+        elif top[0] != tag:
+            self._lists.pop()
+            out.append(f"</li></{top[0]}><{tag}><li>")
+            self._lists.append((tag, indent))
+        else:
+            out.append("</li><li>")
+        out.append(html)
+
+    def _close_paragraph(self, out: List[str]):
+        if self._paragraph:
+            out.append(f"<p>{' '.join(self._paragraph)}</p>")
+            self._paragraph = []
+
+    def _close_lists(self, out: List[str]):
+        while self._lists:
+            out.append(f"</li></{self._lists.pop()[0]}>")
+
+    def _close_blocks(self, out: List[str]):
+        self._close_paragraph(out)
+        self._close_lists(out)
+
+    def _close_code_block(self, out: List[str]):
+        language = f' class="language-{self._fence_language}"' if self._fence_language else ""
+        out.append(f"<pre><code{language}>" + "\n".join(self._code_lines) + "</code></pre>")
+        self._fence = None
+        self._fence_language = ""
+        self._code_lines = []
+
+def convert_markdown_to_html(markdown: str) -> str:
+    """Convert markdown of an answer to sanitized HTML"""
+    renderer = MarkdownRenderer()
+    return renderer.feed(markdown) + renderer.close()
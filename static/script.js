@@ -128,6 +128,72 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
+function parseEvent(rawEvent) {
+    let event = "message";
+    const dataLines = [];
+    rawEvent.split("\n").forEach(line => {
+        if (line.startsWith("event:")) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+            dataLines.push(line.slice(5).trim());
+        }
+    });
+    return { event, data: dataLines.length ? JSON.parse(dataLines.join("\n")) : {} };
+}
+
+async function readStream(body) {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let botMessage = null;
+    let content = null;
+    let finished = false;
+    // HTML of the completed lines of the answer, rendered by the server as they arrive
+    let renderedHtml = "";
+
+    function ensureBotMessage() {
+        if (!botMessage) {
+            removeTempMessages();
+            botMessage = addMessage("bot", "", true);
+            botMessage.removeAttribute("data-temp");
+            content = botMessage.querySelector(".message-content");
+        }
+    }
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-sent events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const { event, data } = parseEvent(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+
+            ensureBotMessage();
+            if (event === "token") {
+                // Completed lines are shown rendered, the line being written as raw text
+                renderedHtml += data.html || "";
+                content.innerHTML = renderedHtml;
+                content.appendChild(document.createTextNode(data.pending || ""));
+                scrollToBottom(false);
+            } else if (event === "done" || event === "error") {
+                content.innerHTML = formatBotResponse(data.response);
+                scrollToBottom();
+                finished = true;
+            }
+        }
+    }
+
+    if (!finished) {
+        ensureBotMessage();
+        if (!content.textContent) {
+            content.textContent = 'Xin lỗi, tôi không thể tạo phản hồi lúc này.';
+        }
+    }
+}
+
 chatForm.addEventListener("submit", async (e) => {
     e.preventDefault();
     const userMessage = messageInput.value.trim();
@@ -150,24 +216,17 @@ chatForm.addEventListener("submit", async (e) => {
     scrollToBottom();
 
     try {
-        const response = await fetch("/chat", {
+        const response = await fetch(chatForm.dataset.streamUrl, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ message: userMessage })
         });
 
-        if (!response.ok) {
+        if (!response.ok || !response.body) {
             throw new Error('Network response was not ok');
         }
 
-        const data = await response.json();
-        removeTempMessages();
-
-        if (data.response) {
-            addMessage('bot', data.response);
-        } else {
-            addMessage('bot', 'Xin lỗi, tôi không thể tạo phản hồi lúc này.');
-        }
+        await readStream(response.body);
 
     } catch (err) {
         console.error('Error:', err);
@@ -0,0 +1,90 @@
+"""Golden HTML of the markdown renderer of src/utils.py, at once and streamed
+
+Answers come from the model and are put in the page as HTML, so injected tags must
+be stripped or escaped whichever way the text is split into streamed chunks.
+"""
+import sys
+import pytest
+
+from pathlib import Path
+
+root_dir = str(Path(__file__).parent.parent)
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from src.utils import MarkdownRenderer, convert_markdown_to_html
+
+INJECTION_CASES = [
+    ('<script>alert("x")</script>Hello', '<p>alert("x")Hello</p>'),
+    ('<img src=x onerror=alert(1)>Hi <b>bold</b> <!-- hidden -->end', '<p>Hi bold end</p>'),
+    ('a < b && c > d', '<p>a &lt; b &amp;&amp; c &gt; d</p>'),
+    ('Tom &amp; Jerry', '<p>Tom &amp; Jerry</p>'),
+    ('**<i>x</i>**', '<p><b>x</b></p>'),
+    ('`<b>code</b>`', '<p><code>code</code></p>'),
+]
+
+FENCED_CASES = [
+    ("```python\nif a < b:\n    print('**not bold**')\n```\nAfter",
+     '<pre><code class="language-python">if a &lt; b:\n    print(\'**not bold**\')</code></pre><p>After</p>'),
+    ('~~~\n<script>\n~~~', '<pre><code>&lt;script&gt;</code></pre>'),
+    ('```\nstill streaming', '<pre><code>still streaming</code></pre>'),
+]
+
+LIST_CASES = [
+    ('- one\n  - one.a\n    - one.a.i\n- two',
+     '<ul><li>one<ul><li>one.a<ul><li>one.a.i</li></ul></li></ul></li><li>two</li></ul>'),
+    ('1. Step one\n   - detail\n   - more\n2. Step two\n   1. sub',
+     '<ol><li>Step one<ul><li>detail</li><li>more</li></ul></li><li>Step two<ol><li>sub</li></ol></li></ol>'),
+    ('- a\n\n- b', '<ul><li>a</li><li>b</li></ul>'),
+    ('1. one\n- two', '<ol><li>one</li></ol><ul><li>two</li></ul>'),
+    ('## Steps\n1. Open\n2. Login', '<h2>Steps</h2><ol><li>Open</li><li>Login</li></ol>'),
+]
+
+ANSWER = """## Chính sách đổi trả
+
+**Theo techshop-user-guide.pdf**, TechShop offers a 30-day return policy <script>x</script>for
+unsatisfactory products. Refunds take *7-10 business days* & cost < $5.
+
+1. Ensure the product is unused.
+2. Fill out the return form:
+   - Order number, e.g. `TS-2025-0042`
+   - Reason of the return
+3. Ship the product back.
+
+```
+Return address: <TechShop Returns>
+```
+
+Bạn còn thắc mắc gì khác không?"""
+
+def render_streamed(markdown, chunk_size):
+    renderer = MarkdownRenderer()
+    parts = [renderer.feed(markdown[start:start + chunk_size]) for start in range(0, len(markdown), chunk_size)]
+    return "".join(parts) + renderer.close()
+
+@pytest.mark.parametrize("markdown, expected", INJECTION_CASES)
+def test_injected_html(markdown, expected):
+    assert convert_markdown_to_html(markdown) == expected
+
+@pytest.mark.parametrize("markdown, expected", FENCED_CASES)
+def test_fenced_code(markdown, expected):
+    assert convert_markdown_to_html(markdown) == expected
+
+@pytest.mark.parametrize("markdown, expected", LIST_CASES)
+def test_nested_lists(markdown, expected):
+    assert convert_markdown_to_html(markdown) == expected
+
+def test_inline_formatting():
+    assert convert_markdown_to_html('**bold** and *it* and ***both***') == '<p><b>bold</b> and <i>it</i> and <b><i>both</i></b></p>'
+    assert convert_markdown_to_html('2 * 3 * 4') == '<p>2 * 3 * 4</p>'
+
+@pytest.mark.parametrize("markdown", [markdown for markdown, _ in INJECTION_CASES + FENCED_CASES + LIST_CASES] + [ANSWER])
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 13])
+def test_streamed_matches_whole_text(markdown, chunk_size):
+    assert render_streamed(markdown, chunk_size) == convert_markdown_to_html(markdown)
+
+def test_streamed_answer_has_no_injected_tags():
+    html = render_streamed(ANSWER, 1)
+    assert "<script>" not in html and "</script>" not in html
+    assert "&lt;TechShop Returns&gt;" in html
+    assert "&amp; cost &lt; $5" in html
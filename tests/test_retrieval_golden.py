@@ -0,0 +1,41 @@
+"""Retrieval quality of the golden query set, offline with the fake Gemini backend
+
+Thresholds sit just under the offline values (recall@5 1.0, MRR 0.8948, follow-ups
+MRR 0.9167), so a change to chunking, ranking or query rewriting which loses a
+golden answer fails here instead of only in a benchmark report.
+"""
+import sys
+import pytest
+
+from pathlib import Path
+
+benchmarks_dir = str(Path(__file__).parent.parent / "benchmarks")
+if benchmarks_dir not in sys.path:
+    sys.path.insert(0, benchmarks_dir)
+
+import run_benchmark
+
+TOP_K = 5
+MIN_RECALL = 1.0
+MIN_MRR = 0.88
+MIN_FOLLOW_UP_RECALL = 1.0
+MIN_FOLLOW_UP_MRR = 0.9
+
+@pytest.fixture(scope="module")
+def retrieval(tmp_path_factory):
+    config = run_benchmark.create_config({}, str(tmp_path_factory.mktemp("golden")))
+    chatbot = run_benchmark.create_chatbot(config, "fake", run_benchmark.StageTimer(), 0.0, 0.0)
+    chatbot.index_corpus()
+    queries = run_benchmark.load_queries(str(Path(benchmarks_dir) / "queries.jsonl"))
+    return run_benchmark.benchmark_retrieval(chatbot, queries, TOP_K)
+
+def test_golden_recall(retrieval):
+    assert retrieval[f"recall@{TOP_K}"] >= MIN_RECALL, f"Missed: {retrieval['misses']}"
+
+def test_golden_mrr(retrieval):
+    assert retrieval["mrr"] >= MIN_MRR
+
+def test_golden_follow_ups(retrieval):
+    assert retrieval["follow_up_queries"] > 0
+    assert retrieval[f"follow_up_recall@{TOP_K}"] >= MIN_FOLLOW_UP_RECALL
+    assert retrieval["follow_up_mrr"] >= MIN_FOLLOW_UP_MRR